@@ -0,0 +1,285 @@
+import ast
+import hashlib
+import importlib.util
+import os
+import re
+import select
+import subprocess
+import sys
+import threading
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+from types import ModuleType
+
+from bitbuffer import BitBuffer
+
+# ways to talk to an augmenter, all of them answer a batch of requests in order:
+# - ("?", line) -> `{min_hex}-{max_hex} {*created_labels_names} | {*used_labels_names}`
+# - (">", offset, line, labels) -> Augmented parsed from `{data} {*created_labels}`
+# (see examples/helloworld/helloworld.asm for the protocol)
+
+AUGMENTER = "./augmenter"
+
+# `./augmenter {r} {m} serve` answers with this line first when it supports the serve mode,
+# then it reads tab separated requests (`?\t{line}` or `>\t{offset_hex}\t{line}\t{*labels_hex}`)
+# one per line and writes one answer line per request in the same order
+# (`!{message}` when the request failed)
+SERVE_BANNER = "jaw-augmenter-serve 1"
+SERVE_HANDSHAKE_TIMEOUT = 5  # seconds
+
+# where a python augmenter finds the assembler modules it imports (e.g. bitbuffer)
+ASM_DIR = os.path.dirname(os.path.realpath(__file__))
+# the scripts a wrapper runs, `$SCRIPT_DIR/` like prefixes are dropped
+_SCRIPT = re.compile(r"[\w./${}-]+\.(?:py|sh)\b")
+_VARIABLES = re.compile(r"^(?:\$\{?\w+\}?/)+")
+
+Request = Tuple
+
+
+class AugmentationError(Exception):
+    pass
+
+
+class Augmented(NamedTuple):
+    bits: BitBuffer
+    labels: List[int]  # values of the created labels
+    code: bool = True  # False for data (e.g. #store_ascii), it is never optimized
+
+
+def parse_output(answer: str) -> Augmented:
+    # `{data} {*created_labels}`, data is binary if started with 0xb or hexadecimal if with 0x
+    # (binary answers are code and hexadecimal ones are data)
+    data, *created = answer.split()
+    if data.startswith("0xb"):
+        return Augmented(BitBuffer.from_bin(data[3:]), [int(e, 16) for e in created])
+    elif data.startswith("0x"):
+        return Augmented(BitBuffer.from_hex(data[2:]), [int(e, 16) for e in created], False)
+    raise AugmentationError(f"Error: neither binary nor hex data: {data}")
+
+
+class Augmenter:
+    path: str
+    _identity: str | None = None
+
+    @property
+    def identity(self) -> str:
+        # hash of the augmenter and of the files it runs (see sources)
+        if self._identity is None:
+            h = hashlib.sha256()
+            for path in sources(self.path):
+                with open(path, "rb") as f:
+                    data = f.read()
+                h.update(f"{os.path.basename(path)} {len(data)}\n".encode())
+                h.update(data)
+            self._identity = h.hexdigest()
+        return self._identity
+
+    def run(self, r: int, m: int, requests: Sequence[Request]) -> List:
+        # a str for every `?` and an Augmented for every `>`
+        return [self._one(r, m, req) for req in requests]
+
+    def _one(self, r: int, m: int, req: Request) -> str | Augmented:
+        raise NotImplementedError()
+
+    def query(self, r: int, m: int, line: str) -> str:
+        return self.run(r, m, [("?", line)])[0]
+
+    def augment(self, r: int, m: int, offset: int, line: str, labels=()) -> Augmented:
+        return self.run(r, m, [(">", offset, line, labels)])[0]
+
+    def close(self):
+        pass
+
+
+def sources(path: str) -> List[str]:
+    # the augmenter file and the files it runs that can be found without running it:
+    # - a script: the .py/.sh files it mentions (`python "$SCRIPT_DIR/../_shared/augmenter.py"`)
+    #   relative to the script directory or to the working directory
+    # - a python file: the modules it imports from its own directory or from ASM_DIR
+    found: List[str] = []
+    todo = [path]
+    while todo:
+        path = os.path.realpath(todo.pop(0))
+        if path in found or not os.path.isfile(path):
+            continue
+        found.append(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        here = os.path.dirname(path)
+        if path.endswith(".py"):
+            try:
+                tree = ast.parse(data)
+            except (SyntaxError, ValueError):
+                continue
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    names = [e.name for e in node.names]
+                elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                    names = [node.module]
+                else:
+                    continue
+                for name in names:
+                    module = os.path.join(*name.split(".")) + ".py"
+                    todo += [os.path.join(here, module), os.path.join(ASM_DIR, module)]
+        else:
+            for script in _SCRIPT.findall(data.decode(errors="replace")):
+                script = _VARIABLES.sub("", script)
+                todo += [os.path.join(here, script), script]
+    return found
+
+
+def request_fields(req: Request) -> List[str]:
+    if req[0] == "?":
+        return ["?", req[1]]
+    _, offset, line, labels = req
+    return [">", f"{offset:x}", line, *(f"{e:x}" for e in labels)]
+
+
+class ProcessAugmenter(Augmenter):
+    # any executable speaking the `./augmenter {r} {m} {>/?} {offset} {line} {labels}` protocol,
+    # spawned once per request
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def _one(self, r: int, m: int, req: Request) -> str | Augmented:
+        process = subprocess.Popen(
+            [self.path, str(r), str(m), *request_fields(req)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        stdout, stderr = process.communicate()
+
+        if process.returncode != 0:
+            raise AugmentationError(f"Error: {stderr}")
+        else:
+            return stdout if req[0] == "?" else parse_output(stdout)
+
+
+class ServerAugmenter(Augmenter):
+    # an executable started once per (r, m) in the serve mode, requests are pipelined:
+    # a writer thread streams all of them while the answers are read,
+    # falls back to the per-request processes when the augmenter does not answer with the banner
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._servers: Dict[Tuple[int, int], subprocess.Popen] = {}
+        self._fallback: ProcessAugmenter | None = None
+
+    def _start(self, r: int, m: int) -> subprocess.Popen | None:
+        server = self._servers.get((r, m))
+        if server is not None:
+            return server
+        server = subprocess.Popen(
+            [self.path, str(r), str(m), "serve"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        assert server.stdout is not None
+        ready, _, _ = select.select([server.stdout], [], [], SERVE_HANDSHAKE_TIMEOUT)
+        if not ready or server.stdout.readline().rstrip("\n") != SERVE_BANNER:
+            server.kill()
+            server.wait()
+            self._fallback = ProcessAugmenter(self.path)
+            return None
+        self._servers[(r, m)] = server
+        return server
+
+    def run(self, r: int, m: int, requests: Sequence[Request]) -> List:
+        if self._fallback is None:
+            server = self._start(r, m)
+        if self._fallback is not None:
+            return self._fallback.run(r, m, requests)
+        assert server is not None and server.stdin is not None and server.stdout is not None
+
+        lines = []
+        for req in requests:
+            fields = request_fields(req)
+            if any("\t" in e or "\n" in e for e in fields):
+                raise AugmentationError(f"Error: tabs and newlines cannot be sent: {fields}")
+            lines.append("\t".join(fields) + "\n")
+
+        def write():
+            try:
+                server.stdin.writelines(lines)
+                server.stdin.flush()
+            except BrokenPipeError:
+                pass  # the reader reports the server exit
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        answers: List = []
+        try:
+            for req in requests:
+                answer = server.stdout.readline()
+                if not answer:
+                    raise AugmentationError(
+                        f"Error: augmenter server exited with {server.wait()}"
+                    )
+                if answer.startswith("!"):
+                    raise AugmentationError(f"Error: {answer[1:].strip()}")
+                answers.append(answer if req[0] == "?" else parse_output(answer))
+        except AugmentationError:
+            # the server is out of sync with the requests now
+            self._stop(r, m)
+            raise
+        writer.join()
+        return answers
+
+    def _stop(self, r: int, m: int):
+        server = self._servers.pop((r, m))
+        server.kill()
+        server.wait()
+
+    def close(self):
+        for server in self._servers.values():
+            assert server.stdin is not None
+            server.stdin.close()
+            server.wait()
+        self._servers.clear()
+
+
+class ModuleAugmenter(Augmenter):
+    # a python augmenter (like examples/_shared/augmenter.py) imported once,
+    # its `query`/`augment` are called with an explicit context,
+    # `augment` returns the bits as a BitBuffer (`content`), the created labels
+    # as `new_labels_offsets` and whether the bits are code or data as `code`
+
+    module: ModuleType
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        spec = importlib.util.spec_from_file_location("augmenter", path)
+        if spec is None or spec.loader is None:
+            raise AugmentationError(f"Error: cannot import {path}")
+        self.module = importlib.util.module_from_spec(spec)
+        # let it import its siblings the same way it does when run as a script
+        sys.path.insert(0, os.path.dirname(os.path.realpath(path)))
+        try:
+            spec.loader.exec_module(self.module)
+        finally:
+            sys.path.pop(0)
+
+    def _one(self, r: int, m: int, req: Request) -> str | Augmented:
+        try:
+            if req[0] == "?":
+                return self.module.query(self.module.Context(r, m), req[1])
+            _, offset, line, labels = req
+            ctx = self.module.Context(r, m, offset + self.module.CODE_BEGINNING)
+            res = self.module.augment(ctx, line, list(labels))
+        except Exception as e:
+            raise AugmentationError(f"Error: {type(e).__name__}: {e}")
+        return Augmented(res.content, list(res.new_labels_offsets), res.code)
+
+
+def load_augmenter(path: str = AUGMENTER) -> Augmenter:
+    # a python augmenter is used in-process when it is given as a .py file
+    # or there is a .py file next to the executable (e.g. `./augmenter.py` for `./augmenter`),
+    # other executables are run in the serve mode if they support it
+    if not path.endswith(".py") and os.path.exists(path + ".py"):
+        path += ".py"
+    if path.endswith(".py"):
+        return ModuleAugmenter(path)
+    return ServerAugmenter(path)
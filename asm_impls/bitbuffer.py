@@ -0,0 +1,90 @@
+# a growable sequence of bits packed MSB-first into a bytearray (the order of a program image),
+# the bits after `nbits` in the last byte are always zero
+
+
+class BitBuffer:
+    __slots__ = ("data", "nbits")
+
+    data: bytearray
+    nbits: int
+
+    def __init__(self, data: bytes | bytearray | None = None, nbits: int | None = None) -> None:
+        self.data = bytearray() if data is None else bytearray(data)
+        self.nbits = len(self.data) * 8 if nbits is None else nbits
+        assert len(self.data) == (self.nbits + 7) >> 3, "data does not match nbits"
+
+    @classmethod
+    def of(cls, value: int, width: int) -> "BitBuffer":
+        res = cls()
+        res.append(value, width)
+        return res
+
+    @classmethod
+    def from_bin(cls, s: str) -> "BitBuffer":
+        return cls.of(int(s, 2) if s else 0, len(s))
+
+    @classmethod
+    def from_hex(cls, s: str) -> "BitBuffer":
+        if len(s) % 2 == 0:
+            return cls(bytes.fromhex(s))
+        return cls.of(int(s, 16), len(s) * 4)
+
+    def __len__(self) -> int:
+        return self.nbits
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, BitBuffer) and (self.nbits, self.data) == (other.nbits, other.data)
+
+    def __getitem__(self, i: int) -> int:
+        if not 0 <= i < self.nbits:
+            raise IndexError(i)
+        return self.data[i >> 3] >> (7 - (i & 7)) & 1
+
+    def __repr__(self) -> str:
+        return f"BitBuffer({self.to_bin()!r})"
+
+    def append(self, value: int, width: int):
+        # the `width` low bits of `value`, the highest one first
+        if width <= 0:
+            return
+        value &= (1 << width) - 1
+        used = self.nbits & 7
+        if used:
+            # take the partial last byte back and write it together with the new bits
+            value |= (self.data.pop() >> (8 - used)) << width
+            width += used
+            self.nbits -= used
+        pad = -width & 7
+        self.data += (value << pad).to_bytes((width + pad) >> 3, "big")
+        self.nbits += width
+
+    def extend(self, other: "BitBuffer"):
+        if self.nbits & 7 == 0:
+            self.data += other.data
+            self.nbits += other.nbits
+        elif other.nbits:
+            self.append(int.from_bytes(other.data, "big") >> (-other.nbits & 7), other.nbits)
+
+    def read(self, at: int, width: int) -> int:
+        # `width` bits starting from `at` as an MSB-first unsigned int
+        if width <= 0:
+            return 0
+        if at < 0 or at + width > self.nbits:
+            raise IndexError(at + width)
+        first = at >> 3
+        last = (at + width - 1) >> 3
+        chunk = int.from_bytes(self.data[first : last + 1], "big")
+        return (chunk >> (((last + 1) << 3) - at - width)) & ((1 << width) - 1)
+
+    def to_bytes(self) -> bytes:
+        # zero padded to whole bytes
+        return bytes(self.data)
+
+    def to_bin(self) -> str:
+        if not self.nbits:
+            return ""
+        return f"{int.from_bytes(self.data, 'big') >> (-self.nbits & 7):0{self.nbits}b}"
+
+    def to_hex(self) -> str:
+        assert self.nbits % 4 == 0, "not a whole number of hex digits"
+        return self.data.hex()[: self.nbits // 4]
@@ -0,0 +1,88 @@
+import hashlib
+import sqlite3
+import struct
+from typing import Dict, List, Sequence
+
+from augmenters import Augmented, Augmenter, Request, request_fields
+from bitbuffer import BitBuffer
+
+# augmenter answers stored on disk by the hash of everything they depend on:
+# the augmenter identity, r, m and the request (mode, offset, line, label values),
+# so after an edit only the changed lines and the lines the layout has moved are augmented again
+
+CACHE = ".jaw-cache"
+
+# `?` answers are stored as text,
+# `>` answers as {nbits: u64}{labels count: u32}{code: u8}{labels: u64...}{data}
+# (the table name changes with the format)
+TABLE = "answers_v3"
+_AUGMENTED = struct.Struct("<QIB")
+
+
+def _pack(answer: str | Augmented) -> bytes:
+    if isinstance(answer, str):
+        return answer.encode()
+    bits, labels, code = answer
+    return (
+        _AUGMENTED.pack(bits.nbits, len(labels), code)
+        + struct.pack(f"<{len(labels)}Q", *labels)
+        + bits.data
+    )
+
+
+def _unpack(req: Request, blob: bytes) -> str | Augmented:
+    if req[0] == "?":
+        return blob.decode()
+    nbits, count, code = _AUGMENTED.unpack_from(blob)
+    at = _AUGMENTED.size + 8 * count
+    labels = list(struct.unpack_from(f"<{count}Q", blob, _AUGMENTED.size))
+    return Augmented(BitBuffer(blob[at:], nbits), labels, bool(code))
+
+
+class CachedAugmenter(Augmenter):
+    def __init__(self, inner: Augmenter, path: str = CACHE) -> None:
+        self.inner = inner
+        self.path = inner.path
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            f"CREATE TABLE IF NOT EXISTS {TABLE} (key BLOB PRIMARY KEY, answer BLOB) WITHOUT ROWID"
+        )
+
+    def _key(self, r: int, m: int, req: Request) -> bytes:
+        fields = [self.inner.identity, str(r), str(m), *request_fields(req)]
+        return hashlib.sha256("\0".join(fields).encode()).digest()
+
+    def run(self, r: int, m: int, requests: Sequence[Request]) -> List:
+        keys = [self._key(r, m, req) for req in requests]
+        found: Dict[bytes, bytes] = {}
+        for at in range(0, len(keys), 512):  # sqlite limits the number of parameters
+            chunk = keys[at : at + 512]
+            found.update(
+                self._db.execute(
+                    f"SELECT key, answer FROM {TABLE} WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+
+        answers = [
+            None if key not in found else _unpack(req, found[key])
+            for req, key in zip(requests, keys)
+        ]
+        missing = [j for j, answer in enumerate(answers) if answer is None]
+        if missing:
+            for j, answer in zip(missing, self.inner.run(r, m, [requests[j] for j in missing])):
+                answers[j] = answer
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO {TABLE} VALUES (?, ?)",
+                [(keys[j], _pack(answers[j])) for j in missing],
+            )
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        return answers
+
+    def close(self):
+        self.inner.close()
+        self._db.commit()
+        self._db.close()
@@ -0,0 +1,147 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from augmenters import AugmentationError, Augmenter
+from bitbuffer import BitBuffer
+from optimizer import CODE_BEGINNING, DATA, FREE, PINNED, Decoder, optimize
+
+# places the augmented lines one after another:
+# - `?` tells the size range of every line and which labels it creates and uses
+# - every pass augments all the lines at the offsets computed from the sizes of the previous pass
+#   and with the label values it reported, the sizes of lines like `reg1: 0x0 = const .label`
+#   depend on the label values, so this repeats until neither the sizes nor the labels change
+# the first pass starts from the minimal sizes and zero labels
+# every pass runs the optimizer over the augmented lines before they are measured,
+# it only shrinks the lines creating labels in front of the labels, which move back with the code
+
+MAX_PASSES = 16
+# the optimizer decisions depend on the layout too (jump targets, label values in registers),
+# after a pass with the right label values (the optimizer has seen the jumps where they go)
+# or from this pass on the optimized lines are not let to get shorter than in the previous pass,
+# so their sizes only grow and the layout settles
+GROW_FROM = 5
+
+
+class LayoutError(AugmentationError):
+    pass
+
+
+@dataclass
+class Line:
+    lineno: int  # 1-based line in the source file
+    text: str
+    min: int = 0
+    max: int = 0
+    created: List[str] = field(default_factory=list)  # label names
+    used: List[str] = field(default_factory=list)
+    offset: int = 0  # bits from the program start
+    bits: BitBuffer = field(default_factory=BitBuffer)  # the augmented code of the last pass
+    code: bool = True  # False for data
+    saved: int = 0  # bits removed by the optimizer
+
+
+def read_lines(filename: str) -> List[Line]:
+    lines: List[Line] = []
+    with open(filename, "r") as file:
+        for lineno, line in enumerate(file, 1):
+            line = line.split("//")[0].strip()
+            if len(line) != 0:
+                lines.append(Line(lineno, line))
+    return lines
+
+
+def parse_info(answer: str) -> Tuple[int, int, List[str], List[str]]:
+    # `{min_hex}-{max_hex} {*created_labels_names} | {*used_labels_names}`
+    head, _, used = answer.partition("|")
+    rng, *created = head.split()
+    lo, _, hi = rng.partition("-")
+    return int(lo, 16), int(hi, 16), created, used.split()
+
+
+def layout(
+    r: int, m: int, lines: List[Line], augmenter: Augmenter, optimized: bool = True
+) -> int:
+    # fills offset/bits of the lines, returns the number of passes it took
+    defined: Dict[str, Line] = {}
+    for line, answer in zip(lines, augmenter.run(r, m, [("?", e.text) for e in lines])):
+        line.min, line.max, line.created, line.used = parse_info(answer)
+        for name in line.created:
+            if name in defined:
+                raise LayoutError(
+                    f"Error: line {line.lineno}: label {name} is already declared "
+                    f"on line {defined[name].lineno}"
+                )
+            defined[name] = line
+    for line in lines:
+        for name in line.used:
+            if name not in defined:
+                raise LayoutError(f"Error: line {line.lineno}: undeclared label {name}")
+
+    sizes = [line.min for line in lines]
+    values = {name: 0 for name in defined}
+    growing = False
+    decoder = Decoder(r, m)
+    for passes in range(1, MAX_PASSES + 1):
+        offset = 0
+        for line, size in zip(lines, sizes):
+            line.offset = offset
+            offset += size
+
+        requests = [
+            (">", line.offset, line.text, [values[name] for name in line.used])
+            for line in lines
+        ]
+        new_values: Dict[str, int] = {}
+        for line, (bits, created, code) in zip(lines, augmenter.run(r, m, requests)):
+            line.bits = bits
+            line.code = code
+            if len(created) != len(line.created):
+                raise LayoutError(
+                    f"Error: line {line.lineno}: {len(created)} label values "
+                    f"for {len(line.created)} labels ({line.text})"
+                )
+            if not line.min <= len(line.bits) <= line.max:
+                raise LayoutError(
+                    f"Error: line {line.lineno}: {len(line.bits)} bits are out of the reported "
+                    f"range {line.min}-{line.max} ({line.text})"
+                )
+            new_values.update(zip(line.created, created))
+
+        if optimized:
+            # the labels as bit offsets in their lines and the values the lines were given
+            labels = [
+                [(new_values[name] - CODE_BEGINNING - line.offset, values[name]) for name in line.created]
+                for line in lines
+            ]
+            pieces = [
+                (
+                    line.bits,
+                    line.offset,
+                    DATA if not line.code else PINNED if line.created else FREE,
+                    marks,
+                )
+                for line, marks in zip(lines, labels)
+            ]
+            at_least = sizes if growing else None
+            optimized_bits = optimize(r, m, pieces, at_least, decoder)
+            for line, bits, marks in zip(lines, optimized_bits, labels):
+                line.saved = len(line.bits) - len(bits)
+                line.bits = bits
+                # only the head of a line with labels shrinks, the labels past it move back
+                for name, (at, _) in zip(line.created, marks):
+                    if at > 0:
+                        new_values[name] -= line.saved
+
+        new_sizes = [len(line.bits) for line in lines]
+        if new_sizes == sizes and new_values == values:
+            return passes
+        growing = growing or new_values == values or passes + 1 >= GROW_FROM
+        # the labels move with their lines, the next pass gets them where they will be
+        offset = 0
+        for line, size in zip(lines, new_sizes):
+            for name in line.created:
+                new_values[name] += offset - line.offset
+            offset += size
+        sizes, values = new_sizes, new_values
+
+    raise LayoutError(f"Error: the layout did not settle in {MAX_PASSES} passes")
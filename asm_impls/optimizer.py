@@ -0,0 +1,511 @@
+import heapq
+from itertools import compress
+from operator import itemgetter
+from typing import Dict, List, Sequence, Set, Tuple
+
+from bitbuffer import BitBuffer
+
+# a peephole pass over the augmented lines (pieces), run before the layout measures them:
+# - a bit write is dropped when the bit is known to hold the value already
+#   (registers start zeroed, memory is only known after it is written),
+#   so `reg1: any = const 0x5` only keeps the writes of the bits that differ
+# - a bit write is dropped when the same bit is written again before anything reads it
+# - unreachable code is dropped (e.g. after a `mem[reg] = 1` with the register known to be 0)
+#
+# what is known is tracked along the control flow: the jump targets are computed
+# from the known registers and the piece offsets, at every target the states of all the
+# ways in meet (a loop is walked until its head state settles).
+# a jump that can't be followed (unknown register, a target in the middle of a changed piece
+# or in data) is assumed to land on a label or inside its own piece:
+# nothing is known inside and right after its piece and at the pinned pieces.
+# reaching data or undecodable code is treated the same way.
+#
+# the free pieces without jumps are changed as a whole, the other pieces only in their head
+# (the instructions before the first jump, e.g. the jump offsets a macro loads before its jumps):
+# the jumps the augmenter measured inside of the piece must land past the head,
+# the labels must be at the start or past the head (the layout moves them with what they point to)
+# and nothing must jump into the head, otherwise the piece is kept as it is.
+# data is never changed, the free pieces nothing gets to are dropped as a whole.
+#
+# putting back any of the dropped instructions is harmless (they write what is there already,
+# what is overwritten before it is read or they are never reached), so a piece can be kept
+# from shrinking below a given size, the layout uses it to settle
+# pieces that don't split into whole instructions are treated like data
+
+# env `a`
+CODE_BEGINNING = 3
+HALT = 0  # writing 1 halts
+STDOUT_DATA = 1
+STDOUT_TRIGGER = 2  # writing 1 sends mem[STDOUT_DATA] to stdout
+
+MEM_WRITE = 0b00
+MEM_CONDJMP = 0b01
+REG_WRITE = 0b10
+REG_CONDJMP = 0b11
+OPAQUE = -1  # a whole data piece, never executed as far as the optimizer knows
+
+WINDOW = 256  # bytes the decoder reads at once
+APPEND = 4096  # bits of the kept instructions appended at once
+
+# piece kinds
+FREE = 0
+PINNED = 1
+DATA = 2
+
+# (bits, offset in the program, kind, labels as (bit offset in the piece, value))
+Piece = Tuple[BitBuffer, int, int, Sequence[Tuple[int, int]]]
+
+# (op, n, i, b, at, span), i is 0 for mem instructions, b is 0 for condjmps,
+# `at` is the bit offset in the piece (plain tuples, there are a lot of them)
+Instr = Tuple[int, int, int, int, int, int]
+
+
+class Decoder:
+    # remembers the pieces it decoded by their bits: the same lines repeat a lot
+    # and a layout pass mostly augments the same lines as the previous one
+
+    decoded: Dict[Tuple[bytes, int], Tuple[List[Instr] | None, int]]
+
+    def __init__(self, r: int, m: int) -> None:
+        self.r = r
+        self.m = m
+        self.decoded = {}
+        self.max_span = 2 + r + m + r
+        self.spans = {
+            MEM_WRITE: 2 + r + 1,
+            MEM_CONDJMP: 2 + r + r,
+            REG_WRITE: 2 + r + m + 1,
+            REG_CONDJMP: 2 + r + m + r,
+        }
+
+    def split(self, bits: BitBuffer) -> Tuple[List[Instr] | None, int]:
+        # the instructions and the end of the head (the ones before the first jump)
+        key = (bytes(bits.data), len(bits))
+        res = self.decoded.get(key)
+        if res is None:
+            instrs = self.decode(bits)
+            head = 0
+            if instrs is not None:
+                head = next((k for k, ins in enumerate(instrs) if ins[0] & 0b01), len(instrs))
+            res = self.decoded[key] = instrs, head
+        return res
+
+    def decode(self, bits: BitBuffer) -> List[Instr] | None:
+        # None when the bits don't split into whole instructions
+        r, m, max_span, spans = self.r, self.m, self.max_span, self.spans
+        span_mask = (1 << max_span) - 1
+        r_mask = (1 << r) - 1
+        m_mask = (1 << m) - 1
+        # the bits are read WINDOW bytes at a time (and the bytes of an instruction starting
+        # at the end of them), the data is padded with zeros, so a read past the end gives zeros
+        tail = (max_span + 7 + 7) >> 3
+        data = bytes(bits.data) + bytes(tail)
+        res: List[Instr] = []
+        append = res.append
+        at = 0
+        end = len(bits)
+        base = -WINDOW * 8  # the bit the window starts at (nothing is read yet)
+        window = top = 0  # the window as an int, the bit right after it
+        while at < end:
+            if at - base >= WINDOW * 8:
+                base = at & ~7
+                read = data[base >> 3 : (base >> 3) + WINDOW + tail]
+                window = int.from_bytes(read, "big")
+                top = base + len(read) * 8
+            chunk = (window >> (top - at - max_span)) & span_mask
+            op = chunk >> (max_span - 2)
+            span = spans[op]
+            if at + span > end:
+                return None
+            n = (chunk >> (m + r)) & r_mask
+            # b of a write and k of a condjmp end the instruction
+            last = chunk >> (max_span - span)
+            if op == MEM_WRITE:
+                append((op, n, 0, last & 1, at, span))
+            elif op == REG_WRITE:
+                append((op, n, (chunk >> r) & m_mask, last & 1, at, span))
+            else:
+                i = (chunk >> r) & m_mask if op == REG_CONDJMP else 0
+                # a condjmp keeps k in `b`
+                append((op, n, i, last & r_mask, at, span))
+            at += span
+        return res
+
+
+class _Known:
+    # what is known about the registers and the memory at some point of the code
+
+    __slots__ = ("reg_known", "reg_values", "mem")
+
+    def __init__(self, reg_known: List[int], reg_values: List[int], mem: Dict[int, int]) -> None:
+        self.reg_known = reg_known
+        self.reg_values = reg_values
+        self.mem = mem
+
+    def copy(self) -> "_Known":
+        return _Known(list(self.reg_known), list(self.reg_values), dict(self.mem))
+
+    def forget(self):
+        self.reg_known = [0] * len(self.reg_known)
+        self.mem.clear()
+
+    def meet(self, other: "_Known") -> bool:
+        # keeps what both agree on, returns whether anything was forgotten
+        changed = False
+        for n, known in enumerate(self.reg_known):
+            agreed = known & other.reg_known[n] & ~(self.reg_values[n] ^ other.reg_values[n])
+            if agreed != known:
+                self.reg_known[n] = agreed
+                self.reg_values[n] &= agreed
+                changed = True
+        for addr, b in list(self.mem.items()):
+            if other.mem.get(addr) != b:
+                del self.mem[addr]
+                changed = True
+        return changed
+
+
+class _Program:
+    # the pieces as one list of instructions
+
+    def __init__(self, pieces: Sequence[Piece], decoder: Decoder) -> None:
+        self.instrs: List[Instr] = []
+        self.piece_of: List[int] = []
+        self.free: List[bool] = []  # can be dropped
+        self.starts_of: List[int] = []  # memory addresses of the pieces
+        self.codes: List[BitBuffer | None] = []  # the bits of the pieces with a head
+        self.ranges: List[Tuple[int, int]] = []  # [first, end) instructions of every piece
+        # the end of the head of every piece (the instructions that can be dropped),
+        # the whole piece for a free piece without jumps, `first` when there is no head
+        self.heads: List[int] = []
+        self.marks: List[Dict[int, int]] = []  # bit offset of a label in the piece -> its value
+        # memory address -> index of the instruction a jump there lands on
+        self.starts: Dict[int, int] = {}
+        # bit offset in the piece -> index of the instruction a jump there lands on
+        # (the pieces are augmented at the offsets of the previous sizes, so they overlap
+        # until the layout settles, a jump inside of its piece is found by the piece itself)
+        self.inside: List[Dict[int, int]] = []
+        self.pinned: Set[int] = set()  # first instructions of the pinned and data pieces
+
+        end = CODE_BEGINNING
+        for j, (bits, offset, kind, labels) in enumerate(pieces):
+            instrs, head = decoder.split(bits) if kind != DATA else (None, 0)
+            first = len(self.instrs)
+            start = CODE_BEGINNING + offset
+            opaque = instrs is None
+            if instrs is None:
+                instrs = [(OPAQUE, 0, 0, 0, 0, len(bits))]
+                head = 0
+            plain = kind == FREE and head == len(instrs) and not opaque
+            if not plain:
+                # a label inside the head would move in the middle of it
+                head_bits = instrs[head][4] if head < len(instrs) else len(bits)
+                if any(0 < at < head_bits for at, _ in labels):
+                    head = 0
+            self.starts_of.append(start)
+            self.codes.append(bits if head else None)
+            self.heads.append(first + head)
+            self.marks.append(dict(labels))
+            self.starts.setdefault(start, first)
+            if kind != FREE or opaque:
+                self.pinned.add(first)
+            inside = {}
+            if not plain:
+                inside = {ins[4]: k for k, ins in enumerate(instrs, first)}
+                inside[len(bits)] = first + len(instrs)
+                for at, k in inside.items():
+                    self.starts.setdefault(start + at, k)
+            self.inside.append(inside)
+            self.instrs.extend(instrs)
+            self.piece_of.extend([j] * len(instrs))
+            self.free.extend([True] * head + [False] * (len(instrs) - head))
+            self.ranges.append((first, len(self.instrs)))
+            end = start + len(bits)
+        # running off the end of the program
+        self.starts.setdefault(end, len(self.instrs))
+        # the jumps by labels go where the labels are,
+        # the first one of the labels with the same value (the pieces between are empty)
+        labelled: Dict[int, int] = {}
+        for inside, marks in zip(self.inside, self.marks):
+            for at, value in marks.items():
+                if at in inside:
+                    labelled.setdefault(value, inside[at])
+        self.starts.update(labelled)
+
+    def fix(self, piece: int):
+        # keeps the head of the piece as it is
+        first = self.ranges[piece][0]
+        head = self.heads[piece]
+        self.free[first:head] = [False] * (head - first)
+        self.heads[piece] = first
+        self.codes[piece] = None
+
+    def check_jump(self, piece: int, at: int, target: int, fixed: Set[int]):
+        # adds the pieces with the heads that can't shrink for the jump from the bit `at`
+        # of the piece to the instruction `target` to stay right:
+        # a jump from a label is measured by the layout, the others are measured by the augmenter
+        # inside of their piece (and land past its head), a jump from outside can only land
+        # on the start of a piece or on a label past its head
+        first, end = self.ranges[piece]
+        head = self.heads[piece]
+        if head > first and at not in self.marks[piece] and not head <= target <= end:
+            fixed.add(piece)
+        if target < len(self.instrs):
+            into = self.piece_of[target]
+            first, head = self.ranges[into][0], self.heads[into]
+            if target != first and head > first and (
+                target < head or into != piece and self.instrs[target][4] not in self.marks[into]
+            ):
+                fixed.add(into)
+
+
+class _Interpreter:
+    # walks the program from the entries, marks the instructions to keep
+    # (reachable and not writing a known value) and collects the jump targets
+
+    def __init__(self, r: int, m: int, prog: _Program) -> None:
+        self.prog = prog
+        self.full = (1 << 2**m) - 1
+        self.masks = [1 << (2**m - 1 - i) for i in range(2**m)]
+        self.sizeofmem = 2 ** (2**m)
+        self.count = 2**r
+
+    def zeroed(self) -> _Known:
+        return _Known([self.full] * self.count, [0] * self.count, {})
+
+    def unknown(self) -> _Known:
+        return _Known([0] * self.count, [0] * self.count, {})
+
+    def run(
+        self, entries: Dict[int, _Known], targets: Set[int], loose: Set[int]
+    ) -> Tuple[bytearray, List[int | None], Set[int], Set[int], Set[int]]:
+        # the jumps of the loose pieces aren't followed and nothing is known inside of them,
+        # returns the kept instructions, the addresses the memory writes write,
+        # the new jump targets, the new loose pieces (with jumps that can't be followed)
+        # and the pieces with the heads that must stay as they are
+        prog = self.prog
+        instrs, free, piece_of = prog.instrs, prog.free, prog.piece_of
+        full, masks, sizeofmem = self.full, self.masks, self.sizeofmem
+        end = len(instrs)
+        keep = bytearray(end)
+        mem_addresses: List[int | None] = [None] * end
+        found: Set[int] = set()
+        new_loose: Set[int] = set()
+        fixed: Set[int] = set()
+        in_loose = bytearray(end)  # the instructions of the loose pieces
+        for piece in loose:
+            first, last = prog.ranges[piece]
+            in_loose[first:last] = b"\1" * (last - first)
+        work = list(entries)
+        heapq.heapify(work)
+        queued = set(work)
+
+        def land(j: int, state: _Known):
+            if j not in targets:
+                found.add(j)
+                return
+            entry = entries.get(j)
+            if entry is None:
+                entries[j] = state.copy()
+            elif not entry.meet(state):
+                return
+            if j not in queued:
+                queued.add(j)
+                heapq.heappush(work, j)
+
+        while work:
+            j = heapq.heappop(work)
+            queued.discard(j)
+            state = entries[j].copy()
+            reg_known, reg_values, mem = state.reg_known, state.reg_values, state.mem
+            while j < end:
+                op, n, i, b, _, span = instrs[j]
+                if in_loose[j]:
+                    state.forget()
+                    reg_known = state.reg_known
+                if op == REG_WRITE:
+                    mask = masks[i]
+                    if free[j] and reg_known[n] & mask and bool(reg_values[n] & mask) == b:
+                        keep[j] = 0
+                    else:
+                        keep[j] = 1
+                        reg_known[n] |= mask
+                        if b:
+                            reg_values[n] |= mask
+                        else:
+                            reg_values[n] &= ~mask
+                elif op == MEM_WRITE:
+                    keep[j] = 1
+                    addr = reg_values[n] if reg_known[n] == full else None
+                    mem_addresses[j] = addr
+                    if addr is None:
+                        mem.clear()  # it could have written anywhere
+                    elif addr == HALT and b:
+                        break
+                    elif addr == HALT or addr == STDOUT_TRIGGER:
+                        mem.pop(addr, None)
+                    elif free[j] and mem.get(addr) == b:
+                        keep[j] = 0
+                    else:
+                        mem[addr] = b
+                elif op == OPAQUE:
+                    keep[j] = 1
+                    if not in_loose[j]:
+                        new_loose.add(piece_of[j])  # it could do anything
+                else:
+                    keep[j] = 1
+                    if op == REG_CONDJMP:
+                        mask = masks[i]
+                        taken = bool(reg_values[n] & mask) if reg_known[n] & mask else None
+                    else:
+                        addr = reg_values[n] if reg_known[n] == full else None
+                        taken = None if addr is None else mem.get(addr)
+                    if taken != 0 and not in_loose[j]:
+                        piece = piece_of[j]
+                        target = None
+                        at = instrs[j][4] + span - 1
+                        if reg_known[b] == full:
+                            start = prog.starts_of[piece]
+                            origin = prog.marks[piece].get(at)
+                            if origin is None:
+                                dest = (start + at + reg_values[b]) % sizeofmem
+                                target = prog.inside[piece].get(dest - start)
+                            else:
+                                dest = (origin + reg_values[b]) % sizeofmem
+                            if target is None:
+                                target = prog.starts.get(dest)
+                        if target is None:
+                            new_loose.add(piece)
+                        else:
+                            prog.check_jump(piece, at, target, fixed)
+                            land(target, state)
+                            if taken:
+                                break
+                j += 1
+                if j in targets:
+                    land(j, state)
+                    break
+                if in_loose[j - 1] and (j == end or not in_loose[j]):
+                    state.forget()
+                    reg_known = state.reg_known
+        return keep, mem_addresses, found, new_loose, fixed
+
+    def walk(self) -> Tuple[bytearray, List[int | None]]:
+        # grows the jump targets and the loose pieces until the walk finds no new ones,
+        # once there are loose pieces, jumps can land on any pinned piece,
+        # then keeps the heads that must stay (and the ones of the loose pieces)
+        targets: Set[int] = set()
+        loose: Set[int] = set()
+        while True:
+            entries = {0: self.zeroed()}
+            if loose:
+                targets |= self.prog.pinned
+                for j in self.prog.pinned:
+                    entries[j] = self.unknown()
+            keep, mem_addresses, found, new_loose, fixed = self.run(entries, targets, loose)
+            if found <= targets and new_loose <= loose:
+                for piece in fixed | loose:
+                    first, head = self.prog.ranges[piece][0], self.prog.heads[piece]
+                    keep[first:head] = b"\1" * (head - first)
+                    self.prog.fix(piece)
+                return keep, mem_addresses
+            targets |= found
+            loose |= new_loose
+
+
+def _drop_overwritten(
+    prog: _Program, keep: bytearray, mem_addresses: List[int | None], code_end: int
+):
+    # unmarks the writes overwritten before anything reads them:
+    # walks the straight-line runs of the free instructions backwards collecting
+    # the bits that are written again before they are read
+    # (a jump landing in the middle of a run doesn't matter, the way through it is still straight)
+    overwritten_regs: Dict[int, int] = {}  # register -> bits
+    overwritten_mem: Set[int] = set()
+    instrs, free = prog.instrs, prog.free
+    for j in compress(range(len(instrs) - 1, -1, -1), keep[::-1]):
+        if not free[j]:
+            overwritten_regs.clear()
+            overwritten_mem.clear()
+            continue
+        op, n, i, b, _, _ = instrs[j]
+        if op == REG_WRITE:
+            bits = overwritten_regs.get(n, 0)
+            if bits >> i & 1:
+                keep[j] = 0
+            else:
+                overwritten_regs[n] = bits | 1 << i
+            continue
+        overwritten_regs.pop(n, None)  # the address is read
+        addr = mem_addresses[j]
+        if addr is None or (addr == HALT and b):
+            # could halt or send stdout
+            overwritten_regs.clear()
+            overwritten_mem.clear()
+        elif addr == STDOUT_TRIGGER and b:
+            overwritten_mem.discard(STDOUT_DATA)
+        elif addr == HALT or addr == STDOUT_TRIGGER or CODE_BEGINNING <= addr < code_end:
+            pass  # the code is read by being executed
+        elif addr in overwritten_mem:
+            keep[j] = 0
+        else:
+            overwritten_mem.add(addr)
+
+
+def optimize(
+    r: int,
+    m: int,
+    pieces: Sequence[Piece],
+    at_least: Sequence[int] | None = None,
+    decoder: Decoder | None = None,
+) -> List[BitBuffer]:
+    # the optimized bits of every piece,
+    # the pieces don't get shorter than `at_least` when they can help it,
+    # a decoder kept between the calls decodes the pieces that did not change only once
+    prog = _Program(pieces, decoder or Decoder(r, m))
+    keep, mem_addresses = _Interpreter(r, m, prog).walk()
+    code_end = CODE_BEGINNING + sum(len(piece[0]) for piece in pieces)
+    _drop_overwritten(prog, keep, mem_addresses, code_end)
+
+    instrs = prog.instrs
+    res = [piece[0] for piece in pieces]
+    for j, (first, end) in enumerate(prog.ranges):
+        need = 0 if at_least is None else at_least[j]
+        if first == end or keep[first : end].count(0) == 0:
+            continue
+        if (
+            pieces[j][2] == FREE
+            and instrs[first][0] != OPAQUE
+            and keep[first:end].count(1) == 0
+            and not need
+        ):
+            res[j] = BitBuffer()  # nothing gets to it
+            continue
+        head = prog.heads[j]
+        if head == first:
+            continue
+        keep[head:end] = b"\1" * (end - head)  # only the head changes
+        size = sum(compress(map(itemgetter(5), instrs[first:end]), keep[first:end]))
+        for k in range(first, head):
+            if size >= need:
+                break
+            if not keep[k]:
+                keep[k] = 1
+                size += instrs[k][5]
+        # the runs of the kept instructions are copied over as they are,
+        # gathered into an int of up to about APPEND bits before they are appended
+        code = prog.codes[j]
+        bits = res[j] = BitBuffer()
+        gathered = width = 0
+        run_at = run_end = 0
+        for ins in compress(instrs[first:end], keep[first:end]):
+            if ins[4] != run_end:
+                gathered = gathered << (run_end - run_at) | code.read(run_at, run_end - run_at)
+                width += run_end - run_at
+                if width >= APPEND:
+                    bits.append(gathered, width)
+                    gathered = width = 0
+                run_at = ins[4]
+            run_end = ins[4] + ins[5]
+        bits.append(gathered << (run_end - run_at) | code.read(run_at, run_end - run_at), width + run_end - run_at)
+    return res
@@ -1,58 +1,49 @@
 import argparse
-import subprocess
-
-
-class AugmentationError(Exception):
-    pass
-
-
-def augment_line(r, m, line):
-    command = ["./augmenter", str(r), str(m), ">", "0", line]
-    process = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-    )
-    stdout, stderr = process.communicate()
-
-    if process.returncode != 0:
-        raise AugmentationError(f"Error: {stderr}")
-    else:
-        return stdout
-
-
-def augment_lines_from_file(r: int, m: int, filename: str):
-    content: str = ""
-
-    with open(filename, "r") as file:
-        for line in file:
-            line = line.split("//")[0].strip()
-            if len(line) == 0:
-                continue
-            output = augment_line(r, m, line).strip()
-            output = output.split()[0]
-            print(line, ":", output)
-            if output.startswith("0xb"):
-                content += output[3:]
-            elif output.startswith("0x"):
-                for d in output[2:]:
-                    content += f"{int(d, base=16):04b}"
-            else:
-                raise ValueError(output)
-
-    # Adjust the last byte and write to the binary file
-    while len(content) % 8 != 0:
-        content += "0"  # Fill the remaining bits with zeros
-
-    # Convert binary content to bytes
-    binary_bytes = bytes(int(content[i : i + 8], 2) for i in range(0, len(content), 8))
+import os
+import sys
+
+import sourcemap
+from augmenters import AUGMENTER, AugmentationError, Augmenter, load_augmenter
+from bitbuffer import BitBuffer
+from cache import CACHE, CachedAugmenter
+from layout import layout, read_lines
+
+LISTING_BITS = 64
+
+
+def augment_lines_from_file(
+    r: int, m: int, filename: str, augmenter: Augmenter, optimized: bool = True
+):
+    lines = read_lines(filename)
+    passes = layout(r, m, lines, augmenter, optimized)
+
+    content = BitBuffer()
+    for line in lines:
+        # bit offset in the program, size in bits, the first LISTING_BITS bits of the code
+        preview = line.bits.to_bin() if len(line.bits) <= LISTING_BITS else (
+            BitBuffer.of(line.bits.read(0, LISTING_BITS), LISTING_BITS).to_bin() + "..."
+        )
+        print(f"{line.offset:>6x} {len(line.bits):>5} {line.text} : 0xb{preview}")
+        content.extend(line.bits)
+    print(f"Layout: {passes} pass{'es' if passes > 1 else ''}, {len(content)} bits")
+    if optimized:
+        print(f"Optimizer: {sum(line.saved for line in lines)} bits saved")
+
+    # the last byte is filled with zeros
+    binary_bytes = content.to_bytes()
 
     # Write to the binary file
     with open(filename + ".bin", "wb") as binary_file:
         binary_file.write(binary_bytes)
+    # where the bits came from, for the vm profiles and traces
+    sourcemap.write(filename + ".bin.map", os.path.basename(filename), lines)
 
     print("Augmentation complete.")
 
     l = len(binary_bytes)
     print(f"Size: {l} byte{'s' if l > 10 and l % 10 != 1 else ''}")
+    if isinstance(augmenter, CachedAugmenter):
+        print(f"Cache: {augmenter.hits} hits, {augmenter.misses} misses")
 
 
 if __name__ == "__main__":
@@ -71,7 +62,38 @@ if __name__ == "__main__":
         help="The address space (where mem is of 2^2^m bits) (int >= 1)",
         default=4,
     )
+    parser.add_argument(
+        "--augmenter",
+        type=str,
+        help="The augmenter executable, or a python augmenter module to run in-process "
+        "(`./augmenter.py` is preferred over `./augmenter` when it exists)",
+        default=AUGMENTER,
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        help=f"The build cache file (default: {CACHE} next to the input file)",
+        default=None,
+    )
+    parser.add_argument("--no-cache", action="store_true", help="Augment every line anew")
+    parser.add_argument(
+        "--no-optimize",
+        action="store_true",
+        help="Emit the augmented code as it is (no redundant writes or unreachable code removal)",
+    )
     parser.add_argument("filename", type=str, help="The path to the input file.")
 
     args = parser.parse_args()
-    augment_lines_from_file(args.r, args.m, args.filename)
+    augmenter = load_augmenter(args.augmenter)
+    if not args.no_cache:
+        cache = args.cache or os.path.join(os.path.dirname(args.filename), CACHE)
+        augmenter = CachedAugmenter(augmenter, cache)
+    try:
+        augment_lines_from_file(
+            args.r, args.m, args.filename, augmenter, not args.no_optimize
+        )
+    except AugmentationError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        augmenter.close()
@@ -0,0 +1,34 @@
+import re
+from typing import List
+
+from layout import Line
+
+# the sidecar of a binary (`{program}.map`), it tells which line every bit of the binary came from:
+# - header: `jaw-map 1 {source file}`
+# - a line per source line with code, sorted by the offset:
+#   `{bit offset in the binary hex} {size in bits hex} {lineno}\t{macro}\t{line}\t{augmenter output}`
+#   where the macro is the line with its arguments left out (e.g. `reg{}++ (reg{}, reg{})`)
+#   and the output is the emitted bits in the answer form (`0xb...` for code, `0x...` for data)
+# the lines without bits (labels, dropped code) are left out
+# (vm_impls/sourcemap.py reads it)
+
+MAGIC = "jaw-map 1"
+
+_ARGUMENTS = re.compile(r'"(?:[^"\\]|\\.)*"|\.[A-Za-z_]\w*|0x[0-9a-fA-F]+|\d+')
+
+
+def macro(text: str) -> str:
+    return _ARGUMENTS.sub("{}", text)
+
+
+def write(path: str, source: str, lines: List[Line]):
+    with open(path, "w") as f:
+        f.write(f"{MAGIC} {source}\n")
+        for line in lines:
+            if len(line.bits) == 0:
+                continue
+            output = f"0xb{line.bits.to_bin()}" if line.code else f"0x{line.bits.to_hex()}"
+            text = line.text.replace("\t", " ")
+            f.write(
+                f"{line.offset:x} {len(line.bits):x} {line.lineno}\t{macro(text)}\t{text}\t{output}\n"
+            )
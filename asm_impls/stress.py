@@ -0,0 +1,75 @@
+import argparse
+import os
+import random
+import sys
+import time
+from typing import List
+
+from augmenters import load_augmenter
+from layout import Line, layout
+
+# assembles one long `#dumb_stdout` line (tens of thousands of instructions in one piece)
+# with and without the optimizer and checks that the optimizer stays linear and cheap:
+# twice the text may take at most SCALING times as long, the optimizer at most OVERHEAD times
+# the plain assembly, and it still has to save bits (the best of a few runs is measured)
+
+AUGMENTER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "examples", "_shared", "augmenter.py")
+
+SCALING = 2.6
+OVERHEAD = 10
+
+
+def source(rng: random.Random, chars: int) -> List[Line]:
+    text = "".join(rng.choice("abcdefghijklmnop ") for _ in range(chars))
+    return [
+        Line(1, "reg0: 0x0 = const 0x0"),
+        Line(2, "reg1: 0x0 = const 0x1"),
+        Line(3, "reg2: 0x0 = const 0x2"),
+        Line(4, f'#dumb_stdout "{text}"'),
+    ]
+
+
+def measure(augmenter, r: int, m: int, text: List[Line], optimized: bool, runs: int):
+    best = float("inf")
+    for _ in range(runs):
+        lines = [Line(e.lineno, e.text) for e in text]
+        started = time.perf_counter()
+        layout(r, m, lines, augmenter, optimized)
+        best = min(best, time.perf_counter() - started)
+    return best, sum(len(e.bits) for e in lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that the optimizer stays linear and cheap on a large program"
+    )
+    parser.add_argument("--chars", type=int, default=10000, help="text of the smaller program")
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--augmenter", default=AUGMENTER)
+    args = parser.parse_args()
+
+    r, m = 3, 5
+    augmenter = load_augmenter(args.augmenter)
+    rng = random.Random(args.seed)
+    small, large = source(rng, args.chars), source(rng, 2 * args.chars)
+
+    plain, plain_bits = measure(augmenter, r, m, small, False, args.runs)
+    once, bits = measure(augmenter, r, m, small, True, args.runs)
+    twice, _ = measure(augmenter, r, m, large, True, args.runs)
+    print(
+        f"{args.chars} chars: {plain:.2f}s plain ({plain_bits} bits), "
+        f"{once:.2f}s optimized ({bits} bits), {twice:.2f}s optimized twice the text"
+    )
+
+    failed = False
+    if twice > SCALING * once:
+        print(f"Error: twice the text took {twice / once:.1f} times as long", file=sys.stderr)
+        failed = True
+    if once > OVERHEAD * plain:
+        print(f"Error: the optimizer took {once / plain:.1f} times the plain assembly", file=sys.stderr)
+        failed = True
+    if bits >= plain_bits:
+        print(f"Error: the optimizer saved nothing ({bits} of {plain_bits} bits)", file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
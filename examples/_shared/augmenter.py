@@ -1,88 +1,84 @@
 from dataclasses import dataclass
+import functools
+import os
 import re
 import sys
-from typing import Any, Callable, List, Tuple
+from typing import Any, Callable, Dict, FrozenSet, List, Tuple
+
+# the bit buffer type is shared with the assembler, which appends the returned bits as they are
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "asm_impls"))
+from bitbuffer import BitBuffer  # noqa: E402
 
 
 @dataclass
 class Return:
-    content: str
+    content: BitBuffer
     new_labels_offsets: List[int]
 
+    def __init__(self, content: BitBuffer | None = None, new_labels_offsets: List[int] | None = None):
+        self.content = content if content is not None else BitBuffer()
+        self.new_labels_offsets = (
+            new_labels_offsets if new_labels_offsets is not None else []
+        )
+
     @property
     def hex(self) -> str:
-        raise NotImplementedError()
+        return self.content.to_hex()
 
     @property
     def bin(self) -> str:
-        raise NotImplementedError()
+        return self.content.to_bin()
 
     @property
     def get(self) -> str:
         raise NotImplementedError()
 
 
-@dataclass
 class HexReturn(Return):
-    def __init__(self, content: str, new_labels_offsets: List[int] | None = None):
-        # assert content is of hex symbols
-        self.content = content
-        self.new_labels_offsets = (
-            new_labels_offsets if new_labels_offsets is not None else []
-        )
+    # data, reported as hex (the content must be a whole number of hex digits)
+    code = False
 
     @property
-    def bin(self):
-        return bin(int(self.content, 16))[2:]
+    def get(self):
+        return "0x" + self.hex
 
-    @property
-    def hex(self):
-        return self.content
+
+class BinReturn(Return):
+    # code, reported as binary
+    code = True
 
     @property
     def get(self):
-        return "0x" + self.content
+        return "0xb" + self.bin
 
 
-@dataclass
-class BinReturn(Return):
-    def __init__(self, content: str, new_labels_offsets: List[int] | None = None):
-        # assert content is of binary symbols
-        self.content = content
-        self.new_labels_offsets = (
-            new_labels_offsets if new_labels_offsets is not None else []
-        )
+CODE_BEGINNING = 3  # env `a` places the program right after the special memory addresses
 
-    @property
-    def bin(self):
-        return self.content
 
-    @property
-    def hex(self):
-        return hex(int(self.content, 2))[2:]
+@dataclass
+class Context:
+    # what a command knows about the machine it generates code for and where its code goes
+    r: int
+    m: int
+    offset: int = CODE_BEGINNING  # absolute bit address of the line's code
 
-    @property
-    def get(self):
-        return "0xb" + self.content
+    def __post_init__(self):
+        self.registers_count = 2**self.r
+        self.sizeofreg = 2**self.m
+        self.sizeofmem = 2**self.sizeofreg
 
 
 @dataclass
 class Command:
     regex: re.Pattern[Any]
-    func: Callable[..., Return]
-    eval: Callable[[Tuple[str], List[int]], str]
-    info: Callable[[Tuple[str]], str]
-    range: Callable[..., "Range"]
+    func: Callable[..., Return]  # (ctx, *args)
+    eval: Callable[[Context, Tuple[str], List[int]], Return]
+    info: Callable[[Context, Tuple[str]], str]
+    range: Callable[..., "Range"]  # (ctx, *args)
+    words: FrozenSet[str]  # tokens every line it matches contains
 
 
 commands: List[Command] = []
-offset: int
-r: int
-m: int
-
-registers_count: int
-sizeofreg: int
-sizeofmem: int
 
 parambr = re.compile(r"\{:(\S+?):\}")
 
@@ -121,6 +117,8 @@ class ParamResolver:
         [str, List[int]], NotPass | None | Any
     ]  # (matched arg, labels) => NotPass - do not pass to the func | None - unresolved | res - resolved value to pass
     label: Callable[[str], Label | None]  # (matched arg) => label | None
+    capture: str  # regex of the values
+    token: str | None  # the token every value starts with (None if there is no such)
 
 
 @dataclass
@@ -130,6 +128,8 @@ class ParamT:
         [str, str, List[int]], Any
     ]  # (matched_selector, matched arg, labels) => res | None
     label: Callable[[str, str], Label | None]  # (matched_selector, matched arg)
+    capture: Callable[[str], str]  # (matched_selector) => regex of the values
+    token: Callable[[str], str | None]  # (matched_selector) => the token every value starts with
 
     def gen_resolver(self, s: str):
         matched_selector = self.selector.fullmatch(s)
@@ -138,6 +138,8 @@ class ParamT:
         return ParamResolver(
             resolve=lambda arg, lbs: self.resolve(s, arg, lbs),
             label=lambda arg: self.label(s, arg),
+            capture=self.capture(s),
+            token=self.token(s),
         )
 
 
@@ -149,6 +151,8 @@ param_resolvers.append(
         selector=re.compile(r"N"),
         resolve=lambda sm, arg, lbls: int(arg, base=0),
         label=lambda sm, arg: None,
+        capture=lambda sm: r"[-+]?\w+",
+        token=lambda sm: None,
     )
 )
 
@@ -158,6 +162,8 @@ param_resolvers.append(
         selector=re.compile(r"S"),
         resolve=lambda sm, arg, lbls: arg,
         label=lambda sm, arg: None,
+        capture=lambda sm: r".*",
+        token=lambda sm: None,
     )
 )
 
@@ -178,6 +184,8 @@ param_resolvers.append(
         label=lambda sm, arg: Label.use(_extract_use_label(arg))
         if arg.startswith(".")
         else None,
+        capture=lambda sm: r"\.\S*",
+        token=lambda sm: ".",
     )
 )
 
@@ -196,6 +204,8 @@ param_resolvers.append(
         label=lambda sm, arg: Label.new(_extract_define_label(arg))
         if arg.startswith("@.")
         else None,
+        capture=lambda sm: r"@\.\S*",
+        token=lambda sm: "@.",
     )
 )
 
@@ -205,6 +215,8 @@ param_resolvers.append(
         selector=re.compile(r"\`\S*\`"),
         resolve=lambda sm, arg, lbls: arg if arg == sm[1:-1] else None,
         label=lambda sm, arg: None,
+        capture=lambda sm: re.escape(sm[1:-1]),
+        token=lambda sm: next(iter(_token.findall(sm[1:-1])), None),
     )
 )
 
@@ -217,22 +229,104 @@ def get_param_resolver(s: str):
     raise AssertionError(f"Failed to find parameter resolver for {s}")
 
 
+@functools.cache
 def get_mixed_params_resolver(s: str):
+    # built once per distinct parameter, the commands share them
     mix = s.split("|")
     assert len(mix) != 0, f"Empty mixed param: {mix}"
-    return [get_param_resolver(e) for e in mix]
+    return tuple(get_param_resolver(e) for e in mix)
+
+
+# the dispatch index: a line is split into tokens, every command is indexed by the rarest of the
+# tokens that all of its lines contain (`mem`, `pp`, `const`, `#store_ascii`, `@.`, ...),
+# so only the commands indexed by the tokens of the line (and the ones with no such tokens)
+# are candidates, they are tried at once by a regex of alternatives in the declaration order
+_token = re.compile(r"#?[A-Za-z_][A-Za-z_0-9]*|@\.|[^\s\w]")
+
+
+def _wordy(ch: str) -> bool:
+    return ch.isalnum() or ch in "_#"
+
+
+def _command_words(pattern: str) -> FrozenSet[str]:
+    parts = parambr.split(pattern)
+    words = set()
+    for j, part in enumerate(parts):
+        if j % 2 == 1:
+            tokens = {e.token for e in get_mixed_params_resolver(part)}
+            if len(tokens) == 1 and None not in tokens:
+                words |= tokens
+            continue
+        for t in _token.finditer(part):
+            # a word touching a parameter could be glued to its value (`reg{:N:}` is `reg1`)
+            w = t.group()
+            if t.start() == 0 and j > 0 and _wordy(w[0]):
+                continue
+            if t.end() == len(part) and j < len(parts) - 1 and _wordy(w[-1]):
+                continue
+            words.add(w)
+    return frozenset(words)
+
+
+class _Index:
+    def __init__(self) -> None:
+        count: Dict[str, int] = {}
+        for cmd in commands:
+            for w in cmd.words:
+                count[w] = count.get(w, 0) + 1
+        self.by_word: Dict[str, List[int]] = {}
+        self.anywhere: List[int] = []  # commands without words, candidates for every line
+        for j, cmd in enumerate(commands):
+            if cmd.words:
+                key = min(cmd.words, key=lambda w: (count[w], w))
+                self.by_word.setdefault(key, []).append(j)
+            else:
+                self.anywhere.append(j)
+        # candidates => (regex, {group of an alternative: (command, number of its parameters)})
+        self.regexes: Dict[Tuple[int, ...], Tuple[re.Pattern[Any], Dict[int, Tuple[Command, int]]]] = {}
+
+    def candidates(self, msg: str) -> Tuple[int, ...]:
+        tokens = set(_token.findall(msg))
+        res = list(self.anywhere)
+        for t in tokens:
+            for j in self.by_word.get(t, ()):
+                if commands[j].words <= tokens:
+                    res.append(j)
+        return tuple(sorted(res))
+
+    def regex(self, candidates: Tuple[int, ...]):
+        compiled = self.regexes.get(candidates)
+        if compiled is None:
+            alternatives: List[str] = []
+            groups: Dict[int, Tuple[Command, int]] = {}
+            group = 1
+            for j in candidates:
+                cmd = commands[j]
+                alternatives.append(f"({cmd.regex.pattern[1:-1]})")
+                groups[group] = (cmd, cmd.regex.groups)
+                group += 1 + cmd.regex.groups
+            regex = re.compile(f"^(?:{'|'.join(alternatives)})$" if alternatives else "(?!)")
+            compiled = self.regexes[candidates] = (regex, groups)
+        return compiled
+
+
+_index: _Index | None = None
 
 
 def add_to_commands(
     pattern: str, range: Callable[..., Range]
 ) -> Callable[..., Command]:
     def decorate(func: Callable[..., Return]) -> Command:
-        escaped_pattern = re.escape(pattern).replace(r"\{:", "{:").replace(r":\}", ":}")
-        regex_pattern = parambr.sub(r"(.*)", escaped_pattern)
+        # literals and parameters alternate, every parameter captures only what its kinds accept
+        parts = parambr.split(pattern)
+        params = [get_mixed_params_resolver(p) for p in parts[1::2]]
+        regex_pattern = "".join(
+            re.escape(part) if j % 2 == 0 else f"({'|'.join(e.capture for e in params[j // 2])})"
+            for j, part in enumerate(parts)
+        )
         regex = re.compile(rf"^{regex_pattern}$")
-        params = [get_mixed_params_resolver(p) for p in parambr.findall(pattern)]
 
-        def eval(args: Tuple[str], labels: List[int]) -> str:
+        def eval(ctx: Context, args: Tuple[str], labels: List[int]) -> Return:
             cargs: List[Any] = []
             for param, arg in zip(params, args):
                 for resolvep in param:
@@ -244,8 +338,7 @@ def add_to_commands(
                         break
                 else:
                     raise ValueError(f"invalid value : {arg}")
-            res = func(*cargs)
-            return f"{res.get} {' '.join(f'{e:x}' for e in res.new_labels_offsets)}"
+            return func(ctx, *cargs)
 
         def labels_wrapper(args: Tuple[str]):
             new_labels: List[str] = []
@@ -258,7 +351,7 @@ def add_to_commands(
                         break  # one label per parameter
             return new_labels, use_labels
 
-        def range_wrapper(args: Tuple[str]):
+        def range_wrapper(ctx: Context, args: Tuple[str]):
             cargs: List[Any] = []
             for param, arg in zip(params, args):
                 for resolvep in param:
@@ -274,11 +367,11 @@ def add_to_commands(
                         break
                 else:
                     raise ValueError(f"invalid value : {arg}")
-            return range(*cargs)
+            return range(ctx, *cargs)
 
-        def info(args: Tuple[str]):
+        def info(ctx: Context, args: Tuple[str]):
             created_labels_names, used_labels_names = labels_wrapper(args)
-            rng = range_wrapper(args)
+            rng = range_wrapper(ctx, args)
             return f"{rng.min:x}-{rng.max:x} {' '.join(created_labels_names)} | {' '.join(used_labels_names)}"
 
         cmd = Command(
@@ -287,8 +380,11 @@ def add_to_commands(
             eval=eval,
             info=info,
             range=range,
+            words=_command_words(pattern),
         )
         commands.append(cmd)
+        global _index
+        _index = None
         return cmd
 
     return decorate
@@ -299,174 +395,467 @@ def mb(n: int, size: int):
     return f"{n:0{size}b}"
 
 
+def bits(*fields: Tuple[int, int]):
+    # (value, width) fields one after another, values are taken modulo 2^width
+    res = BitBuffer()
+    for value, width in fields:
+        res.append(value, width)
+    return res
+
+
 # # Basic instructions
 @add_to_commands(
     "mem[reg{:N:}] = {:N:}",
-    range=lambda *_: Range.only(3 + r),
+    range=lambda ctx, *_: Range.only(3 + ctx.r),
 )
-def set_mem_bit(n: int, b: int):
+def set_mem_bit(ctx: Context, n: int, b: int):
     # 00{n:[r bits]}{<0/1>:[1 bit]}
-    return BinReturn(f"00{mb(n, r)}{mb(b, 1)}")
+    return BinReturn(bits((0b00, 2), (n, ctx.r), (b, 1)))
 
 
 @add_to_commands(
     "mem[reg{:N:}] ? pp += reg{:N:} {:L:}",
-    range=lambda *args, _: cnd_jmp_mem.range(*args),
+    range=lambda ctx, *args: cnd_jmp_mem.range(ctx, *args),
 )
-def cnd_jmp_mem_with_label(n: int, k: int):
-    res = cnd_jmp_mem.func(n, k)
-    res.new_labels_offsets.append(offset + len(res.bin) - 1)
+def cnd_jmp_mem_with_label(ctx: Context, n: int, k: int):
+    res = cnd_jmp_mem.func(ctx, n, k)
+    res.new_labels_offsets.append(ctx.offset + len(res.content) - 1)
     return res
 
 
 @add_to_commands(
     "mem[reg{:N:}] ? pp += reg{:N:}",
-    range=lambda *_: Range.only(2 + r * 2),
+    range=lambda ctx, *_: Range.only(2 + ctx.r * 2),
 )
-def cnd_jmp_mem(n: int, k: int):
+def cnd_jmp_mem(ctx: Context, n: int, k: int):
     # 01{n:[r bits]}{k:[r bits]}
-    return BinReturn(f"01{mb(n, r)}{mb(k, r)}")
+    return BinReturn(bits((0b01, 2), (n, ctx.r), (k, ctx.r)))
 
 
 @add_to_commands(
-    "reg[{:N:}][{:N:}] = {:N:}",
-    range=lambda *_: Range.only(3 + r + m),
+    "reg{:N:}[{:N:}] = {:N:}",
+    range=lambda ctx, *_: Range.only(3 + ctx.r + ctx.m),
 )
-def set_reg_bit(n: int, i: int, b: int):
+def set_reg_bit(ctx: Context, n: int, i: int, b: int):
     # 10{n:[r bits]}{i:[m bits]}{<0/1>:[1 bit]}
-    return BinReturn(f"10{mb(n, r)}{mb(i, m)}{mb(b, 1)}")
+    return BinReturn(bits((0b10, 2), (n, ctx.r), (i, ctx.m), (b, 1)))
+
+
+@add_to_commands(
+    "reg[{:N:}][{:N:}] = {:N:}",
+    range=lambda ctx, *_: set_reg_bit.range(ctx),
+)
+def set_reg_bit_old(ctx: Context, n: int, i: int, b: int):
+    # the form before `regN[i] = b`
+    return set_reg_bit.func(ctx, n, i, b)
 
 
 @add_to_commands(
     "reg{:N:}[{:N:}] ? pp += reg{:N:} {:L:}",
-    range=lambda *args, _: cnd_jmp_reg.range(*args),
+    range=lambda ctx, *args: cnd_jmp_reg.range(ctx, *args),
 )
-def cnd_jmp_reg_with_label(n: int, i: int, k: int):
-    res = cnd_jmp_reg.func(n, i, k)
-    res.new_labels_offsets.append(offset + len(res.bin) - 1)
+def cnd_jmp_reg_with_label(ctx: Context, n: int, i: int, k: int):
+    res = cnd_jmp_reg.func(ctx, n, i, k)
+    res.new_labels_offsets.append(ctx.offset + len(res.content) - 1)
     return res
 
 
 @add_to_commands(
     "reg{:N:}[{:N:}] ? pp += reg{:N:}",
-    range=lambda *_: Range.only(2 + 2 * r + m),
+    range=lambda ctx, *_: Range.only(2 + 2 * ctx.r + ctx.m),
 )
-def cnd_jmp_reg(n: int, i: int, k: int):
+def cnd_jmp_reg(ctx: Context, n: int, i: int, k: int):
     # 11{n:[r bits]}{i:[m bits]}{k:[r bits]}
-    return BinReturn(f"11{mb(n, r)}{mb(i, m)}{mb(k, r)}")
+    return BinReturn(bits((0b11, 2), (n, ctx.r), (i, ctx.m), (k, ctx.r)))
+
+
+# # Complex instructions
+def _resolve_set_full_reg_with_const_diff_range(
+    ctx: Context, n: int, init: str | int | None, a: int | None, b: int | None
+):
+    return _resolve_set_full_reg_with_const_range(
+        ctx, n, init, None if (a is None or b is None) else (a - b) % ctx.sizeofmem
+    )
+
+
+@add_to_commands(
+    "reg{:N:}: {:`any`|X|N:} = const {:X|N:} - {:X|N:}",
+    range=_resolve_set_full_reg_with_const_diff_range,
+)
+def set_full_reg_with_const_diff(ctx: Context, n: int, init: str | int, a: int, b: int):
+    return set_full_reg_with_const.func(ctx, n, init, (a - b) % ctx.sizeofmem)
 
 
 def _resolve_set_full_reg_with_const_range(
-    n: int, init: str | int | None, const: int | None
+    ctx: Context, n: int, init: str | int | None, const: int | None
 ):
     if init == "any":
         # the guaranteed size of _set_full_reg_from_any
-        return Range.only(sizeofreg * set_reg_bit.range(n, 0, 0).max)
+        return Range.only(ctx.sizeofreg * set_reg_bit.range(ctx, n, 0, 0).max)
 
     if isinstance(init, int) and isinstance(const, int):
-        return Range.only(len(_set_full_reg_from_known(n, init, const)))
+        return Range.only(len(_set_full_reg_from_known(ctx, n, init, const)))
 
-    return Range(0, sizeofreg * set_reg_bit.range(n, 0, 0).max)
+    return Range(0, ctx.sizeofreg * set_reg_bit.range(ctx, n, 0, 0).max)
 
 
-# # Complex instructions
 @add_to_commands(
     "reg{:N:}: {:`any`|X|N:} = const {:X|N:}",
     range=_resolve_set_full_reg_with_const_range,
 )
-def set_full_reg_with_const(n: int, init: str | int, const: int):
+def set_full_reg_with_const(ctx: Context, n: int, init: str | int, const: int):
     if init == "any":
-        return BinReturn(_set_full_reg_from_any(n, const))
+        return BinReturn(_set_full_reg_from_any(ctx, n, const))
 
     assert isinstance(init, int)
-    return BinReturn(_set_full_reg_from_known(n, init, const))
+    return BinReturn(_set_full_reg_from_known(ctx, n, init, const))
 
 
-def _set_full_reg_from_known(n: int, init: int, const: int):
-    res = ""
+def _set_full_reg_from_known(ctx: Context, n: int, init: int, const: int):
+    res = BitBuffer()
     for i, wasbit, needbit in zip(
-        range(sizeofreg), mb(init, sizeofreg), mb(const, sizeofreg)
+        range(ctx.sizeofreg), mb(init, ctx.sizeofreg), mb(const, ctx.sizeofreg)
     ):
         if wasbit != needbit:
-            res += set_reg_bit.func(n, i, int(needbit)).bin
+            res.extend(set_reg_bit.func(ctx, n, i, int(needbit)).content)
     return res
 
 
-def _set_full_reg_from_any(n: int, const: int):
-    return "".join(
-        set_reg_bit.func(n, i, int(bit)).bin
-        for i, bit in enumerate(mb(const, sizeofreg))
-    )
+def _set_full_reg_from_any(ctx: Context, n: int, const: int):
+    res = BitBuffer()
+    for i, bit in enumerate(mb(const, ctx.sizeofreg)):
+        res.extend(set_reg_bit.func(ctx, n, i, int(bit)).content)
+    return res
 
 
-def _resolve_set_full_reg_with_const_diff_range(
-    n: int, init: str | int | None, a: int | None, b: int | None
-):
-    return _resolve_set_full_reg_with_const_range(
-        n, init, None if (a is None or b is None) else (a - b) % sizeofmem
-    )
+# # Macros
+# a macro jumps inside of itself by the offsets it loads into its scratch registers first
+# (the assembler drops the loads when the registers hold the offsets already),
+# the offsets only depend on the kind of the macro, so the macros given scratch registers
+# of their own leave them loaded for the next call, and `#load` loads them in front of a loop
+# (the loop starts with them known and the loads inside of it are dropped),
+# an exit from the middle of a macro jumps to its end by the `exit` register,
+# the offsets of the exits differ: the way on to the next exit flips the bits of `exit` that differ
+# and every exit lands on a sled flipping them back, so `exit` holds the same offset
+# after the macro whichever way it went:
+#   {loads} {block 0} {flips 0>1} {block 1} ... {block n-1} [{flips n-1>0} {jump}] {sled n-1>n-2} ... {sled 1>0}
+# (with a jump out at the end, the way through all the blocks takes it, otherwise it goes down the sled)
+
+# (the code before the exit, the (register, bit) the exit is taken on or None for always, the code after)
+Block = Tuple[BitBuffer, Tuple[int, int] | None, BitBuffer]
+
+
+def _distinct(*regs: int):
+    if len(set(regs)) != len(regs):
+        raise ValueError(f"the registers must differ: {', '.join(f'reg{e}' for e in regs)}")
+
+
+def _load(ctx: Context, n: int, const: int):
+    return _set_full_reg_from_any(ctx, n, const)
+
+
+# (register, offset) loads of the scratch registers of a macro
+Loads = List[Tuple[int, int]]
+
+
+def _loaded(ctx: Context, loads: Loads, code: BitBuffer):
+    res = BitBuffer()
+    for n, const in loads:
+        res.extend(_load(ctx, n, const))
+    res.extend(code)
+    return res
+
+
+def _other(ctx: Context, *regs: int) -> int:
+    # a register that is none of `regs`, the offsets don't depend on the other registers
+    return next(e for e in range(ctx.registers_count) if e not in regs)
+
+
+def _defaults(ctx: Context, count: int) -> List[int]:
+    # the scratch registers of the forms without them: the last ones
+    return list(range(ctx.registers_count - count, ctx.registers_count))
+
+
+def _flips(ctx: Context, n: int, was: int, becomes: int, count: int):
+    # the bit sets from `was` to `becomes` padded to `count` with the sets of the bits that are equal
+    res = BitBuffer()
+    same = []
+    for i, wasbit, bit in zip(range(ctx.sizeofreg), mb(was, ctx.sizeofreg), mb(becomes, ctx.sizeofreg)):
+        if wasbit != bit:
+            res.extend(set_reg_bit.func(ctx, n, i, int(bit)).content)
+        else:
+            same.append((i, int(bit)))
+    for i, bit in same[: count - len(res) // set_reg_bit.range(ctx).max]:
+        res.extend(set_reg_bit.func(ctx, n, i, bit).content)
+    return res
+
+
+def _one_bit(ctx: Context, value: int) -> int:
+    # a bit that is set in `value`
+    value %= 2**ctx.sizeofreg
+    if value == 0:
+        raise ValueError("the macro does not fit the register size")
+    return ctx.sizeofreg - value.bit_length()
+
+
+def _exits(ctx: Context, e: int, blocks: List[Block], jump: int | None = None):
+    # lays out the blocks with the exits by the register `e` and the sled (see above),
+    # `jump` is the register to jump by at the end of the last block
+    # -> (code, the offset `e` holds, the bit offset of the jump origin in the code or None)
+    width = ctx.sizeofreg
+    set_size = set_reg_bit.range(ctx).max
+    jmp_size = cnd_jmp_reg.range(ctx).max
+
+    # the numbers of bit sets after every block (to the offset of the next one,
+    # or back to the first before `jump`) only grow, so the offsets settle
+    counts = [0] * len(blocks)
+    while True:
+        origins = []
+        at = 0
+        for (head, _, tail), count in zip(blocks, counts):
+            at += len(head) + jmp_size
+            origins.append(at - 1)
+            at += len(tail) + count * set_size
+        if jump is not None:
+            at += jmp_size
+        landings = [0] * len(blocks)
+        for i in range(len(blocks) - 1, 0, -1):
+            landings[i] = at
+            at += counts[i - 1] * set_size
+        landings[0] = at
+        offsets = [(land - origin) % 2**width for land, origin in zip(landings, origins)]
+        needed = [bin(a ^ b).count("1") for a, b in zip(offsets, offsets[1:])]
+        needed.append(0 if jump is None else bin(offsets[-1] ^ offsets[0]).count("1"))
+        grown = [max(a, b) for a, b in zip(counts, needed)]
+        if grown == counts:
+            break
+        counts = grown
+
+    res = BitBuffer()
+    for i, ((head, cond, tail), count) in enumerate(zip(blocks, counts)):
+        res.extend(head)
+        n, bit = cond if cond is not None else (e, _one_bit(ctx, offsets[i]))
+        res.extend(cnd_jmp_reg.func(ctx, n, bit, e).content)
+        res.extend(tail)
+        if i + 1 < len(blocks) or jump is not None:
+            res.extend(_flips(ctx, e, offsets[i], offsets[(i + 1) % len(blocks)], count))
+    origin = None
+    if jump is not None:
+        res.extend(cnd_jmp_reg.func(ctx, e, _one_bit(ctx, offsets[0]), jump).content)
+        origin = len(res) - 1
+    for i in range(len(blocks) - 1, 0, -1):
+        res.extend(_flips(ctx, e, offsets[i], offsets[i - 1], counts[i - 1]))
+    return res, offsets[0], origin
+
+
+def _increment(ctx: Context, n: int, k: int, e: int):
+    # from the lowest bit: a 1 becomes 0 and the carry goes on, a 0 becomes 1 and it exits
+    #   regN[i] ? pp += regK  // to the carry
+    #   regN[i] = 1
+    #   regN[i] ? pp += regE  // exit
+    #   regN[i] = 0           // the carry
+    set_size = set_reg_bit.range(ctx).max
+    skip = 1 + set_size + cnd_jmp_reg.range(ctx).max
+    blocks: List[Block] = []
+    for i in reversed(range(ctx.sizeofreg)):
+        head = cnd_jmp_reg.func(ctx, n, i, k).content
+        head.extend(set_reg_bit.func(ctx, n, i, 1).content)
+        blocks.append((head, (n, i), set_reg_bit.func(ctx, n, i, 0).content))
+    code, offset, _ = _exits(ctx, e, blocks)
+    loads: Loads = [(k, skip), (e, offset)]
+    return loads, code
 
 
 @add_to_commands(
-    "reg{:N:}: {:`any`|X|N:} = const {:X|N:} - {:X|N:}",
-    range=_resolve_set_full_reg_with_const_diff_range,
+    "reg{:N:}++ (reg{:N:}, reg{:N:})",
+    range=lambda ctx, *_: Range.only(len(_loaded(ctx, *_increment(ctx, 0, 1, 2)))),
+)
+def increment(ctx: Context, n: int, k: int, e: int):
+    # wraps around, overwrites the scratch registers regK and regE
+    _distinct(n, k, e)
+    return BinReturn(_loaded(ctx, *_increment(ctx, n, k, e)))
+
+
+@add_to_commands(
+    "reg{:N:}++",
+    range=lambda ctx, *_: increment.range(ctx),
+)
+def increment_default(ctx: Context, n: int):
+    return increment.func(ctx, n, *_defaults(ctx, 2))
+
+
+@add_to_commands(
+    "#load ++ (reg{:N:}, reg{:N:})",
+    range=lambda ctx, *_: Range.only(2 * len(_load(ctx, 0, 0))),
+)
+def load_increment(ctx: Context, k: int, e: int):
+    _distinct(k, e)
+    loads, _ = _increment(ctx, _other(ctx, k, e), k, e)
+    return BinReturn(_loaded(ctx, loads, BitBuffer()))
+
+
+def _read_mem_bit(ctx: Context, n: int, i: int, a: int, k: int):
+    #   regN[i] = 1
+    #   mem[regA] ? pp += regK  // over the next one
+    #   regN[i] = 0
+    code = set_reg_bit.func(ctx, n, i, 1).content
+    code.extend(cnd_jmp_mem.func(ctx, a, k).content)
+    code.extend(set_reg_bit.func(ctx, n, i, 0).content)
+    loads: Loads = [(k, 1 + set_reg_bit.range(ctx).max)]
+    return loads, code
+
+
+@add_to_commands(
+    "reg{:N:}[{:N:}] = mem[reg{:N:}] (reg{:N:})",
+    range=lambda ctx, *_: Range.only(len(_loaded(ctx, *_read_mem_bit(ctx, 0, 0, 1, 2)))),
+)
+def read_mem_bit(ctx: Context, n: int, i: int, a: int, k: int):
+    # overwrites the scratch register regK, regN can't be the address (its bit is set first)
+    _distinct(n, a, k)
+    return BinReturn(_loaded(ctx, *_read_mem_bit(ctx, n, i, a, k)))
+
+
+@add_to_commands(
+    "reg{:N:}[{:N:}] = mem[reg{:N:}]",
+    range=lambda ctx, *_: read_mem_bit.range(ctx),
+)
+def read_mem_bit_default(ctx: Context, n: int, i: int, a: int):
+    return read_mem_bit.func(ctx, n, i, a, *_defaults(ctx, 1))
+
+
+@add_to_commands(
+    "#load = mem (reg{:N:})",
+    range=lambda ctx, *_: Range.only(len(_load(ctx, 0, 0))),
+)
+def load_read_mem_bit(ctx: Context, k: int):
+    n = _other(ctx, k)
+    loads, _ = _read_mem_bit(ctx, n, 0, _other(ctx, n, k), k)
+    return BinReturn(_loaded(ctx, loads, BitBuffer()))
+
+
+def _write_mem_bit(ctx: Context, a: int, n: int, i: int, k: int):
+    #   mem[regA] = 1
+    #   regN[i] ? pp += regK  // over the next one
+    #   mem[regA] = 0
+    code = set_mem_bit.func(ctx, a, 1).content
+    code.extend(cnd_jmp_reg.func(ctx, n, i, k).content)
+    code.extend(set_mem_bit.func(ctx, a, 0).content)
+    loads: Loads = [(k, 1 + set_mem_bit.range(ctx).max)]
+    return loads, code
+
+
+@add_to_commands(
+    "mem[reg{:N:}] = reg{:N:}[{:N:}] (reg{:N:})",
+    range=lambda ctx, *_: Range.only(len(_loaded(ctx, *_write_mem_bit(ctx, 0, 1, 0, 2)))),
 )
-def set_full_reg_with_const_diff(n: int, init: str | int, a: int, b: int):
-    return set_full_reg_with_const.func(n, init, (a - b) % sizeofmem)
+def write_mem_bit(ctx: Context, a: int, n: int, i: int, k: int):
+    # overwrites the scratch register regK
+    _distinct(a, k)
+    _distinct(n, k)
+    return BinReturn(_loaded(ctx, *_write_mem_bit(ctx, a, n, i, k)))
+
+
+@add_to_commands(
+    "mem[reg{:N:}] = reg{:N:}[{:N:}]",
+    range=lambda ctx, *_: write_mem_bit.range(ctx),
+)
+def write_mem_bit_default(ctx: Context, a: int, n: int, i: int):
+    return write_mem_bit.func(ctx, a, n, i, *_defaults(ctx, 1))
+
 
-# todo: mb try to pass the expected generation size
 @add_to_commands(
-    "reg{:N:} == {:X|N:} ? pp += reg{:N:} (1 = reg{:N:}[{:N:}], next = reg{:N:}: {:L:}, end = reg{:N:}: {:L:} > {:L:}) {:L:}",
-    range=,
+    "#load mem = (reg{:N:})",
+    range=lambda ctx, *_: Range.only(len(_load(ctx, 0, 0))),
 )
-def cndjmp_reg_eq_const(n: int, val: int, k: int, s1_n: int, s1_i: int, next_n: int, end_n: int):
-    jmp_end = cnd_jmp_reg.func(s1_n, s1_i, end_n).bin
+def load_write_mem_bit(ctx: Context, k: int):
+    a = _other(ctx, k)
+    loads, _ = _write_mem_bit(ctx, a, a, 0, k)
+    return BinReturn(_loaded(ctx, loads, BitBuffer()))
+
+
+def _reg_eq_const(ctx: Context, n: int, val: int, k: int, a: int, e: int):
+    # from the lowest bit, every bit that differs from `val` exits:
+    #   regA[0] ? pp += regA  // a 0 in `val`: never taken (the offset is small),
+    #   regN[i] ? pp += regE  // the blocks are the same for any `val`
+    # or
+    #   regN[i] ? pp += regA  // a 1 in `val`: over the exit
+    #   regE[_] ? pp += regE  // exit
+    # and the last block jumps by regK
+    skip = 1 + cnd_jmp_reg.range(ctx).max
+    blocks: List[Block] = []
+    for i, bit in reversed(list(enumerate(mb(val, ctx.sizeofreg)))):
+        if bit == "1":
+            blocks.append((cnd_jmp_reg.func(ctx, n, i, a).content, None, BitBuffer()))
+        else:
+            blocks.append((cnd_jmp_reg.func(ctx, a, 0, a).content, (n, i), BitBuffer()))
+    code, offset, origin = _exits(ctx, e, blocks, k)
+    assert origin is not None
+    loads: Loads = [(a, skip), (e, offset)]
+    return loads, code, origin
 
-    next_val = len(jmp_end)
-    end_val_init = 0
-    end_val_end = 0
 
-    res = ""
-    for i, bit in enumerate(mb(val, sizeofreg)):
-        match bit:
-            case "1":
-                res += cnd_jmp_reg.func(n, i, end_n).bin
-            case "0":
-                pass
-            case _:
-                raise AssertionError()
-    
-    return BinReturn(res, [next_val, end_val_init, end_val_end, offset + len(res) - 1])
+@add_to_commands(
+    "reg{:N:} == {:X|N:} ? pp += reg{:N:} {:L:} (reg{:N:}, reg{:N:})",
+    # the size doesn't depend on the constant
+    range=lambda ctx, *_: Range.only(len(_loaded(ctx, *_reg_eq_const(ctx, 0, 0, 1, 2, 3)[:2]))),
+)
+def cndjmp_reg_eq_const(ctx: Context, n: int, val: int, k: int, a: int, e: int):
+    # the label is the origin of the jump (like with `regN[i] ? pp += regK @.label`),
+    # overwrites the scratch registers regA and regE
+    _distinct(k, a, e)
+    _distinct(n, a, e)
+    loads, code, origin = _reg_eq_const(ctx, n, val, k, a, e)
+    res = _loaded(ctx, loads, code)
+    return BinReturn(res, [ctx.offset + len(res) - len(code) + origin])
 
 
-# TODO: regN[N] = mem[regN]
-# TODO: regN++
+@add_to_commands(
+    "reg{:N:} == {:X|N:} ? pp += reg{:N:} {:L:}",
+    range=lambda ctx, *_: cndjmp_reg_eq_const.range(ctx),
+)
+def cndjmp_reg_eq_const_default(ctx: Context, n: int, val: int, k: int):
+    return cndjmp_reg_eq_const.func(ctx, n, val, k, *_defaults(ctx, 2))
+
+
+@add_to_commands(
+    "#load == (reg{:N:}, reg{:N:})",
+    range=lambda ctx, *_: Range.only(2 * len(_load(ctx, 0, 0))),
+)
+def load_reg_eq_const(ctx: Context, a: int, e: int):
+    _distinct(a, e)
+    n = _other(ctx, a, e)
+    loads, _, _ = _reg_eq_const(ctx, n, 0, _other(ctx, n, a, e), a, e)
+    return BinReturn(_loaded(ctx, loads, BitBuffer()))
+
+
+def _unescape(s: str):
+    return s.encode().decode("unicode-escape")
 
 
 @add_to_commands(
     '#store_ascii "{:S:}"',
-    range=lambda s: Range.only(len(s)*8),
+    range=lambda ctx, s: Range.only(len(_unescape(s)) * 8),
 )
-def store_ascii(s: str):
-    s = s.encode().decode("unicode-escape")
-    res = ""
-    for ch in s:
-        res += f"{ord(ch):01x}"
-    return HexReturn(res)
+def store_ascii(ctx: Context, s: str):
+    # unicode-escape decodes to chars < 256, a byte per char
+    return HexReturn(BitBuffer(_unescape(s).encode("latin-1")))
 
 
 @add_to_commands(
     '#dumb_stdout "{:S:}"',
-    range=lambda s: Range.only(len(s)*8),
+    # a pair of mem writes per bit
+    range=lambda ctx, s: Range.only(len(_unescape(s)) * 8 * 2 * set_mem_bit.range(ctx).max),
 )
-def dumb_stdout(s: str):
+def dumb_stdout(ctx: Context, s: str):
     # assumes reg1 is set to 0x1, reg2 is set to 0x2
-    s = s.encode().decode("unicode-escape")
-    res = ""
+    s = _unescape(s)
+    data = [set_mem_bit.func(ctx, 1, b).content for b in (0, 1)]  # mem[reg1] = bit // set data
+    trigger = set_mem_bit.func(ctx, 2, 1).content  # mem[reg2] = 1 // trigger collect
+    res = BitBuffer()
     for ch in s:
         for bit in f"{ord(ch):08b}":
-            res += set_mem_bit.func(1, int(bit)).bin  # mem[reg1] = bit // set data
-            res += set_mem_bit.func(2, 1).bin  # mem[reg2] = 1 // trigger collect
+            res.extend(data[bit == "1"])
+            res.extend(trigger)
     return BinReturn(res)
 
 
@@ -475,42 +864,86 @@ def dumb_stdout(s: str):
     "{:L:}",
     range=lambda *_: Range.only(0),
 )
-def decl_label():
-    return BinReturn("", [offset])
+def decl_label(ctx: Context):
+    return BinReturn(BitBuffer(), [ctx.offset])
+
+
+def find_command(msg: str) -> Tuple[Command, Tuple[str]]:
+    global _index
+    if _index is None:
+        _index = _Index()
+    regex, starts = _index.regex(_index.candidates(msg))
+    match = regex.match(msg)
+    if match is None:
+        raise ValueError(msg)
+    cmd, n = starts[match.lastindex]  # the alternative is the last group to close
+    return cmd, match.groups()[match.lastindex : match.lastindex + n]  # type: ignore
+
+
+# the `?` and `>` queries, an assembler running in the same python process calls these directly
+# (and takes the returned bits of `>` as they are)
+
+
+def query(ctx: Context, msg: str) -> str:
+    cmd, args = find_command(msg)
+    return cmd.info(ctx, args)
+
+
+def augment(ctx: Context, msg: str, labels: List[int]) -> Return:
+    cmd, args = find_command(msg)
+    labels = list(labels)
+    res = cmd.eval(ctx, args, labels)
+    assert len(labels) == 0
+    return res
+
+
+def format_return(res: Return) -> str:
+    # the `>` answer: `{data} {*created_labels}`
+    return f"{res.get} {' '.join(f'{e:x}' for e in res.new_labels_offsets)}"
+
+
+# `{r} {m} serve`: answers many tab separated `?\t{line}` and `>\t{offset}\t{line}\t{*labels}`
+# requests from stdin, one answer line per request line (`!{error}` on failures),
+# the banner tells the assembler that this mode is supported
+SERVE_BANNER = "jaw-augmenter-serve 1"
+
+
+def serve(r: int, m: int):
+    print(SERVE_BANNER, flush=True)
+    for req in sys.stdin:
+        mode, *fields = req.rstrip("\n").split("\t")
+        try:
+            match mode:
+                case "?":
+                    res = query(Context(r, m), fields[0])
+                case ">":
+                    _offset, msg, *labels = fields
+                    ctx = Context(r, m, int(_offset, base=16) + CODE_BEGINNING)
+                    res = format_return(
+                        augment(ctx, msg, [int(label, base=16) for label in labels])
+                    )
+                case _:
+                    raise ValueError(f"{mode} is not ? or >")
+        except Exception as e:
+            res = "!" + f"{type(e).__name__}: {e}".replace("\n", " ")
+        sys.stdout.write(res + "\n")
+        sys.stdout.flush()
 
 
 if __name__ == "__main__":
     _, _r, _m, _f, *rest = sys.argv
-    r = int(_r)
-    m = int(_m)
+    ctx = Context(int(_r), int(_m))
 
     match _f:
+        case "serve":
+            serve(ctx.r, ctx.m)
         case "?":
             msg, *labels = rest
+            print(query(ctx, msg))
         case ">":
             _offset, msg, *labels = rest
-            offset = int(_offset, base=16)  # use for computation of labels
-            offset += 3  # hardcode for env `a`
+            # the offset is relative to the program, labels are computed from it
+            ctx.offset = int(_offset, base=16) + CODE_BEGINNING
+            print(format_return(augment(ctx, msg, [int(label, base=16) for label in labels])))
         case _:
             raise ValueError(f"{_f} is not ? or >")
-
-    registers_count = 2**r
-    sizeofreg = 2**m
-    sizeofmem = 2**sizeofreg
-
-    labels = [int(label, base=16) for label in labels]
-
-    for cmd in commands:
-        match = cmd.regex.search(msg)
-        if match is None:
-            continue
-        args = match.groups()
-        match _f:
-            case "?":
-                print(cmd.info(args))  # type: ignore
-            case ">":
-                print(cmd.eval(args, labels))  # type: ignore
-                assert len(labels) == 0
-        break
-    else:
-        raise ValueError(msg)
@@ -0,0 +1 @@
+../_shared/augmenter.py
\ No newline at end of file
@@ -23,54 +23,44 @@
 //    `data` must be binary (if started with 0xb) or hexadecimal (if started with 0x)
 //    `*created_labels` must be a sequence of hexadecimal numbers delimited by spaces
 
-reg0: 0x0 = 0x0 // reg0 must be only 0 or 1, init with 0 (this macro will actually generate no code)
-reg1: 0x0 = 0x2 // set reg1 to 2 (generates reg1[-2] = 1)
-
-// the current augmented avriable/label syntax:
-
-// @.label - declare a label
-// .label - use label
-
-// $'var - declare or set a variable (so any assignment must be `$'var = ...`, cannot be `'var = ...`)
-// 'var - use variable value
-
-// further some instructions are implisitly using 1 and j variables, so we need to define them
-// TODO: separate notion of compile time variables (alongside with labels, but the usage is strictly when declared before and can be reassigned)
-$'1 = "reg1[-2]"
-$'j = "reg7: 'reg7_value > $'reg7_value"
-$'reg7_value = 0x0
-
-reg2: 0x0 = .msg              // reg2 is the data pointer
-reg3: 0x0 = .loop - .bottom   // reg3 for jmp from .bottom to .loop
-reg4: 0x0 = 0x0               // reg4 must be 0 (this macro will actually generate no code)
-reg5: 0x0 = .halt - .top      // reg5 is for jmp from condition to halt
-reg6: 0x0 = .next             // const .next
-reg7: 'reg7_value = .end_init // temporal variable
+// the macros below take scratch registers in the parentheses, they load the jump offsets they need
+// into them, the assembler drops the loads when the registers hold the offsets already
+// (without the parentheses they take the last registers),
+// every macro gets registers of its own here and `#load` loads them before the loop,
+// so the loop doesn't load anything: assemble and run with `--r 4` for the 16 registers
+
+reg1: any = const 0x1         // stdout signal address
+reg2: any = const .msg        // reg2 is the data pointer
+reg3: any = const 0x2         // stdout trigger address
+reg4: any = const .halt - .top
+reg5: any = const .loop - .bottom
+#load == (reg6, reg7)
+#load = mem (reg8)
+#load mem = (reg9)
+#load ++ (reg10, reg11)
 
 @.loop
 
 // check pointer reached the end, jmp to halt if so
-$'next = "reg6: @.next"
-$'j = "reg7: @.end_init > $'end_end"
-reg2 == .msgend ? pp += reg5 @.top // the last command that uses j
-reg7: 'end_end = .end_init
+reg2 == .msgend ? pp += reg4 @.top (reg6, reg7)
 
 // read data bit to reg0[-1]
-reg0[-1] = mem[reg2]
+reg0[-1] = mem[reg2] (reg8)
 
 // stdout reg0[-1] bit
-mem[reg0] = reg0[-1] // set data
-mem[reg1] = 1        // trigger collect
+mem[reg1] = reg0[-1] (reg9) // set data
+mem[reg3] = 1               // trigger collect
 
 // advance data pointer
-reg2++
+reg2++ (reg10, reg11)
 
-// jmp to loop
-reg1[-2] ? pp += reg3 @.bottom
+// jmp to loop (reg1 is 1)
+reg1[-1] ? pp += reg5 @.bottom
 
 @.halt
-mem[reg4] = 1
+reg0: any = const 0x0
+mem[reg0] = 1
 
 @.msg
 #store_ascii "Hello World!\n"
-@.msgend
\ No newline at end of file
+@.msgend
@@ -0,0 +1,10 @@
+// an always taken jump over a print, the optimizer follows it and knows the registers at .end
+
+reg1: 0x0 = const 0x1
+reg2: 0x0 = const 0x2
+reg3: 0x0 = const .end - .jmp
+reg1[15] ? pp += reg3 @.jmp   // reg1 is 1, always jumps
+#dumb_stdout "skipped!!"
+@.end
+#dumb_stdout "ok\n"
+mem[reg0] = 1
@@ -0,0 +1,305 @@
+import argparse
+import hashlib
+import importlib.util
+import marshal
+import os
+from types import CodeType
+from typing import Callable, Dict, List, Tuple
+
+from decoder import MEM_CONDJMP, MEM_WRITE, REG_WRITE, Instr, decode
+from devices import Bus
+from memory import PagedBitMemory
+from registers import RegisterFile
+
+# ahead-of-time translation of a program image into python:
+# the image is swept from CODE_BEGINNING one instruction after another, every basic block
+# (the writes up to and including a condjmp) becomes a function and every instruction start
+# is an entry into it, `ENTRIES = {pos: (block, index, count)}` (a block skips its instructions
+# before the index, jumps land in the middle of blocks, e.g. into the sled of an increment,
+# and executes at most count of them from there), the start of a block with register writes
+# enters a second function of it that skips nothing and merges the consecutive ones
+# a block adds the instructions it executed to ctr[0] and returns the next pos
+# (~pos on halt, where pos is right after the halting write like the interpreter leaves it),
+# a write that changes the translated code sets dirty[0] and returns right after it,
+# the machine interprets the program from there on (and after a jump to anything but an entry)
+# a block is only entered when it fits into max_steps, the rest is stepped one instruction
+# at a time, so the step counts are exact
+# the compiled module is cached as marshalled bytecode keyed by the image, r, m, VERSION and
+# the python bytecode magic number (marshalled code only loads in the python that wrote it)
+
+VERSION = 3  # of the generated code, a part of the cache key
+CODE_BEGINNING = 3
+MAX_BLOCK = 64  # instructions per block
+
+CACHE = ".jaw-aot"
+
+
+def translate(image: bytes | bytearray | memoryview, r: int, m: int) -> str:
+    # the module source, it expects regs, mem, dev, ctr and dirty in its globals
+    # (see Translated)
+    sizeofreg = 2**m
+    sizeofmem = 2**sizeofreg
+    full = (1 << sizeofreg) - 1
+    masks = [1 << (sizeofreg - 1 - i) for i in range(sizeofreg)]
+    mem = PagedBitMemory(sizeofmem)
+    mem.load(CODE_BEGINNING, image)
+    end = CODE_BEGINNING + 8 * len(image)
+
+    # the translated instructions as (pos, instr), the sweep stops at an instruction
+    # reaching past the image
+    instrs = []
+    pos = CODE_BEGINNING
+    while pos < end:
+        ins = decode(mem, pos, r, m)
+        if pos + ins.span > end:
+            break
+        instrs.append((pos, ins))
+        pos += ins.span if ins.op & 0b01 else ins.length
+    hi = pos  # the writes into [CODE_BEGINNING, hi) change the translated code
+
+    # the blocks as lists of (pos, instr), every one up to and including a condjmp
+    # or of MAX_BLOCK instructions
+    blocks: List[List[Tuple[int, Instr]]] = []
+    for pos, ins in instrs:
+        if not blocks or len(blocks[-1]) == MAX_BLOCK or blocks[-1][-1][1].op & 0b01:
+            blocks.append([])
+        blocks[-1].append((pos, ins))
+
+    def mem_write(indent: str, n: int, b: int, done: str, nxt: int) -> List[str]:
+        return [
+            f"{indent}a = regs[{n}]",
+            f"{indent}if a in dev and dev[a](mem, a, {b}):",
+            f"{indent}    ctr[0] += {done}",
+            f"{indent}    return {~(nxt % sizeofmem)}",
+            f"{indent}if {'not ' if b else ''}mem[a]:",
+            f"{indent}    mem[a] = {b}",
+            f"{indent}    if {CODE_BEGINNING} <= a < {hi}:",
+            f"{indent}        ctr[0] += {done}",
+            f"{indent}        dirty[0] = True",
+            f"{indent}        return {nxt % sizeofmem}",
+        ]
+
+    def condjmp(op: int, n: int, i: int, k: int, done: str, nxt: int) -> List[str]:
+        return [
+            f"    ctr[0] += {done}",
+            f"    if mem[regs[{n}]]:"
+            if op == MEM_CONDJMP
+            else f"    if regs[{n}] & {masks[i]:#x}:",
+            f"        return ({nxt} + regs[{k}]) & {sizeofmem - 1}",
+            f"    return {(nxt + 1) % sizeofmem}",
+        ]
+
+    src = [
+        f"# jaw-{r}x{m}:a program translated by aot.py (version {VERSION}), do not edit",
+        "# expects regs, mem, dev, ctr and dirty to be defined (see aot.Translated)",
+        "",
+    ]
+    entries: List[Tuple[int, str, int, int]] = []  # (pos, function, index, count)
+    for block in blocks:
+        start = block[0][0]
+        # the start gets a second function when there are register writes to merge in it
+        fast = any(ins.op == REG_WRITE for _, ins in block)
+        entries.append((start, f"f{start}" if fast else f"b{start}", 0, len(block)))
+        entries.extend(
+            (pos, f"b{start}", index, len(block) - index)
+            for index, (pos, _) in enumerate(block)
+            if index
+        )
+        if len(block) > 1 or not fast:
+            # entered in the middle, the writes before the entry are skipped
+            # (a condjmp ends the block, it always runs)
+            src.append(f"def b{start}(e, regs=regs, mem=mem, dev=dev, ctr=ctr, dirty=dirty):")
+            for index, (pos, ins) in enumerate(block):
+                op, n, i, k, b, length, _ = ins
+                nxt = pos + length
+                if op & 0b01:
+                    src.extend(condjmp(op, n, i, k, f"{index + 1} - e", nxt))
+                    break
+                src.append("    if not e:" if index == 0 else f"    if e <= {index}:")
+                if op == REG_WRITE:
+                    if b:
+                        src.append(f"        regs[{n}] |= {masks[i]:#x}")
+                    else:
+                        src.append(f"        regs[{n}] &= {full ^ masks[i]:#x}")
+                else:  # MEM_WRITE
+                    src.extend(mem_write("        ", n, b, f"{index + 1} - e", nxt))
+            else:
+                src.append(f"    ctr[0] += {len(block)} - e")
+                src.append(f"    return {nxt % sizeofmem}")
+            src.append("")
+        if not fast:
+            continue
+
+        # entered at the start (a jump target), nothing is skipped and the consecutive
+        # register writes are merged into one keep/put mask pair per register
+        src.append(f"def f{start}(e, regs=regs, mem=mem, dev=dev, ctr=ctr, dirty=dirty):")
+        merged: Dict[int, Tuple[int, int]] = {}  # register -> (keep, put) of the pending writes
+
+        def flush():
+            for n, (keep, put) in merged.items():
+                if put == full ^ keep:
+                    src.append(f"    regs[{n}] |= {put:#x}")
+                elif put == 0:
+                    src.append(f"    regs[{n}] &= {keep:#x}")
+                else:
+                    src.append(f"    regs[{n}] = regs[{n}] & {keep:#x} | {put:#x}")
+            merged.clear()
+
+        for index, (pos, ins) in enumerate(block):
+            op, n, i, k, b, length, _ = ins
+            nxt = pos + length
+            if op == REG_WRITE:
+                keep, put = merged.get(n, (full, 0))
+                clear = full ^ masks[i]
+                merged[n] = (keep & clear, put | masks[i] if b else put & clear)
+                continue
+            flush()
+            if op == MEM_WRITE:
+                src.extend(mem_write("    ", n, b, f"{index + 1}", nxt))
+            else:
+                src.extend(condjmp(op, n, i, k, f"{index + 1}", nxt))
+                break
+        else:
+            flush()
+            src.append(f"    ctr[0] += {len(block)}")
+            src.append(f"    return {nxt % sizeofmem}")
+        src.append("")
+
+    src.append(f"HI = {hi}")
+    src.append("ENTRIES = {")
+    src.extend(f"    {pos}: ({fn}, {index}, {count})," for pos, fn, index, count in entries)
+    src.append("}")
+    return "\n".join(src) + "\n"
+
+
+def compile_image(
+    image: bytes | bytearray | memoryview, r: int, m: int, cache: str | None = None
+) -> CodeType:
+    # the translated module, from `cache` (a directory) when it was translated before
+    key = hashlib.sha256(
+        f"{VERSION} {r} {m} ".encode() + importlib.util.MAGIC_NUMBER + bytes(image)
+    ).hexdigest()
+    path = None if cache is None else os.path.join(cache, f"{key}.pyc")
+    if path is not None and os.path.exists(path):
+        with open(path, "rb") as f:
+            # marshal.load reads the file in small pieces, 10x slower
+            return marshal.loads(f.read())
+
+    code = compile(translate(image, r, m), f"<jaw aot {key[:12]}>", "exec")
+    if path is not None:
+        os.makedirs(cache, exist_ok=True)
+        # write aside and rename, so a concurrent run never reads a partial file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            marshal.dump(code, f)
+        os.replace(tmp, path)
+    return code
+
+
+class Translated:
+    # a translated program bound to the memory and registers of a machine
+
+    entries: Dict[int, Tuple[Callable[[int], int], int, int]]
+
+    def __init__(
+        self,
+        code: CodeType,
+        mem: PagedBitMemory,
+        registers: RegisterFile,
+        r: int,
+        m: int,
+        bus: Bus,
+    ) -> None:
+        self.mem = mem
+        self.registers = registers
+        self.r = r
+        self.m = m
+        self.bus = bus
+        self._ctr = [0]  # every exit of a block adds here the instructions it executed
+        self._dirty = [False]
+        env = {
+            "regs": registers.values,
+            "mem": mem,
+            "dev": bus.at,
+            "ctr": self._ctr,
+            "dirty": self._dirty,
+        }
+        exec(code, env)
+        self.entries = env["ENTRIES"]
+        self._hi = env["HI"]  # the writes into [CODE_BEGINNING, HI) change the translated code
+
+    @property
+    def dirty(self) -> bool:
+        # the program has written into its translated code, it is stale now
+        return self._dirty[0]
+
+    def run(self, pos: int, max_steps: int = -1) -> Tuple[int, int]:
+        # runs until halt (pos is ~pos then), max_steps instructions, the code is written
+        # or pos is not an entry, returns (pos, executed instructions)
+        entries = self.entries
+        ctr = self._ctr
+        dirty = self._dirty
+        ctr[0] = 0
+        if max_steps < 0:
+            while True:
+                entry = entries.get(pos)
+                if entry is None:
+                    break
+                pos = entry[0](entry[1])
+                if pos < 0 or dirty[0]:
+                    break
+            return pos, ctr[0]
+
+        step = self.step
+        while ctr[0] < max_steps:
+            entry = entries.get(pos)
+            if entry is None:
+                break
+            if ctr[0] + entry[2] <= max_steps:
+                pos = entry[0](entry[1])
+            else:
+                pos = step(pos)
+            if pos < 0 or dirty[0]:
+                break
+        return pos, ctr[0]
+
+    def step(self, pos: int) -> int:
+        # executes one instruction the slow way (the tail of a block past max_steps)
+        op, n, i, k, b, length, _ = decode(self.mem, pos, self.r, self.m)
+        size = self.mem.size
+        regs = self.registers.values
+        nxt = (pos + length) % size
+        self._ctr[0] += 1
+        if op == MEM_WRITE:
+            a = regs[n]
+            devices = self.bus.at
+            if a in devices and devices[a](self.mem, a, b):
+                return ~nxt
+            if self.mem[a] != b:
+                self.mem[a] = b
+                if CODE_BEGINNING <= a < self._hi:
+                    self._dirty[0] = True
+        elif op == MEM_CONDJMP:
+            return (nxt + (regs[k] if self.mem[regs[n]] else 1)) % size
+        elif op == REG_WRITE:
+            mask = self.registers.masks[i]
+            regs[n] = regs[n] | mask if b else regs[n] & ~mask
+        else:  # REG_CONDJMP
+            return (nxt + (regs[k] if regs[n] & self.registers.masks[i] else 1)) % size
+        return nxt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Translate a jaw binary into a python module (the vm runs it with --engine aot)"
+    )
+    parser.add_argument("--r", type=int, default=3, help="2^r registers")
+    parser.add_argument("--m", type=int, default=4, help="2^2^m bits of memory")
+    parser.add_argument("-o", "--output", help="The module path (default: {program}.py)")
+    parser.add_argument("program", type=str, help="The binary file to translate")
+    args = parser.parse_args()
+
+    with open(args.program, "rb") as f:
+        image = f.read()
+    with open(args.output or f"{args.program}.py", "w") as f:
+        f.write(translate(image, args.r, args.m))
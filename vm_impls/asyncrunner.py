@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import json
+import sys
+from dataclasses import asdict
+from typing import Iterable, List
+
+from batch import Job, Result, read_jobs
+from machine import Machine
+
+# runs many machines in one process on an asyncio event loop:
+# a machine executes QUANTUM instructions at a time and yields to the loop in between,
+# the loop resumes the ready tasks in order, so every running machine gets its quantum in turn
+# and a program that never halts can't starve the rest (it is stopped by the job max_steps
+# or by cancelling its task, which lands in between of two quanta),
+# every engine executes exactly the instructions it is given, so no quantum runs over
+# (blocks and aot step the instructions of a block that does not fit one at a time)
+# the image is read and loaded in a thread, so the files (and the aot translation) don't
+# hold up the loop
+# the output is handed to the sink after every quantum:
+# - asyncio.Queue: gets str chunks and None once the job is over (unless it was cancelled)
+# - asyncio.StreamWriter: gets the chunks as latin-1 bytes and is drained (it is not closed)
+# - None: the output is collected into Result.output
+
+QUANTUM = 10_000  # instructions per turn
+
+Sink = asyncio.Queue | asyncio.StreamWriter | None
+
+
+async def _emit(sink: Sink, chunks: List[str]):
+    if isinstance(sink, asyncio.Queue):
+        for chunk in chunks:
+            await sink.put(chunk)  # a bounded queue holds the machine back until it is read
+    elif sink is not None:
+        sink.write("".join(chunks).encode("latin-1"))
+        await sink.drain()
+    chunks.clear()
+
+
+def _load(machine: Machine, program: str | bytes):
+    if isinstance(program, str):
+        with open(program, "rb") as f:
+            machine.load(f.read())
+    else:
+        machine.load(program)
+
+
+async def run_job(job: Job, sink: Sink = None, quantum: int = QUANTUM) -> Result:
+    name = job.program if isinstance(job.program, str) else f"<{len(job.program)} bytes>"
+    chunks: List[str] = []
+    try:
+        machine = Machine(job.r, job.m, None if sink is None else chunks.append, job.engine)
+        await asyncio.to_thread(_load, machine, job.program)
+
+        executed = 0
+        while not machine.halted and (job.max_steps < 0 or executed < job.max_steps):
+            left = quantum if job.max_steps < 0 else min(quantum, job.max_steps - executed)
+            executed += machine.run(left)  # the output is flushed into chunks after every run
+            if chunks:
+                await _emit(sink, chunks)
+            await asyncio.sleep(0)
+    except Exception as e:
+        result = Result(name, job.r, job.m, "error", 0, "", f"{type(e).__name__}: {e}")
+    else:
+        result = Result(
+            name,
+            job.r,
+            job.m,
+            "halted" if machine.halted else "limit",
+            machine.steps,
+            machine.output,
+        )
+    if isinstance(sink, asyncio.Queue):
+        await sink.put(None)
+    return result
+
+
+async def run_all(jobs: Iterable[Job], quantum: int = QUANTUM) -> List[Result]:
+    # results come in the order of the jobs, the outputs are collected
+    return await asyncio.gather(*(run_job(job, None, quantum) for job in jobs))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run many jaw programs concurrently in one process, "
+        "prints a json line per job as it finishes"
+    )
+    parser.add_argument("--r", type=int, default=3, help="r for the programs given as arguments")
+    parser.add_argument("--m", type=int, default=4, help="m for the programs given as arguments")
+    parser.add_argument(
+        "--max-steps", type=int, default=-1, help="Stop a job after this many instructions"
+    )
+    parser.add_argument("--engine", choices=["interp", "blocks", "aot"], default="interp")
+    parser.add_argument(
+        "--quantum", type=int, default=QUANTUM, help="Instructions a machine runs in its turn"
+    )
+    parser.add_argument("--jobs", type=str, help="File with `{program} {r} {m}` per line")
+    parser.add_argument("programs", type=str, nargs="*", help="The binary files to execute")
+    args = parser.parse_args()
+    if args.quantum < 1:
+        parser.error("--quantum must be positive")
+
+    jobs = [Job(p, args.r, args.m, args.max_steps, args.engine) for p in args.programs]
+    if args.jobs is not None:
+        jobs += read_jobs(args.jobs, args.max_steps, args.engine)
+
+    async def main() -> bool:
+        failed = False
+        for done in asyncio.as_completed([run_job(job, None, args.quantum) for job in jobs]):
+            result = await done
+            print(json.dumps(asdict(result)), flush=True)
+            failed |= result.status != "halted"
+        return failed
+
+    sys.exit(1 if asyncio.run(main()) else 0)
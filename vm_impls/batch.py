@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Iterable, List
+
+from machine import Machine
+
+# runs many (binary, r, m) jobs over a pool of warm worker processes
+# every worker imports the vm once and then takes jobs one after another,
+# so a job costs a Machine, not a python interpreter startup
+
+
+@dataclass
+class Job:
+    program: str | bytes  # a path or the image itself
+    r: int = 3
+    m: int = 4
+    max_steps: int = -1
+    engine: str = "interp"
+
+
+@dataclass
+class Result:
+    program: str
+    r: int
+    m: int
+    status: str  # halted | limit (max_steps reached) | error
+    steps: int
+    output: str
+    error: str | None = None
+
+
+def run_job(job: Job) -> Result:
+    name = job.program if isinstance(job.program, str) else f"<{len(job.program)} bytes>"
+    try:
+        machine = Machine(job.r, job.m, engine=job.engine)
+        if isinstance(job.program, str):
+            with open(job.program, "rb") as f:
+                machine.load(f.read())
+        else:
+            machine.load(job.program)
+        machine.run(job.max_steps)
+    except Exception as e:
+        return Result(name, job.r, job.m, "error", 0, "", f"{type(e).__name__}: {e}")
+    return Result(
+        name,
+        job.r,
+        job.m,
+        "halted" if machine.halted else "limit",
+        machine.steps,
+        machine.output,
+    )
+
+
+def run_batch(jobs: Iterable[Job], workers: int | None = None) -> List[Result]:
+    # results come in the order of the jobs
+    jobs = list(jobs)
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(run_job, jobs, chunksize=chunksize))
+
+
+def read_jobs(path: str, max_steps: int, engine: str) -> List[Job]:
+    # one job per line: `{program} {r} {m}`, r and m can be omitted, `#` starts a comment
+    jobs: List[Job] = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            program, *rm = line.split()
+            r, m = (int(e) for e in rm) if rm else (3, 4)
+            jobs.append(Job(program, r, m, max_steps, engine))
+    return jobs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run many jaw programs in a pool of vm processes, prints a json line per job"
+    )
+    parser.add_argument("--r", type=int, default=3, help="r for the programs given as arguments")
+    parser.add_argument("--m", type=int, default=4, help="m for the programs given as arguments")
+    parser.add_argument(
+        "--max-steps", type=int, default=-1, help="Stop a job after this many instructions"
+    )
+    parser.add_argument("--engine", choices=["interp", "blocks", "aot"], default="interp")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--jobs", type=str, help="File with `{program} {r} {m}` per line")
+    parser.add_argument("programs", type=str, nargs="*", help="The binary files to execute")
+    args = parser.parse_args()
+
+    jobs = [Job(p, args.r, args.m, args.max_steps, args.engine) for p in args.programs]
+    if args.jobs is not None:
+        jobs += read_jobs(args.jobs, args.max_steps, args.engine)
+
+    failed = False
+    for result in run_batch(jobs, args.workers):
+        print(json.dumps(asdict(result)))
+        failed |= result.status != "halted"
+    sys.exit(1 if failed else 0)
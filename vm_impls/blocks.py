@@ -0,0 +1,287 @@
+from typing import Callable, Dict, List, Set, Tuple
+
+from decoder import MEM_CONDJMP, MEM_WRITE, REG_WRITE, decode
+from devices import Bus
+from memory import PagedBitMemory
+from registers import RegisterFile
+
+# basic block engine:
+# a block is a straight-line run of `00`/`10` writes ended by a `01`/`11` condjmp,
+# it is decoded on the first entry and interpreted from the decoded list until it is entered
+# HOT times, then it is translated into one python function that runs all the writes and returns
+# the next pos (~pos on halt, where pos is right after the halting write like the interpreter
+# leaves it), the consecutive register writes are merged into one keep/put mask pair per register,
+# blocks are dropped when their code is written
+# a block is only entered when it fits into max_steps, the rest is stepped one instruction
+# at a time, so the step counts are exact
+
+MAX_BLOCK = 64  # instructions per block
+HOT = 64  # entries of a block before it is compiled (compiling costs about 50 interpreted runs)
+BUCKET = 6  # the blocks are found for a written bit by the 2^6 bit bucket it is in
+
+Block = Callable[[], int]
+# (op, n, mask of bit i, k, b, pos after it) of every instruction of a block
+Code = List[Tuple[int, int, int, int, int, int]]
+
+
+class BlockEngine:
+    blocks: Dict[int, Block]
+    decoded: int
+    compiled: int
+    invalidations: int
+
+    def __init__(
+        self,
+        mem: PagedBitMemory,
+        registers: RegisterFile,
+        r: int,
+        m: int,
+        bus: Bus,
+    ) -> None:
+        self.mem = mem
+        self.registers = registers
+        self.r = r
+        self.m = m
+        self.bus = bus
+        self.blocks = {}
+        self._sizes: Dict[int, int] = {}  # block start -> its instructions
+        self._ends: Dict[int, int] = {}  # block start -> the end of its code bits
+        self._code: Dict[int, Set[int]] = {}  # bucket -> starts of the blocks compiled from it
+        # [lo, hi) covers every compiled block, writes outside of it can't hit one
+        self.lo = mem.size
+        self.hi = 0
+        self._ctr = [0]  # every exit of a block adds here the instructions it executed
+        self.decoded = 0
+        self.compiled = 0
+        self.invalidations = 0
+
+    def run(self, pos: int, max_steps: int = -1) -> Tuple[int, int]:
+        # runs until halt (pos is ~pos then) or max_steps instructions,
+        # returns (pos, executed instructions)
+        blocks = self.blocks
+        enter = self.enter
+        ctr = self._ctr
+        ctr[0] = 0
+        if max_steps < 0:
+            while pos >= 0:
+                fn = blocks.get(pos)
+                if fn is None:
+                    fn = enter(pos)
+                pos = fn()
+            return pos, ctr[0]
+
+        sizes = self._sizes
+        step = self.step
+        while pos >= 0 and ctr[0] < max_steps:
+            fn = blocks.get(pos)
+            if fn is None:
+                fn = enter(pos)
+            if ctr[0] + sizes[pos] <= max_steps:
+                pos = fn()
+            else:
+                pos = step(pos)
+        return pos, ctr[0]
+
+    def step(self, pos: int) -> int:
+        # executes one instruction the slow way (the tail of a block past max_steps)
+        ins = decode(self.mem, pos, self.r, self.m)
+        op, n, i, k, b, length, _ = ins
+        size = self.mem.size
+        regs = self.registers.values
+        nxt = (pos + length) % size
+        self._ctr[0] += 1
+        if op == MEM_WRITE:
+            a = regs[n]
+            devices = self.bus.at
+            if a in devices and devices[a](self.mem, a, b):
+                return ~nxt
+            if self.mem[a] != b:
+                self.write(a, b)
+        elif op == MEM_CONDJMP:
+            return (nxt + (regs[k] if self.mem[regs[n]] else 1)) % size
+        elif op == REG_WRITE:
+            mask = self.registers.masks[i]
+            regs[n] = regs[n] | mask if b else regs[n] & ~mask
+        else:  # REG_CONDJMP
+            return (nxt + (regs[k] if regs[n] & self.registers.masks[i] else 1)) % size
+        return nxt
+
+    def write(self, addr: int, b: int) -> bool:
+        # the slow path of a mem write that changes the bit, True if it hit compiled code
+        self.mem[addr] = b
+        if not self.lo <= addr < self.hi:
+            return False
+        starts = self._code.get(addr >> BUCKET)
+        if starts is None:
+            return False
+        hit = False
+        for start in list(starts):
+            if start <= addr < self._ends[start]:
+                self._drop(start)
+                hit = True
+        return hit
+
+    def _drop(self, start: int):
+        del self.blocks[start]
+        del self._sizes[start]
+        end = self._ends.pop(start)
+        self.invalidations += 1
+        for bucket in range(start >> BUCKET, ((end - 1) >> BUCKET) + 1):
+            starts = self._code[bucket]
+            starts.discard(start)
+            if not starts:
+                del self._code[bucket]
+
+    def enter(self, start: int) -> Block:
+        # the block for a pos entered for the first time (since its code was written)
+        code, end = self.decode(start)
+        if not code:
+            # the instruction wraps around the memory, it is only ever stepped
+            self._sizes[start] = 1
+            block = self.blocks[start] = lambda: self.step(start)
+            return block
+
+        hits = 0
+
+        def block() -> int:
+            nonlocal hits
+            hits += 1
+            if hits == HOT:
+                return self.compile(start, code)()
+            return self.interpret(code)
+
+        self.blocks[start] = block
+        self._sizes[start] = len(code)
+        self._ends[start] = end
+        self.lo = min(self.lo, start)
+        self.hi = max(self.hi, end)
+        for bucket in range(start >> BUCKET, ((end - 1) >> BUCKET) + 1):
+            self._code.setdefault(bucket, set()).add(start)
+        self.decoded += 1
+        return block
+
+    def decode(self, start: int) -> Tuple[Code, int]:
+        # the instructions from start up to the first condjmp (or MAX_BLOCK of them),
+        # a block never wraps around the memory, it ends before; returns (code, end of its bits)
+        r, m = self.r, self.m
+        size = self.mem.size
+        masks = self.registers.masks
+        max_span = 2 + r + m + r
+        span_mask = (1 << max_span) - 1
+        r_mask = (1 << r) - 1
+        m_mask = (1 << m) - 1
+        # the block bits read at once, the fields are taken from the top of the window at `at`
+        # (padded with zeroes, an instruction reading past the end does not fit)
+        width = min(MAX_BLOCK * max_span, size - start)
+        window = self.mem.read_bits(start, width) << max_span
+        top = width + max_span
+
+        code: Code = []
+        at = 0
+        while len(code) < MAX_BLOCK:
+            chunk = (window >> (top - at - max_span)) & span_mask
+            op = chunk >> (max_span - 2)
+            n = (chunk >> (m + r)) & r_mask
+            if op == MEM_WRITE:
+                ins = (op, n, 0, 0, (chunk >> (m + r - 1)) & 1, 3 + r, 3 + r)
+            elif op == MEM_CONDJMP:
+                ins = (op, n, 0, (chunk >> m) & r_mask, 0, 1 + 2 * r, 2 + 2 * r)
+            elif op == REG_WRITE:
+                mask = masks[(chunk >> r) & m_mask]
+                ins = (op, n, mask, 0, (chunk >> (r - 1)) & 1, 3 + r + m, 3 + r + m)
+            else:  # REG_CONDJMP
+                mask = masks[(chunk >> r) & m_mask]
+                ins = (op, n, mask, chunk & r_mask, 0, 1 + r + m + r, max_span)
+            op, n, mask, k, b, length, span = ins
+            if at + span > width:
+                break
+            code.append((op, n, mask, k, b, start + at + length))
+            if op & 0b01:
+                return code, start + at + span
+            at += length
+        return code, start + at
+
+    def interpret(self, code: Code) -> int:
+        # runs a block that is not hot yet, the same as its compiled function
+        mem = self.mem
+        regs = self.registers.values
+        devices = self.bus.at
+        size = mem.size
+        ctr = self._ctr
+        for done, (op, n, mask, k, b, nxt) in enumerate(code, 1):
+            if op == REG_WRITE:
+                regs[n] = regs[n] | mask if b else regs[n] & ~mask
+            elif op == MEM_WRITE:
+                a = regs[n]
+                if a in devices and devices[a](mem, a, b):
+                    ctr[0] += done
+                    return ~(nxt % size)
+                # the write could have changed the code of this very block
+                if mem[a] != b and self.write(a, b):
+                    ctr[0] += done
+                    return nxt % size
+            else:
+                ctr[0] += done
+                taken = mem[regs[n]] if op == MEM_CONDJMP else regs[n] & mask
+                return (nxt + (regs[k] if taken else 1)) % size
+        ctr[0] += len(code)
+        return nxt % size
+
+    def compile(self, start: int, code: Code) -> Block:
+        size = self.mem.size
+        full = (1 << self.registers.width) - 1
+
+        body: List[str] = []
+        merged: Dict[int, Tuple[int, int]] = {}  # register -> (keep, put) of the pending writes
+
+        def flush():
+            for n, (keep, put) in merged.items():
+                if put == full ^ keep:
+                    body.append(f"regs[{n}] |= {put:#x}")
+                elif put == 0:
+                    body.append(f"regs[{n}] &= {keep:#x}")
+                else:
+                    body.append(f"regs[{n}] = regs[{n}] & {keep:#x} | {put:#x}")
+            merged.clear()
+
+        for done, (op, n, mask, k, b, nxt) in enumerate(code, 1):
+            if op == REG_WRITE:
+                keep, put = merged.get(n, (full, 0))
+                merged[n] = (keep & ~mask, put | mask if b else put & ~mask)
+            elif op == MEM_WRITE:
+                flush()
+                body.append(f"a = regs[{n}]")
+                body.append(f"if a in dev and dev[a](mem, a, {b}):")
+                body.append(f"    ctr[0] += {done}")
+                body.append(f"    return {~(nxt % size)}")
+                # the write could have changed the code of this very block
+                body.append(f"if {'not ' if b else ''}mem[a] and write(a, {b}):")
+                body.append(f"    ctr[0] += {done}")
+                body.append(f"    return {nxt % size}")
+            else:
+                flush()
+                body.append(f"ctr[0] += {done}")
+                if op == MEM_CONDJMP:
+                    body.append(f"if mem[regs[{n}]]:")
+                else:  # REG_CONDJMP
+                    body.append(f"if regs[{n}] & {mask:#x}:")
+                body.append(f"    return ({nxt} + regs[{k}]) & {size - 1}")
+                body.append(f"return {(nxt + 1) % size}")
+        if not code[-1][0] & 0b01:
+            flush()
+            body.append(f"ctr[0] += {len(code)}")
+            body.append(f"return {nxt % size}")
+
+        src = "def block(regs=regs, mem=mem, dev=dev, write=write, ctr=ctr):\n"
+        src += "".join(f"    {line}\n" for line in body)
+        env = {
+            "regs": self.registers.values,
+            "mem": self.mem,
+            "dev": self.bus.at,
+            "write": self.write,
+            "ctr": self._ctr,
+        }
+        exec(compile(src, f"<jaw block {start}>", "exec"), env)
+        block = self.blocks[start] = env["block"]
+        self.compiled += 1
+        return block
@@ -0,0 +1,211 @@
+from typing import Dict, List, NamedTuple, Set, Tuple
+
+from memory import PagedBitMemory
+
+# 00{n:[r bits]}{<0/1>:[1 bit]}              = mem[reg[n]] = <0/1>
+# 01{n:[r bits]}{k:[r bits]}                 = mem[reg[n]] ? pp += reg[k]
+# 10{n:[r bits]}{i:[m bits]}{<0/1>:[1 bit]}  = reg[n][i] = <0/1>
+# 11{n:[r bits]}{i:[m bits]}{k:[r bits]}     = reg[n][i] ? pp += reg[k]
+
+MEM_WRITE = 0b00
+MEM_CONDJMP = 0b01
+REG_WRITE = 0b10
+REG_CONDJMP = 0b11
+
+# superinstructions, a run of instructions decoded at once and executed by one dispatch:
+# - REG_RUN: register writes and register condjmps (const loads, ripples like increments, sleds),
+#   the consecutive writes are merged into a keep/put mask pair per register
+# - MEM_RUN: memory writes (e.g. the data/trigger pairs of `#dumb_stdout`)
+REG_RUN = 4
+MEM_RUN = 5
+
+MAX_RUN = 64  # instructions per run
+RUN_BUCKET = 6  # runs are found for an invalidated bit by the 2^6 bit bucket it is in
+
+OP_NAMES = {
+    MEM_WRITE: "mem-write",
+    MEM_CONDJMP: "mem-condjmp",
+    REG_WRITE: "reg-write",
+    REG_CONDJMP: "reg-condjmp",
+}
+
+
+class Instr(NamedTuple):
+    op: int
+    n: int
+    i: int  # 0 for mem instructions
+    k: int  # 0 for write instructions
+    b: int  # 0 for condjmp instructions
+    length: int  # how far pp moves before the jump add (the last bit of k is not consumed)
+    span: int  # how many bits the instruction reads (k shares its last bit with the next one)
+
+
+class Run(NamedTuple):
+    op: int  # REG_RUN or MEM_RUN
+    count: int  # instructions
+    # REG_RUN: (writes as ((n, keep, put), ...), n, mask, k, rel, done) for every condjmp
+    #   where rel is where the condjmp moves pp (before the jump add) and done is how many
+    #   instructions are executed when it is taken, the writes at the end come with mask 0
+    # MEM_RUN: (n, b, rel) for every write, rel is where it moves pp
+    # (rel is relative to the start of the run)
+    items: Tuple
+    length: int  # how far pp moves when no jump is taken (a run never wraps around the memory)
+
+
+def decode(mem: PagedBitMemory, pos: int, r: int, m: int) -> Instr:
+    op = mem.read_bits(pos, 2)
+    n = mem.read_bits(pos + 2, r)
+    i = 0
+    k = 0
+    b = 0
+    length = 2 + r
+    if op & 0b10:
+        i = mem.read_bits(pos + length, m)
+        length += m
+    if op & 0b01:
+        k = mem.read_bits(pos + length, r)
+        length += r - 1
+        span = length + 1
+    else:
+        b = mem.read_bits(pos + length, 1)
+        length += 1
+        span = length
+    return Instr(op, n, i, k, b, length, span)
+
+
+class DecodeCache:
+    # decoded instructions keyed by the bit offset they start at
+    # any write into the bits an entry was decoded from drops that entry
+    # `runs` holds the same for the engine executing superinstructions: a Run where one starts,
+    # the plain instruction otherwise
+
+    entries: Dict[int, Instr]
+    runs: Dict[int, Instr | Run]
+    lookups: int  # one per dispatch (a run head too), counted by the engines
+    misses: int
+    invalidations: int
+    fused: int  # instructions executed by the runs beyond one per dispatch
+
+    def __init__(self, mem: PagedBitMemory, r: int, m: int) -> None:
+        self.mem = mem
+        self.r = r
+        self.m = m
+        self.entries = {}
+        self.runs = {}
+        self._run_code: Dict[int, Set[int]] = {}  # bucket -> starts of the runs decoded from it
+        self.max_span = 2 + r + m + r
+        # [lo, hi) covers every cached span, writes outside of it can't hit an entry
+        self.lo = mem.size
+        self.hi = 0
+        self.lookups = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.fused = 0
+
+    def fill(self, pos: int) -> Instr:
+        self.misses += 1
+        ins = decode(self.mem, pos, self.r, self.m)
+        end = pos + ins.span
+        if end <= self.mem.size:  # do not cache instructions wrapping around the memory
+            self.entries[pos] = ins
+            self._cover(pos, end)
+        return ins
+
+    def fill_run(self, pos: int) -> Instr | Run:
+        run = decode_run(self.mem, pos, self.r, self.m)
+        if run is None:
+            ins = self.entries.get(pos)
+            if ins is None:
+                ins = self.fill(pos)
+            if pos + ins.span <= self.mem.size:
+                self.runs[pos] = ins
+            return ins
+        self.misses += 1
+        self.runs[pos] = run
+        for bucket in range(pos >> RUN_BUCKET, ((pos + run.length - 1) >> RUN_BUCKET) + 1):
+            self._run_code.setdefault(bucket, set()).add(pos)
+        self._cover(pos, pos + run.length)
+        return run
+
+    def _cover(self, pos: int, end: int):
+        if pos < self.lo:
+            self.lo = pos
+        if end > self.hi:
+            self.hi = end
+
+    def invalidate(self, addr: int):
+        if not (self.lo <= addr < self.hi):
+            return
+        entries = self.entries
+        runs = self.runs
+        for start in range(max(self.lo, addr - self.max_span + 1), addr + 1):
+            ins = entries.get(start)
+            if ins is not None and start + ins.span > addr:
+                del entries[start]
+                self.invalidations += 1
+            ins = runs.get(start)
+            if ins is not None and ins[0] < REG_RUN and start + ins.span > addr:
+                del runs[start]
+        starts = self._run_code.get(addr >> RUN_BUCKET)
+        if starts is not None:
+            # the other buckets of a dropped run keep pointing at its start, they are checked here
+            for start in list(starts):
+                run = runs.get(start)
+                if run is None or run[0] < REG_RUN:
+                    starts.discard(start)
+                elif start <= addr < start + run.length:
+                    del runs[start]
+                    starts.discard(start)
+                    self.invalidations += 1
+
+
+def decode_run(mem: PagedBitMemory, pos: int, r: int, m: int) -> Run | None:
+    # the run starting at pos, None when there are less than 2 instructions to fuse
+    max_span = 2 + r + m + r
+    width = min(MAX_RUN * max_span, mem.size - pos)
+    if width < max_span:
+        return None
+    window = mem.read_bits(pos, width)
+    sizeofreg = 2**m
+    full = (1 << sizeofreg) - 1
+    span_mask = (1 << max_span) - 1
+    r_mask = (1 << r) - 1
+    m_mask = (1 << m) - 1
+
+    run_op = MEM_RUN if window >> (width - 2) == MEM_WRITE else REG_RUN
+    items: List[Tuple] = []
+    writes: Dict[int, Tuple[int, int]] = {}  # n -> (keep, put) of the writes since the last condjmp
+    count = 0
+    at = 0
+    while count < MAX_RUN and at + max_span <= width:
+        # the longest instruction from `at`, the fields are read from its top
+        chunk = (window >> (width - at - max_span)) & span_mask
+        op = chunk >> (max_span - 2)
+        n = (chunk >> (m + r)) & r_mask
+        if run_op == MEM_RUN:
+            if op != MEM_WRITE:
+                break
+            at += 3 + r
+            items.append((n, (chunk >> (m + r - 1)) & 1, at))
+        elif op == REG_WRITE:
+            mask = 1 << (sizeofreg - 1 - ((chunk >> r) & m_mask))
+            keep, put = writes.get(n, (full, 0))
+            writes[n] = keep & ~mask, put & ~mask | (mask if (chunk >> (r - 1)) & 1 else 0)
+            at += 3 + r + m
+        elif op == REG_CONDJMP:
+            mask = 1 << (sizeofreg - 1 - ((chunk >> r) & m_mask))
+            at += max_span
+            items.append((_merged(writes), n, mask, chunk & r_mask, at - 1, count + 1))
+            writes = {}
+        else:
+            break
+        count += 1
+    if count < 2:
+        return None
+    if writes:
+        items.append((_merged(writes), 0, 0, 0, at, count))
+    return Run(run_op, count, tuple(items), at)
+
+
+def _merged(writes: Dict[int, Tuple[int, int]]) -> Tuple[Tuple[int, int, int], ...]:
+    return tuple((n, keep, put) for n, (keep, put) in writes.items())
@@ -0,0 +1,101 @@
+from typing import Any, Callable, Dict, List
+
+from memory import PagedBitMemory
+
+# memory-mapped devices of an environment:
+# a device claims [lo, hi) of the memory and sees every write into it before the bit is written
+# (a device that halts the machine keeps the bit from being written),
+# the bus maps every claimed address to the write of its device, so the engines pay one dict
+# lookup for a write (`addr in bus.at`) and only call a device for the claimed addresses,
+# the rest is plain memory
+
+FLUSH_SIZE = 1 << 16  # stdout chars buffered before they are written out
+
+
+class Device:
+    lo: int
+    hi: int
+
+    def write(self, mem: PagedBitMemory, addr: int, b: int) -> bool:
+        # True halts the machine
+        return False
+
+    def flush(self):
+        pass
+
+
+class Halt(Device):
+    # environment `a`: writing 1 to mem[0] halts
+    lo = 0
+    hi = 1
+
+    def write(self, mem: PagedBitMemory, addr: int, b: int) -> bool:
+        return b == 1
+
+
+class Stdout(Device):
+    # environment `a`: writing 1 to mem[2] sends the bit in mem[1], every 8 bits are a char
+    # the chars are written out by FLUSH_SIZE and on flush (the machine flushes after every run),
+    # without a write callback they are all kept in `captured`
+    lo = 2
+    hi = 3
+    DATA = 1
+
+    captured: bytearray
+
+    def __init__(self, write: Callable[[str], Any] | None = None) -> None:
+        self._write = write
+        self._bits = 0
+        self._count = 0  # bits of the char being sent
+        self.captured = bytearray()
+        self._chars = self.captured if write is None else bytearray()
+
+    def write(self, mem: PagedBitMemory, addr: int, b: int) -> bool:
+        if b:
+            self._bits = self._bits << 1 | mem[self.DATA]
+            self._count += 1
+            if self._count == 8:
+                self._chars.append(self._bits)
+                self._bits = 0
+                self._count = 0
+                if len(self._chars) >= FLUSH_SIZE:
+                    self.flush()
+        return False
+
+    def flush(self):
+        if self._write is not None and self._chars:
+            self._write(self._chars.decode("latin-1"))
+            self._chars.clear()
+
+    @property
+    def pending(self) -> List[bool]:
+        # the bits of a char that is not complete yet, MSB-first
+        return [bool(self._bits >> j & 1) for j in range(self._count - 1, -1, -1)]
+
+    @pending.setter
+    def pending(self, bits: List[bool]):
+        self._bits = 0
+        for b in bits:
+            self._bits = self._bits << 1 | b
+        self._count = len(bits)
+
+
+Write = Callable[[PagedBitMemory, int, int], bool]
+
+
+class Bus:
+    devices: List[Device]
+    at: Dict[int, Write]  # claimed address -> the write of its device
+
+    def __init__(self, devices: List[Device]) -> None:
+        self.devices = devices
+        self.at = {}
+        for device in devices:
+            for addr in range(device.lo, device.hi):
+                if addr in self.at:
+                    raise ValueError(f"Address {addr} is claimed by two devices.")
+                self.at[addr] = device.write
+
+    def flush(self):
+        for device in self.devices:
+            device.flush()
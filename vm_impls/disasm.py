@@ -0,0 +1,159 @@
+import argparse
+import sys
+from typing import Iterator, NamedTuple, TextIO, Tuple
+
+import numpy as np
+
+import sourcemap
+from decoder import MEM_CONDJMP, MEM_WRITE, REG_WRITE
+from sourcemap import SourceMap
+
+# decodes the instruction starting at every bit of a loaded image in one pass of numpy ops
+# (a jump can land on any bit, so every bit starts an instruction to someone),
+# the table is indexed by pos and matches decoder.decode on a fresh machine with the image loaded:
+# the bits past the image are zeroes and the reads wrap around the memory
+# the disassembler sweeps the table from CODE_BEGINNING and prints the instructions
+# in the augmenter syntax (`reg1[3] ? pp += reg2`), the --debug output is the same with the values
+
+CODE_BEGINNING = 3
+
+
+class Table(NamedTuple):
+    # every array is of the image end (CODE_BEGINNING + its bits) in size
+    op: np.ndarray  # uint8
+    n: np.ndarray  # int64
+    i: np.ndarray  # int64, 0 for mem instructions
+    k: np.ndarray  # int64, 0 for write instructions
+    b: np.ndarray  # uint8, 0 for condjmp instructions
+    length: np.ndarray  # int64, how far pp moves before the jump add
+    span: np.ndarray  # int64, how many bits the instruction reads
+
+    def __len__(self) -> int:
+        return len(self.op)
+
+
+def decode_image(image: bytes | bytearray | memoryview, r: int, m: int) -> Table:
+    sizeofmem = 2 ** 2**m
+    end = CODE_BEGINNING + 8 * len(image)
+    if end > sizeofmem:
+        raise ValueError(
+            f"program of {8 * len(image)} bits does not fit into {sizeofmem} bits of memory"
+        )
+    max_span = 2 + r + m + r
+
+    # the memory bits from 0 up to where the last instruction of the table ends
+    bits = np.zeros(end + max_span, dtype=np.uint8)
+    bits[CODE_BEGINNING:end] = np.unpackbits(np.frombuffer(image, dtype=np.uint8))
+    if end + max_span > sizeofmem:  # the reads wrap around
+        bits[sizeofmem:] = bits[: end + max_span - sizeofmem]
+
+    # windows[pos] = the max_span bits starting at pos (a view, nothing is copied)
+    windows = np.lib.stride_tricks.sliding_window_view(bits, max_span)[:end]
+
+    def field(offset: int, width: int) -> np.ndarray:
+        weights = 1 << np.arange(width - 1, -1, -1, dtype=np.int64)
+        return windows[:, offset : offset + width] @ weights
+
+    op = windows[:, 0] << 1 | windows[:, 1]
+    isreg = windows[:, 0] == 1
+    isjmp = windows[:, 1] == 1
+    n = field(2, r)
+    i = np.where(isreg, field(2 + r, m), 0)
+    # k and b follow i in the reg instructions and n in the mem ones
+    k = np.where(isjmp, np.where(isreg, field(2 + r + m, r), field(2 + r, r)), 0)
+    b = np.where(isjmp, 0, np.where(isreg, windows[:, 2 + r + m], windows[:, 2 + r]))
+    b = b.astype(np.uint8)
+    length = 2 + r + 1 + np.where(isreg, m, 0) + np.where(isjmp, r - 2, 0)
+    span = length + isjmp
+    return Table(op, n, i, k, b, length, span)
+
+
+def mnemonic(op: int, n: int, i: int, k: int, b: int) -> str:
+    if op == MEM_WRITE:
+        return f"mem[reg{n}] = {b}"
+    elif op == MEM_CONDJMP:
+        return f"mem[reg{n}] ? pp += reg{k}"
+    elif op == REG_WRITE:
+        return f"reg{n}[{i}] = {b}"
+    else:  # REG_CONDJMP
+        return f"reg{n}[{i}] ? pp += reg{k}"
+
+
+def sweep(
+    table: Table, start: int = CODE_BEGINNING, sources: SourceMap | None = None
+) -> Iterator[Tuple[int, int, str]]:
+    # (pos, size, text) one after another from start to the end of the image,
+    # the data lines of the source map are given as they are instead of being decoded,
+    # the tail too short for an instruction comes as `.bits`
+    end = len(table)
+    pos = start
+    while pos < end:
+        source = None if sources is None else sources.find(pos)
+        if source is not None and not source.output.startswith("0xb"):
+            size = min(source.end, end) - pos
+            yield pos, size, f".data {source.output}"
+        else:
+            op = int(table.op[pos])
+            size = int(table.span[pos] if op & 0b01 else table.length[pos])
+            if pos + int(table.span[pos]) > end:
+                yield pos, end - pos, ".bits"
+                return
+            yield pos, size, mnemonic(
+                op, int(table.n[pos]), int(table.i[pos]), int(table.k[pos]), int(table.b[pos])
+            )
+        pos += size
+
+
+def disassemble(
+    image: bytes | bytearray | memoryview,
+    r: int,
+    m: int,
+    out: TextIO,
+    start: int = CODE_BEGINNING,
+    sources: SourceMap | None = None,
+):
+    table = decode_image(image, r, m)
+    bits = np.zeros(len(table) + 1, dtype=np.uint8)
+    bits[CODE_BEGINNING : len(table)] = np.unpackbits(np.frombuffer(image, dtype=np.uint8))
+    width = max(2 + r + m + r, 8)
+    for pos, size, text in sweep(table, start, sources):
+        raw = "".join("01"[e] for e in bits[pos : pos + size])
+        line = f"{pos:#06x}  {raw if len(raw) <= width else raw[:width - 1] + '~':<{width}}  {text}"
+        source = None if sources is None else sources.find(pos)
+        out.write(f"{line}  // {source}\n" if source is not None else f"{line}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Disassemble a jaw binary")
+    parser.add_argument("--r", type=int, default=3, help="2^r registers")
+    parser.add_argument("--m", type=int, default=4, help="2^2^m bits of memory")
+    parser.add_argument(
+        "--start",
+        type=lambda s: int(s, 0),
+        default=CODE_BEGINNING,
+        metavar="POS",
+        help="Where to start the sweep, e.g. a jump target in the middle of an instruction",
+    )
+    parser.add_argument(
+        "--map",
+        metavar="PATH",
+        help="The source map the assembler wrote (default: {program}.map if it exists), "
+        "every instruction is followed by its source line and the data is not decoded",
+    )
+    parser.add_argument("--no-map", action="store_true", help="Do not look for the source map")
+    parser.add_argument("program", type=str, help="The binary file to disassemble")
+    args = parser.parse_args()
+
+    path = None if args.no_map else args.map or sourcemap.find_map(args.program)
+    try:
+        with open(args.program, "rb") as f:
+            image = f.read()
+        sources = None if path is None else sourcemap.load(path)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    try:
+        disassemble(image, args.r, args.m, sys.stdout, args.start, sources)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
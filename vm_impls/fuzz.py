@@ -0,0 +1,96 @@
+import argparse
+import random
+import sys
+from typing import List, Tuple
+
+from machine import Machine
+
+# differential fuzz of the engines against the plain interpreter (fuse off, the reference):
+# random programs, biased to the runs the fused engine executes at once and with
+# the registers pointing around the code and the devices, are run side by side in chunks
+# of random sizes, the whole machine state is compared after every chunk
+# (the chunks stop in the middle of the runs and blocks, so the single steps are covered too)
+
+ENGINES = ["fused", "blocks", "aot"]
+
+CHUNKS = [1, 2, 5, 37, 300, 5000, 20000]
+
+
+def program(rng: random.Random, r: int, m: int) -> bytes:
+    bits: List[int] = []
+
+    def put(value: int, width: int):
+        bits.extend(value >> (width - 1 - j) & 1 for j in range(width))
+
+    for _ in range(rng.randint(2, 120)):
+        op = rng.choices([0b00, 0b01, 0b10, 0b11], [3, 1, 6, 3])[0]
+        put(op, 2)
+        put(rng.randrange(2**r), r)
+        if op & 0b10:
+            put(rng.randrange(2**m), m)
+        if op & 0b01:
+            put(rng.randrange(2**r), r)
+        else:
+            put(rng.randrange(2), 1)
+    bits = bits[: (2 ** 2**m - 3) // 8 * 8]
+    bits += [0] * (-len(bits) % 8)
+    return bytes(int("".join(map(str, bits[j : j + 8])), 2) for j in range(0, len(bits), 8))
+
+
+def state(machine: Machine, out: List[str]) -> Tuple:
+    return (
+        machine.pos,
+        machine.steps,
+        machine.halted,
+        list(machine.registers.values),
+        [(idx, bytes(page)) for idx, page in machine.mem.pages()],
+        "".join(out),
+        machine.stdout.pending,
+    )
+
+
+def fuzz(count: int, seed: int, engine: str = "fused") -> bool:
+    rng = random.Random(seed)
+    for case in range(count):
+        r = rng.choice([1, 2, 3])
+        m = rng.choice([2, 3, 3, 4, 4])
+        image = program(rng, r, m)
+        regs = [rng.choice([0, 1, 2, 3, rng.randrange(2 ** 2**m)]) for _ in range(2**r)]
+        machines = []
+        for tested in (False, True):
+            out: List[str] = []
+            tested_engine = engine if tested and engine != "fused" else "interp"
+            machine = Machine(r, m, out.append, tested_engine)
+            machine.fuse = tested
+            machine.load(image)
+            machine.registers.values[:] = regs
+            machines.append((machine, out))
+
+        for _ in range(rng.randint(1, 6)):
+            steps = rng.choice(CHUNKS)
+            for machine, _ in machines:
+                machine.run(steps)
+            expected, got = (state(machine, out) for machine, out in machines)
+            if expected != got:
+                names = ["pos", "steps", "halted", "registers", "memory", "output", "pending"]
+                diff = ", ".join(n for n, a, b in zip(names, expected, got) if a != b)
+                print(
+                    f"Error: case {case} (r={r} m={m} image={image.hex()} registers={regs}) "
+                    f"differs in {diff} after a chunk of {steps} steps"
+                )
+                return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run random programs on the plain interpreter and on an engine and compare them"
+    )
+    parser.add_argument("--engine", choices=ENGINES, default="fused")
+    parser.add_argument("--count", type=int, default=500, help="How many programs to run")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if not fuzz(args.count, args.seed, args.engine):
+        sys.exit(1)
+    print(f"ok, {args.count} programs")
@@ -0,0 +1,178 @@
+import numpy as np
+
+from decoder import MEM_CONDJMP, MEM_WRITE, REG_CONDJMP, REG_WRITE
+
+# runs N jaw-{r}x{m}:a machines in lockstep, every step advances all the running machines
+# by one instruction with numpy ops over the machine axis
+# divergent jumps are handled with per-machine masks, halted machines just stop stepping
+
+# the whole memory of every machine is kept packed (MSB-first, the same as PagedBitMemory),
+# so it is only meant for address spaces up to jaw-{r}x4 (8KiB per machine)
+MAX_M = 4
+
+CODE_BEGINNING = 3
+
+
+class Lockstep:
+    mem: np.ndarray  # (count, sizeofmem / 8) uint8
+    regs: np.ndarray  # (count, 2^r) int64
+    pos: np.ndarray  # (count,) int64
+    halted: np.ndarray  # (count,) bool
+    steps: np.ndarray  # (count,) int64, executed instructions per machine
+
+    def __init__(self, r: int, m: int, count: int) -> None:
+        if r < 1 or m < 1:
+            raise ValueError("r and m must be greater than or equal to 1")
+        if m > MAX_M:
+            raise ValueError(f"m > {MAX_M} is too large to keep dense memory for every machine")
+        self.r = r
+        self.m = m
+        self.count = count
+        self.sizeofreg = 2**m
+        self.sizeofmem = 2**self.sizeofreg
+
+        self.mem = np.zeros((count, (self.sizeofmem + 7) // 8), dtype=np.uint8)
+        self.regs = np.zeros((count, 2**r), dtype=np.int64)
+        self.pos = np.full(count, CODE_BEGINNING, dtype=np.int64)
+        self.halted = np.zeros(count, dtype=bool)
+        self.steps = np.zeros(count, dtype=np.int64)
+
+        # stdout bits of every machine, packed the same way as the memory
+        self._out = np.zeros((count, 16), dtype=np.uint8)
+        self._outlen = np.zeros(count, dtype=np.int64)
+
+        self._span = 2 + r + m + r  # the longest instruction
+        # pp advance per opcode (not counting the jump add)
+        lengths = {
+            MEM_WRITE: 2 + r + 1,
+            MEM_CONDJMP: 2 + r + r - 1,
+            REG_WRITE: 2 + r + m + 1,
+            REG_CONDJMP: 2 + r + m + r - 1,
+        }
+        self._lengths = np.array([lengths[op] for op in range(4)], dtype=np.int64)
+
+    def load(self, image: bytes, machine: int | None = None):
+        # places the program at CODE_BEGINNING of one machine (or of all of them)
+        # the rest of the memory is zeroed, so patch test vectors in after loading
+        bits = np.unpackbits(np.frombuffer(image, dtype=np.uint8))
+        if CODE_BEGINNING + len(bits) > self.sizeofmem:
+            raise ValueError(
+                f"program of {len(bits)} bits does not fit into {self.sizeofmem} bits of memory"
+            )
+        dense = np.zeros(self.mem.shape[1] * 8, dtype=np.uint8)
+        dense[CODE_BEGINNING : CODE_BEGINNING + len(bits)] = bits
+        packed = np.packbits(dense)
+        if machine is None:
+            self.mem[:] = packed
+        else:
+            self.mem[machine] = packed
+
+    def poke(self, machine: int | None, addr: int, bits: str):
+        # writes a string of '0'/'1' into the memory starting from addr
+        rows = slice(None) if machine is None else machine
+        for j, bit in enumerate(bits):
+            a = (addr + j) % self.sizeofmem
+            if bit == "1":
+                self.mem[rows, a >> 3] |= 0x80 >> (a & 7)
+            else:
+                self.mem[rows, a >> 3] &= ~np.uint8(0x80 >> (a & 7))
+
+    def peek(self, machine: int, addr: int, count: int = 1) -> int:
+        res = 0
+        for j in range(count):
+            a = (addr + j) % self.sizeofmem
+            res = (res << 1) | int((self.mem[machine, a >> 3] >> (7 - (a & 7))) & 1)
+        return res
+
+    def output(self, machine: int) -> str:
+        # what the machine has printed so far (a not finished char is not included)
+        size = int(self._outlen[machine]) // 8
+        return "".join(map(chr, self._out[machine, :size]))
+
+    def _membits(self, rows: np.ndarray, addrs: np.ndarray) -> np.ndarray:
+        return (self.mem[rows, addrs >> 3] >> (7 - (addrs & 7)).astype(np.uint8)) & 1
+
+    def _fwd(self, rows: np.ndarray, bits: np.ndarray):
+        at = self._outlen[rows]
+        if int(at.max()) >= self._out.shape[1] * 8:
+            self._out = np.concatenate([self._out, np.zeros_like(self._out)], axis=1)
+        self._out[rows, at >> 3] |= (bits << (7 - (at & 7))).astype(np.uint8)
+        self._outlen[rows] += 1
+
+    def step(self) -> int:
+        # advances every running machine by one instruction, returns how many were running
+        active = np.flatnonzero(~self.halted)
+        if active.size == 0:
+            return 0
+        r, m, w = self.r, self.m, self.sizeofreg
+        memmask = self.sizeofmem - 1
+        pos = self.pos[active]
+
+        # decode the instruction at pos of every machine
+        bits = np.empty((self._span, active.size), dtype=np.int64)
+        for j in range(self._span):
+            bits[j] = self._membits(active, (pos + j) & memmask)
+
+        def field(offset: int, width: int) -> np.ndarray:
+            res = bits[offset].copy()
+            for j in range(1, width):
+                res = (res << 1) | bits[offset + j]
+            return res
+
+        op = (bits[0] << 1) | bits[1]
+        isreg = bits[0] == 1
+        n = field(2, r)
+        i = field(2 + r, m)  # only meaningful for reg instructions
+        k = np.where(isreg, field(2 + r + m, r), field(2 + r, r))
+        b = np.where(isreg, bits[2 + r + m], bits[2 + r])
+
+        regn = self.regs[active, n]
+        regk = self.regs[active, k]
+        newpos = (pos + self._lengths[op]) & memmask
+        self.steps[active] += 1
+
+        # mem[reg[n]] = b
+        mw = op == MEM_WRITE
+        set1 = mw & (b == 1)
+        halt = set1 & (regn == 0)
+        trig = set1 & (regn == 2)
+        if trig.any():
+            rows = active[trig]
+            self._fwd(rows, self._membits(rows, np.ones(rows.size, dtype=np.int64)))
+        write = mw & ~halt
+        if write.any():
+            rows = active[write]
+            addrs = regn[write]
+            cur = self.mem[rows, addrs >> 3]
+            mask = (0x80 >> (addrs & 7)).astype(np.uint8)
+            self.mem[rows, addrs >> 3] = np.where(b[write] == 1, cur | mask, cur & ~mask)
+
+        # reg[n][i] = b
+        rw = op == REG_WRITE
+        if rw.any():
+            mask = np.left_shift(1, w - 1 - i[rw])
+            self.regs[active[rw], n[rw]] = np.where(
+                b[rw] == 1, regn[rw] | mask, regn[rw] & ~mask
+            )
+
+        # mem[reg[n]] ? pp += reg[k] and reg[n][i] ? pp += reg[k]
+        cond = np.zeros(active.size, dtype=bool)
+        mj = op == MEM_CONDJMP
+        if mj.any():
+            cond[mj] = self._membits(active[mj], regn[mj]) == 1
+        rj = op == REG_CONDJMP
+        if rj.any():
+            cond[rj] = ((regn[rj] >> (w - 1 - i[rj])) & 1) == 1
+        jmp = mj | rj
+        newpos = np.where(jmp, (newpos + np.where(cond, regk, 1)) & memmask, newpos)
+
+        self.pos[active] = newpos
+        self.halted[active[halt]] = True
+        return active.size
+
+    def run(self, max_steps: int = -1) -> int:
+        # steps until every machine halts or max_steps lockstep steps, returns the steps done
+        done = 0
+        while done != max_steps and self.step():
+            done += 1
+        return done
@@ -0,0 +1,407 @@
+from itertools import repeat
+from typing import Any, Callable, List
+
+import aot
+import snapshot
+from blocks import BlockEngine
+from decoder import MEM_CONDJMP, MEM_WRITE, REG_RUN, REG_WRITE, DecodeCache
+from devices import Bus, Device, Halt, Stdout
+from memory import PagedBitMemory
+from profiler import Profiler
+from registers import RegisterFile
+from sourcemap import SourceMap
+from tracer import Tracer
+
+# an embeddable jaw-{r}x{m}:a machine (see p1.py for the arch and envirionment description)
+
+CODE_BEGINNING = 3
+
+
+class Machine:
+    # engine:
+    # - interp: decode-cached interpreter, steps exactly and supports debug/profiler/tracer,
+    #   without them it executes the runs of instructions it can fuse by one dispatch (see fuse)
+    # - blocks: basic blocks, compiled to python functions once they are hot, steps exactly
+    #   (see blocks.py)
+    # - aot: the loaded image translated into a python module ahead of time (see aot.py, cached
+    #   in aot_cache), steps exactly, it falls back to interp once the program writes into
+    #   its code or jumps to anything but a translated instruction
+    #   (and a restored machine is only interpreted)
+
+    r: int
+    m: int
+    mem: PagedBitMemory
+    registers: RegisterFile
+    pos: int
+    steps: int  # executed instructions (including the halting one)
+    halted: bool
+    bus: Bus  # the devices of the environment (see devices.py)
+    stdout: Stdout
+
+    aot_cache: str | None  # where the aot engine keeps the translated images (None: nowhere)
+    fuse: bool  # let interp execute superinstructions (decoder.Run) when nothing watches the steps
+    debug: bool
+    sources: SourceMap | None  # --debug shows the source line of every instruction
+    profiler: Profiler | None
+    tracer: Tracer | None
+
+    def __init__(
+        self,
+        r: int,
+        m: int,
+        stdout: Callable[[str], Any] | None = None,
+        engine: str = "interp",
+        devices: List[Device] | None = None,
+    ) -> None:
+        if r < 1:
+            raise ValueError("Register space must be greater than or equal to 1.")
+        if m < 1:
+            raise ValueError("Address space must be greater than or equal to 1.")
+        if engine not in ("interp", "blocks", "aot"):
+            raise ValueError(f"Unknown engine {engine}.")
+        self.r = r
+        self.m = m
+        self.sizeofreg = 2**m
+        self.sizeofmem = 2**self.sizeofreg
+        self.engine = engine
+
+        self.mem = PagedBitMemory(self.sizeofmem)
+        self.registers = RegisterFile(r, m)
+        self.pos = CODE_BEGINNING
+        self.steps = 0
+        self.halted = False
+
+        # without a stdout callback the output is collected and available as `output`,
+        # the devices are attached next to the ones of environment `a`
+        self.stdout = Stdout(stdout)
+        self.bus = Bus([Halt(), self.stdout, *(devices or [])])
+
+        self.aot_cache = None
+        self.fuse = True
+        self.debug = False
+        self.sources = None
+        self.profiler = None
+        self.tracer = None
+        self._cache: DecodeCache | None = None
+        self._blocks: BlockEngine | None = None
+        self._aot: aot.Translated | None = None
+
+    @classmethod
+    def restore(
+        cls,
+        snap: snapshot.Snapshot,
+        stdout: Callable[[str], Any] | None = None,
+        engine: str = "interp",
+    ) -> "Machine":
+        machine = cls(snap.r, snap.m, stdout, engine)
+        machine.mem = snap.mem
+        machine.registers = snap.registers
+        machine.pos = snap.pos
+        machine.steps = snap.steps
+        machine.stdout.pending = snap.outbuf
+        return machine
+
+    def snapshot(self) -> snapshot.Snapshot:
+        return snapshot.Snapshot(
+            self.r,
+            self.m,
+            self.pos,
+            self.steps,
+            self.mem,
+            self.registers,
+            self.stdout.pending,
+        )
+
+    def load(self, image: bytes | bytearray | memoryview):
+        # places the program at CODE_BEGINNING, the program pointer is reset to it
+        if CODE_BEGINNING + 8 * len(image) > self.sizeofmem:
+            raise ValueError(
+                f"The program of {8 * len(image)} bits does not fit into "
+                f"{self.sizeofmem - CODE_BEGINNING} bits of memory available for it."
+            )
+        self.mem.load(CODE_BEGINNING, image)
+        self.pos = CODE_BEGINNING
+        self._cache = None
+        self._blocks = None
+        self._aot = None
+        if self.engine == "aot":
+            code = aot.compile_image(image, self.r, self.m, self.aot_cache)
+            self._aot = aot.Translated(code, self.mem, self.registers, self.r, self.m, self.bus)
+
+    @property
+    def output(self) -> str:
+        # what was printed so far (only when constructed without a stdout callback)
+        return self.stdout.captured.decode("latin-1")
+
+    def step(self, n: int = 1) -> int:
+        return self.run(n)
+
+    def run(self, max_steps: int = -1) -> int:
+        # runs until halt or max_steps instructions (-1 for no limit), returns how many were executed
+        # the buffered output is flushed after every run
+        if self.halted or max_steps == 0:
+            return 0
+        try:
+            if self.engine == "blocks":
+                return self._run_blocks(max_steps)
+            if self.engine == "aot":
+                return self._run_aot(max_steps)
+            return self._run_interp(max_steps)
+        finally:
+            self.bus.flush()
+
+    def _run_blocks(self, max_steps: int) -> int:
+        if self._blocks is None:
+            self._blocks = BlockEngine(
+                self.mem, self.registers, self.r, self.m, self.bus
+            )
+        pos, executed = self._blocks.run(self.pos, max_steps)
+        if pos < 0:
+            self.halted = True
+            pos = ~pos
+        self.pos = pos
+        self.steps += executed
+        return executed
+
+    def _run_aot(self, max_steps: int) -> int:
+        executed = 0
+        while not self.halted and (max_steps < 0 or executed < max_steps):
+            left = max_steps - executed if max_steps >= 0 else -1
+            translated = self._aot
+            if translated is None:
+                return executed + self._run_interp(left)
+            if self.pos not in translated.entries:
+                # data, past the image or in the middle of an instruction, the interpreted code
+                # could write into the translated one unnoticed
+                self._aot = None
+                continue
+            pos, done = translated.run(self.pos, left)
+            # the translated code writes the memory behind the decode cache
+            self._cache = None
+            executed += done
+            self.steps += done
+            if pos < 0:
+                self.halted = True
+                pos = ~pos
+            self.pos = pos
+            if translated.dirty:
+                self._aot = None
+        return executed
+
+    def _run_interp(self, max_steps: int) -> int:
+        if self._cache is None:
+            self._cache = DecodeCache(self.mem, self.r, self.m)
+        if self.fuse and not self.debug and self.profiler is None and self.tracer is None:
+            return self._run_fused(max_steps)
+        cache = self._cache
+        decoded = cache.entries
+        mem = self.mem
+        regs = self.registers.values
+        masks = self.registers.masks
+        sizeofmem = self.sizeofmem
+        devices = self.bus.at
+        debug = self.debug
+        sources = self.sources
+        profiler = self.profiler
+        prof = profiler is not None
+        tracer = self.tracer
+        tracing = tracer is not None
+
+        pos = self.pos
+        steps = start = self.steps
+        # iterating a repeat is cheaper than comparing steps against a limit
+        ticks = repeat(None) if max_steps < 0 else repeat(None, max_steps)
+
+        try:
+            for _ in ticks:
+                ins = decoded.get(pos)
+                if ins is None:
+                    ins = cache.fill(pos)
+                op, n, i, k, b, length, _ = ins
+                at = pos
+                pos = (pos + length) % sizeofmem
+                steps += 1
+                if prof:
+                    profiler.step(at, op)
+
+                if op == MEM_WRITE:
+                    regn_val = regs[n]
+                    if tracing:
+                        tracer.record(at, op, n, 0, 0, b, regn_val, pos, 0, False)
+                    if regn_val in devices and devices[regn_val](mem, regn_val, b):
+                        self.halted = True
+                        break  # halt
+                    if mem[regn_val] != b:
+                        mem[regn_val] = b
+                        cache.invalidate(regn_val)  # the code could be self-modifying
+                    if debug:
+                        print(f"mem[reg{n}:{regn_val}] = {b}", end="")
+                elif op == MEM_CONDJMP:
+                    regn_val = regs[n]
+                    regk_val = regs[k]
+                    taken = mem[regn_val]
+                    pos = (pos + (regk_val if taken else 1)) % sizeofmem
+                    if prof:
+                        profiler.jump(at, taken)
+                    if tracing:
+                        tracer.record(at, op, n, 0, k, 0, regn_val, pos, regk_val, taken)
+                    if debug:
+                        print(
+                            f"mem[reg{n}:{regn_val}] ? pp:{pos} += reg{k}:{regk_val}",
+                            end="",
+                        )
+                elif op == REG_WRITE:
+                    if b:
+                        regs[n] |= masks[i]
+                    else:
+                        regs[n] &= ~masks[i]
+                    if tracing:
+                        tracer.record(at, op, n, i, 0, b, 0, pos, 0, False)
+                    if debug:
+                        print(f"reg{n}[{i}] = {b}", end="")
+                else:  # REG_CONDJMP
+                    regk_val = regs[k]
+                    taken = regs[n] & masks[i]
+                    pos = (pos + (regk_val if taken else 1)) % sizeofmem
+                    if prof:
+                        profiler.jump(at, taken)
+                    if tracing:
+                        tracer.record(at, op, n, i, k, 0, 0, pos, regk_val, taken)
+                    if debug:
+                        print(f"reg{n}[{i}] ? pp:{pos} += reg{k}:{regk_val}", end="")
+
+                if debug:
+                    source = None if sources is None else sources.find(at)
+                    if source is not None:
+                        print(f"  // {source}", end="")
+                    input()
+        finally:
+            self.pos = pos
+            self.steps = steps
+            cache.lookups += steps - start  # one per instruction
+
+        return steps - start
+
+    def _run_fused(self, max_steps: int) -> int:
+        # the same as _run_interp without debug/profiler/tracer, the runs are executed at once,
+        # a run that would go past max_steps is executed instruction by instruction
+        cache = self._cache
+        assert cache is not None
+        decoded = cache.entries
+        runs = cache.runs
+        mem = self.mem
+        regs = self.registers.values
+        masks = self.registers.masks
+        sizeofmem = self.sizeofmem
+        devices = self.bus.at
+
+        pos = self.pos
+        steps = start = self.steps
+        limit = start + max_steps if max_steps >= 0 else float("inf")
+        lookups = 0
+
+        try:
+            while steps < limit:
+                lookups += 1
+                ins = runs.get(pos)
+                if ins is None:
+                    ins = cache.fill_run(pos)
+                op = ins[0]
+                if op >= REG_RUN:
+                    if steps + ins.count <= limit:
+                        if op == REG_RUN:
+                            for writes, n, mask, k, rel, done in ins.items:
+                                for w, keep, put in writes:
+                                    regs[w] = regs[w] & keep | put
+                                if regs[n] & mask:
+                                    pos = (pos + rel + regs[k]) % sizeofmem
+                                    break
+                            else:
+                                done = ins.count
+                                pos = (pos + ins.length) % sizeofmem
+                        else:  # MEM_RUN
+                            base = pos
+                            done = 0
+                            for n, b, rel in ins.items:
+                                done += 1
+                                pos = base + rel
+                                regn_val = regs[n]
+                                if regn_val in devices and devices[regn_val](mem, regn_val, b):
+                                    self.halted = True
+                                    break  # halt
+                                if mem[regn_val] != b:
+                                    mem[regn_val] = b
+                                    cache.invalidate(regn_val)
+                                    if runs.get(base) is not ins:
+                                        break  # it wrote into its own code
+                            pos %= sizeofmem
+                        steps += done
+                        cache.fused += done - 1
+                        if self.halted:
+                            break
+                        continue
+                    lookups += 1  # the run doesn't fit, its first instruction is looked up
+                    ins = decoded.get(pos)
+                    if ins is None:
+                        ins = cache.fill(pos)
+
+                op, n, i, k, b, length, _ = ins
+                pos = (pos + length) % sizeofmem
+                steps += 1
+
+                if op == MEM_WRITE:
+                    regn_val = regs[n]
+                    if regn_val in devices and devices[regn_val](mem, regn_val, b):
+                        self.halted = True
+                        break  # halt
+                    if mem[regn_val] != b:
+                        mem[regn_val] = b
+                        cache.invalidate(regn_val)  # the code could be self-modifying
+                elif op == MEM_CONDJMP:
+                    if mem[regs[n]]:
+                        pos = (pos + regs[k]) % sizeofmem
+                    else:
+                        pos = (pos + 1) % sizeofmem
+                elif op == REG_WRITE:
+                    if b:
+                        regs[n] |= masks[i]
+                    else:
+                        regs[n] &= ~masks[i]
+                else:  # REG_CONDJMP
+                    if regs[n] & masks[i]:
+                        pos = (pos + regs[k]) % sizeofmem
+                    else:
+                        pos = (pos + 1) % sizeofmem
+        finally:
+            self.pos = pos
+            self.steps = steps
+            cache.lookups += lookups
+
+        return steps - start
+
+    def stats(self) -> str:
+        lines = [f"Steps: {self.steps}"]
+        if self._cache is not None:
+            cache = self._cache
+            hits = cache.lookups - cache.misses
+            lines.append(
+                f"Decode cache: {cache.lookups} lookups, {hits} hits, {cache.misses} misses, "
+                f"{cache.invalidations} invalidations ({100 * hits / max(cache.lookups, 1):.2f}% hit rate)"
+            )
+            if cache.fused:
+                lines.append(f"Fused: {cache.fused} instructions executed without a dispatch")
+        if self._blocks is not None:
+            lines.append(
+                f"Blocks: {self._blocks.decoded} decoded, {self._blocks.compiled} compiled, "
+                f"{self._blocks.invalidations} invalidated"
+            )
+        if self.engine == "aot":
+            lines.append(
+                f"AOT: {len(self._aot.entries)} instructions translated"
+                if self._aot is not None
+                else "AOT: interpreted (the program has left its translated code or was restored)"
+            )
+        lines.append(
+            f"Resident memory: {self.mem.resident_pages} pages ({self.mem.resident_bytes} bytes)"
+        )
+        return "\n".join(lines)
@@ -0,0 +1,133 @@
+from typing import Dict, List, Tuple
+
+# bits are packed MSB-first into bytes, so bit `a` lives in byte `a >> 3`
+# under the mask `0x80 >> (a & 7)` (same order as the program image on disk)
+
+PAGE_SHIFT = 15  # 2^15 bits = 4KiB per page
+
+
+class PagedBitMemory:
+    # sparse bit-addressable memory of `size` bits
+    # pages are allocated on the first write of a 1 bit, untouched pages read as zeroes
+    # (envirionment `a` guarantees that the memory starts filled with zeroes)
+
+    size: int
+    page_shift: int
+    _pages: Dict[int, bytearray | memoryview]  # memoryview for pages mapped from a snapshot
+
+    def __init__(self, size: int, page_shift: int = PAGE_SHIFT) -> None:
+        assert size > 0 and size & (size - 1) == 0, "size must be a power of 2"
+        self.size = size
+        # do not make pages larger than the whole memory, but keep them at least a byte
+        self.page_shift = max(3, min(page_shift, size.bit_length() - 1))
+        self._page_bits = 1 << self.page_shift
+        self._page_mask = self._page_bits - 1
+        self._pages = {}
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, addr: int) -> bool:
+        page = self._pages.get(addr >> self.page_shift)
+        if page is None:
+            return False
+        off = addr & self._page_mask
+        return bool(page[off >> 3] & (0x80 >> (off & 7)))
+
+    def __setitem__(self, addr: int, b: bool):
+        idx = addr >> self.page_shift
+        page = self._pages.get(idx)
+        if page is None:
+            if not b:
+                return  # already zero, keep the page implicit
+            page = self._pages[idx] = bytearray(self._page_bits >> 3)
+        off = addr & self._page_mask
+        if b:
+            page[off >> 3] |= 0x80 >> (off & 7)
+        else:
+            page[off >> 3] &= ~(0x80 >> (off & 7)) & 0xFF
+
+    def read_bits(self, addr: int, count: int) -> int:
+        # read `count` bits starting from `addr` as an MSB-first unsigned int
+        # the read wraps around the end of the memory the same way the program pointer does
+        addr %= self.size
+        last = addr + count - 1
+        if last < self.size and addr >> self.page_shift == last >> self.page_shift:
+            page = self._pages.get(addr >> self.page_shift)
+            if page is None:
+                return 0
+            off = addr & self._page_mask
+            first_byte = off >> 3
+            last_byte = (off + count - 1) >> 3
+            chunk = int.from_bytes(page[first_byte : last_byte + 1], "big")
+            tail = ((last_byte + 1) << 3) - (off + count)
+            return (chunk >> tail) & ((1 << count) - 1)
+
+        # crosses a page boundary or the end of the memory
+        res = 0
+        for j in range(count):
+            res = (res << 1) | self[(addr + j) % self.size]
+        return res
+
+    def load(self, addr: int, data: bytes | bytearray | memoryview):
+        # bulk write of `data` as bits starting from `addr` (it must fit without wrapping)
+        # data aligned to a byte is copied into the pages as is, otherwise it is shifted once
+        nbits = len(data) * 8
+        if addr < 0 or addr + nbits > self.size:
+            raise ValueError(f"{nbits} bits do not fit into the memory at {addr}")
+        if nbits == 0:
+            return
+
+        shift = addr & 7
+        if shift:
+            value = int.from_bytes(data, "big") << (8 - shift)
+            buf = bytearray(value.to_bytes(len(data) + 1, "big"))
+            # keep the bits around the loaded range
+            buf[0] |= self._byte(addr >> 3) & (0xFF00 >> shift)
+            buf[-1] |= self._byte((addr + nbits) >> 3) & (0xFF >> shift)
+        else:
+            buf = data
+
+        page_bytes = self.page_bytes
+        with memoryview(buf) as view:
+            at = addr >> 3
+            done = 0
+            while done < len(view):
+                off = at % page_bytes
+                chunk = view[done : done + page_bytes - off]
+                idx = at // page_bytes
+                page = self._pages.get(idx)
+                if page is None:
+                    if chunk.tobytes().count(0) == len(chunk):
+                        at += len(chunk)
+                        done += len(chunk)
+                        continue  # keep zero pages implicit
+                    page = self._pages[idx] = bytearray(page_bytes)
+                page[off : off + len(chunk)] = chunk
+                at += len(chunk)
+                done += len(chunk)
+
+    def _byte(self, i: int) -> int:
+        page = self._pages.get(i // self.page_bytes)
+        return 0 if page is None else page[i % self.page_bytes]
+
+    @property
+    def page_bytes(self) -> int:
+        return self._page_bits >> 3
+
+    def pages(self) -> List[Tuple[int, bytearray | memoryview]]:
+        # resident pages as (page index, page data), ordered by address
+        return sorted(self._pages.items())
+
+    def map_page(self, idx: int, page: bytearray | memoryview):
+        # use a writable buffer as the page (e.g. a copy-on-write view of a mmapped snapshot)
+        assert len(page) == self.page_bytes, "wrong page size"
+        self._pages[idx] = page
+
+    @property
+    def resident_pages(self) -> int:
+        return len(self._pages)
+
+    @property
+    def resident_bytes(self) -> int:
+        return len(self._pages) * self.page_bytes
@@ -19,126 +19,132 @@
 # the fullname of the context is `{arch}:{env}` = `jaw-{r}x{m}:a`
 
 import argparse
+import mmap
+import os
+import signal
 import sys
-from typing import List
+from typing import Set, Tuple
 
+import aot
+import snapshot
+import sourcemap
+from machine import Machine
+from profiler import Profiler
+from tracer import Tracer, parse_ops, parse_pc_range
 
-def b2i(bits: List[bool]) -> int:
-    return int("".join(["1" if b else "0" for b in bits]), 2)
+CHECKPOINT_QUANTUM = 100_000  # how often a pending SIGUSR1 checkpoint is looked at
 
 
-class BitStdOut:
-    _buf: List[bool]
+def open_image(program: str | bytes | bytearray | memoryview):
+    # a path is mmapped, so the image goes to the memory without being read through python
+    if not isinstance(program, str):
+        return program
+    with open(program, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    def __init__(self) -> None:
-        self._buf = []
 
-    def fwd(self, b: bool):
-        self._buf.append(b)
-        if len(self._buf) == 8:
-            sys.stdout.write(chr(b2i(self._buf)))
-            self._buf = []
+def exec_jaw(
+    debug: bool,
+    r: int,
+    m: int,
+    program: str | bytes | bytearray | memoryview | None,
+    stats: bool = False,
+    engine: str = "interp",
+    profile: str | None = None,
+    checkpoint: str | None = None,
+    checkpoint_at: int = -1,
+    restore: str | None = None,
+    trace: str | None = None,
+    trace_pc: Tuple[int, int] = (0, 2**64),
+    trace_ops: Set[int] | None = None,
+    source_map: str | None = None,
+    fuse: bool = True,
+    aot_cache: str | None = None,
+):
+    if engine != "interp" and (
+        debug or profile is not None or checkpoint is not None or trace is not None
+    ):
+        print(
+            "Error: --debug, --profile, --checkpoint and --trace are only supported by the interp engine."
+        )
+        return
 
+    try:
+        if restore is not None:
+            machine = Machine.restore(snapshot.load(restore), sys.stdout.write, engine)
+        else:
+            machine = Machine(r, m, sys.stdout.write, engine)
+            machine.aot_cache = aot_cache
+            image = open_image(program)
+            try:
+                machine.load(image)
+            finally:
+                if isinstance(image, mmap.mmap):
+                    image.close()
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        return
 
-def exec_jaw(debug: bool, r: int, m: int, program: str):
-    CODE_BEGINNING = 3
+    if debug or profile is not None:
+        if source_map is None and isinstance(program, str):
+            source_map = sourcemap.find_map(program)
+        if source_map is not None:
+            try:
+                machine.sources = sourcemap.load(source_map)
+            except (OSError, ValueError) as e:
+                print(f"Error: {e}")
+                return
 
-    if r < 1:
-        print("Error: Register space must be greater than or equal to 1.")
-        return
-    if m < 1:
-        print("Error: Address space must be greater than or equal to 1.")
-        return
+    machine.fuse = fuse
+    machine.debug = debug
+    if profile is not None:
+        machine.profiler = Profiler(machine.r, machine.m)
+    if trace is not None:
+        try:
+            machine.tracer = Tracer(trace, machine.r, machine.m, trace_pc, trace_ops)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            return
 
-    sizeofreg = 2**m
-    registers_count = 2**r
+    try:
+        if checkpoint is None:
+            machine.run()
+        else:
+            _run_with_checkpoints(machine, checkpoint, checkpoint_at)
+    finally:
+        # also on KeyboardInterrupt, so a program that does not halt can still be profiled
+        if machine.profiler is not None:
+            machine.profiler.report(sys.stderr, sources=machine.sources)
+            machine.profiler.dump(
+                profile or f"{restore if program is None else program}.profile.json",
+                machine.sources,
+            )
+        if machine.tracer is not None:
+            machine.tracer.close()
 
-    mem: List[bool] = [False] * 2**sizeofreg
-    sizeofmem = 2**sizeofreg
+    if stats:
+        print(machine.stats(), file=sys.stderr)
 
-    with open(program, "rb") as f:
-        byte = f.read(1)
-        pos = CODE_BEGINNING
-        while byte:
-            for bit in format(int.from_bytes(byte, "big"), "08b"):
-                mem[pos] = bit == "1"
-                pos += 1
-            byte = f.read(1)
-
-    pos = CODE_BEGINNING
-    registers: List[List[bool]] = [[False] * sizeofreg for _ in range(registers_count)]
-
-    def memread_1bit():
-        nonlocal pos
-        res = mem[pos]
-        pos = (1 + pos) % sizeofmem
-        return res
-
-    def memread(bits: int):
-        return [memread_1bit() for _ in range(bits)]
-
-    stdout = BitStdOut()
-
-    # 00{n:[r bits]}{<0/1>:[1 bit]}              = mem[reg[n]] = <0/1>
-    # 01{n:[r bits]}{k:[r bits]}                 = mem[reg[n]] ? pp += reg[k]
-    # 10{n:[r bits]}{i:[m bits]}{<0/1>:[1 bit]}  = reg[n][i] = <0/1>
-    # 11{n:[r bits]}{i:[m bits]}{k:[r bits]}     = reg[n][i] ? pp += reg[k]
-
-    while True:
-        regbit = (
-            memread_1bit()
-        )  # true - reg[n][i], false - mem[reg[n]] (aka [bit slot]: reg/mem)
-        jmp = (
-            memread_1bit()
-        )  # true - pp += reg[k], false - write bit (aka [action]: condjmp/write)
-
-        n = b2i(memread(r))
-        regn = registers[n]
-
-        match (regbit, jmp):
-            case (False, False):
-                regn_val = b2i(regn)
-                b = memread_1bit()
-                if b:  # check triggers
-                    if regn_val == 0:
-                        break  # halt
-                    elif regn_val == 2:
-                        # send stdout
-                        stdout.fwd(mem[1])
-                mem[regn_val] = b
-                if debug:
-                    print(f"mem[reg{n}:{regn_val}] = {int(b)}", end="")
-            case (False, True):
-                regn_val = b2i(regn)
-                k = b2i(memread(r - 1) + [mem[pos]])
-                regk = registers[k]
-                regk_val = b2i(regk)
-                add = regk_val if mem[regn_val] else 1
-                pos = (pos + add) % sizeofmem
-                if debug:
-                    print(
-                        f"mem[reg{n}:{regn_val}] ? pp:{pos} += reg{k}:{regk_val}",
-                        end="",
-                    )
-            case (True, False):
-                i = b2i(memread(m))
-                regn[i] = memread_1bit()
-                if debug:
-                    print(f"reg{n}[{i}] = {int(regn[i])}", end="")
-            case (True, True):
-                i = b2i(memread(m))
-                k = b2i(memread(r - 1) + [mem[pos]])
-                regk = registers[k]
-                regk_val = b2i(regk)
-                add = regk_val if regn[i] else 1
-                pos = (pos + add) % sizeofmem
-                if debug:
-                    print(f"reg{n}[{i}] ? pp:{pos} += reg{k}:{regk_val}", end="")
-            case _:
-                raise AssertionError()
-
-        if debug:
-            input()
+
+def _run_with_checkpoints(machine: Machine, checkpoint: str, checkpoint_at: int):
+    # writes a checkpoint after checkpoint_at instructions and on SIGUSR1
+    # (the latter is picked up in between of CHECKPOINT_QUANTUM instructions)
+    pending = [False]
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda *_: pending.__setitem__(0, True))
+
+    # checked before every quantum, so `--checkpoint-at 0` (or the steps a restored run starts from)
+    # writes the state before the first instruction
+    while not machine.halted:
+        if pending[0] or machine.steps == checkpoint_at:
+            pending[0] = False
+            snapshot.save(checkpoint, machine.snapshot())
+        quantum = CHECKPOINT_QUANTUM
+        if checkpoint_at > machine.steps:
+            quantum = min(quantum, checkpoint_at - machine.steps)
+        machine.run(quantum)
 
 
 if __name__ == "__main__":
@@ -156,6 +162,105 @@ if __name__ == "__main__":
         default=4,
     )
     parser.add_argument("--debug", action="store_true")
-    parser.add_argument("program", type=str, help="The binary file to execute")
+    parser.add_argument(
+        "--engine",
+        choices=["interp", "blocks", "aot"],
+        default="interp",
+        help="interp - decode-cached interpreter, blocks - basic blocks compiled to python functions, "
+        "aot - the whole program translated to python before it runs (the translation costs tens "
+        "of ms and is cached, it pays off from the second run of a long program)",
+    )
+    parser.add_argument(
+        "--aot-cache",
+        metavar="DIR",
+        help=f"Where --engine aot keeps the translated programs (default: {aot.CACHE} next to the program)",
+    )
+    parser.add_argument(
+        "--no-aot-cache", action="store_true", help="Translate the program anew on every run"
+    )
+    parser.add_argument(
+        "--stats", action="store_true", help="Print execution stats to stderr on halt"
+    )
+    parser.add_argument(
+        "--no-fuse",
+        action="store_true",
+        help="Dispatch every instruction on its own in the interp engine "
+        "(by default the runs of register instructions and of memory writes are executed at once)",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        metavar="JSON",
+        help="Count executed instructions, print the hot spots to stderr and dump them as json "
+        "(to {program}.profile.json by default)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        metavar="PATH",
+        help="Where to write the vm state on --checkpoint-at or on SIGUSR1",
+    )
+    parser.add_argument(
+        "--checkpoint-at",
+        type=int,
+        default=-1,
+        metavar="STEPS",
+        help="Write a checkpoint after this many instructions are executed",
+    )
+    parser.add_argument(
+        "--restore",
+        metavar="PATH",
+        help="Continue from a checkpoint instead of loading a program (--r/--m are taken from it)",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="Record executed instructions to a binary trace (print it with tracer.py)",
+    )
+    parser.add_argument(
+        "--trace-pc",
+        type=parse_pc_range,
+        default=(0, 2**64),
+        metavar="LO:HI",
+        help="Only trace instructions with pos in [LO, HI)",
+    )
+    parser.add_argument(
+        "--trace-ops",
+        type=parse_ops,
+        metavar="CLASSES",
+        help="Only trace these comma separated instruction classes "
+        "(mem-write, mem-condjmp, reg-write, reg-condjmp)",
+    )
+    parser.add_argument(
+        "--map",
+        metavar="PATH",
+        help="The source map the assembler wrote, for --debug and --profile "
+        "(default: {program}.map if it exists)",
+    )
+    parser.add_argument(
+        "program", type=str, nargs="?", help="The binary file to execute"
+    )
     args = parser.parse_args()
-    exec_jaw(args.debug, args.r, args.m, args.program)
+    if args.program is None and args.restore is None:
+        parser.error("either program or --restore is required")
+    if args.checkpoint_at >= 0 and args.checkpoint is None:
+        parser.error("--checkpoint-at needs --checkpoint to tell where to write the checkpoint")
+    exec_jaw(
+        args.debug,
+        args.r,
+        args.m,
+        args.program,
+        args.stats,
+        args.engine,
+        args.profile,
+        args.checkpoint,
+        args.checkpoint_at,
+        args.restore,
+        args.trace,
+        args.trace_pc,
+        args.trace_ops,
+        args.map,
+        not args.no_fuse,
+        None if args.no_aot_cache or args.program is None
+        else args.aot_cache or os.path.join(os.path.dirname(args.program), aot.CACHE),
+    )
@@ -0,0 +1,108 @@
+import json
+from typing import Dict, List, TextIO, Tuple
+
+from decoder import OP_NAMES
+from sourcemap import Source, SourceMap
+
+
+class Profiler:
+    # counts executed instructions per opcode class, per program pointer and per jump edge
+    # (the vm only calls it when profiling is enabled)
+
+    steps: int
+    ops: List[int]
+    pcs: Dict[int, int]  # pos -> executions
+    pc_ops: Dict[int, int]  # pos -> opcode of the last instruction executed there
+    edges: Dict[int, List[int]]  # pos of a condjmp -> [taken, not taken]
+
+    def __init__(self, r: int, m: int) -> None:
+        self.r = r
+        self.m = m
+        self.steps = 0
+        self.ops = [0] * len(OP_NAMES)
+        self.pcs = {}
+        self.pc_ops = {}
+        self.edges = {}
+
+    def step(self, pos: int, op: int):
+        self.steps += 1
+        self.ops[op] += 1
+        self.pcs[pos] = self.pcs.get(pos, 0) + 1
+        self.pc_ops[pos] = op
+
+    def jump(self, pos: int, taken: bool):
+        edge = self.edges.get(pos)
+        if edge is None:
+            edge = self.edges[pos] = [0, 0]
+        edge[0 if taken else 1] += 1
+
+    def hot_pcs(self):
+        return sorted(self.pcs.items(), key=lambda e: (-e[1], e[0]))
+
+    def hot_lines(self, sources: SourceMap) -> List[Tuple[Source | None, int]]:
+        # executions summed per source line (None for the code the map doesn't cover)
+        counts: Dict[Source | None, int] = {}
+        for pos, count in self.pcs.items():
+            source = sources.find(pos)
+            counts[source] = counts.get(source, 0) + count
+        return sorted(counts.items(), key=lambda e: -e[1])
+
+    def report(self, out: TextIO, top: int = 20, sources: SourceMap | None = None):
+        steps = max(self.steps, 1)
+        print(f"Profile: {self.steps} steps", file=out)
+        for op, name in OP_NAMES.items():
+            count = self.ops[op]
+            print(f"  {name:<12} {count:>12} {100 * count / steps:6.2f}%", file=out)
+
+        print(f"Hot spots (top {top} of {len(self.pcs)}):", file=out)
+        print(f"  {'pos':>10} {'count':>12} {'%':>7}  {'op':<12} taken/not taken", file=out)
+        for pos, count in self.hot_pcs()[:top]:
+            edge = self.edges.get(pos)
+            source = None if sources is None else sources.find(pos)
+            print(
+                f"  {pos:>#10x} {count:>12} {100 * count / steps:6.2f}%  {OP_NAMES[self.pc_ops[pos]]:<12}"
+                + (f" {edge[0]}/{edge[1]}" if edge is not None else "")
+                + (f"  {source.file}:{source.lineno}" if source is not None else ""),
+                file=out,
+            )
+
+        if sources is not None:
+            lines = self.hot_lines(sources)
+            print(f"Hot lines (top {top} of {len(lines)}):", file=out)
+            print(f"  {'count':>12} {'%':>7}  line", file=out)
+            for source, count in lines[:top]:
+                print(
+                    f"  {count:>12} {100 * count / steps:6.2f}%  "
+                    + (str(source) if source is not None else "(not in the map)"),
+                    file=out,
+                )
+
+    def dump(self, path: str, sources: SourceMap | None = None):
+        profile = {
+            "r": self.r,
+            "m": self.m,
+            "steps": self.steps,
+            "ops": {name: self.ops[op] for op, name in OP_NAMES.items()},
+            "pcs": [
+                {"pos": pos, "count": count, "op": OP_NAMES[self.pc_ops[pos]]}
+                for pos, count in self.hot_pcs()
+            ],
+            "edges": [
+                {"pos": pos, "taken": edge[0], "not_taken": edge[1]}
+                for pos, edge in sorted(self.edges.items())
+            ],
+        }
+        if sources is not None:
+            profile["lines"] = [
+                {
+                    "file": source.file,
+                    "line": source.lineno,
+                    "macro": source.macro,
+                    "text": source.text,
+                    "count": count,
+                }
+                for source, count in self.hot_lines(sources)
+                if source is not None
+            ]
+        with open(path, "w") as f:
+            json.dump(profile, f)
@@ -0,0 +1,41 @@
+from typing import List
+
+
+class RegisterFile:
+    # 2^r registers of 2^m bits each, every register is kept as a plain int
+    # bits are indexed MSB-first like in `reg[n][i]`, so bit i is under `masks[i]`
+    # engines are free to work on `values` and `masks` directly in their hot loops
+
+    count: int
+    width: int
+    values: List[int]
+    masks: List[int]
+
+    def __init__(self, r: int, m: int) -> None:
+        self.count = 2**r
+        self.width = 2**m
+        self.values = [0] * self.count
+        self.masks = [1 << (self.width - 1 - i) for i in range(self.width)]
+        self._full = (1 << self.width) - 1
+
+    def __getitem__(self, n: int) -> int:
+        return self.values[n]
+
+    def __setitem__(self, n: int, value: int):
+        self.values[n] = value & self._full
+
+    def __len__(self) -> int:
+        return self.count
+
+    def test(self, n: int, i: int) -> bool:
+        return bool(self.values[n] & self.masks[i])
+
+    def set_bit(self, n: int, i: int, b: bool):
+        if b:
+            self.values[n] |= self.masks[i]
+        else:
+            self.values[n] &= ~self.masks[i]
+
+    def bits(self, n: int) -> List[bool]:
+        # the old List[bool] view of a register (MSB first)
+        return [bool(self.values[n] & mask) for mask in self.masks]
@@ -0,0 +1,68 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+import snapshot
+from fuzz import program
+from machine import Machine
+
+# saves snapshots of random runs, loads them back and compares the machines,
+# then loads every truncation of them and a few files that are not snapshots,
+# which must be refused with a ValueError (not crash the loader or load garbage)
+
+
+def check(count: int, seed: int) -> bool:
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "run.snap")
+        for case in range(count):
+            r = rng.choice([1, 2, 3])
+            m = rng.choice([2, 3, 4])
+            machine = Machine(r, m, lambda _: None)
+            machine.load(program(rng, r, m))
+            machine.run(rng.randint(0, 300))
+            snapshot.save(path, machine.snapshot())
+            with open(path, "rb") as f:
+                data = f.read()
+
+            restored = Machine.restore(snapshot.load(path), lambda _: None)
+            expected = (machine.pos, machine.steps, list(machine.registers.values))
+            got = (restored.pos, restored.steps, list(restored.registers.values))
+            if expected != got:
+                print(f"Error: case {case} (r={r} m={m}) restored as {got} instead of {expected}")
+                return False
+
+            cuts = {0, 1, snapshot.HEADER.size - 1, snapshot.HEADER.size, len(data) - 1}
+            cuts |= {rng.randrange(len(data)) for _ in range(8)}
+            broken = [data[:e] for e in sorted(cuts)]
+            broken.append(b"not a snapshot at all" * 4)
+            broken.append(bytes(len(data)))
+            for contents in broken:
+                with open(path, "wb") as f:
+                    f.write(contents)
+                try:
+                    snapshot.load(path)
+                except ValueError:
+                    continue
+                except Exception as e:
+                    print(f"Error: case {case} (r={r} m={m}): {len(contents)} of {len(data)} bytes "
+                          f"raised {type(e).__name__}: {e}")
+                    return False
+                print(f"Error: case {case} (r={r} m={m}): {len(contents)} of {len(data)} bytes loaded")
+                return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Save and load snapshots of random runs, and load broken ones"
+    )
+    parser.add_argument("--count", type=int, default=100, help="How many runs to snapshot")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if not check(args.count, args.seed):
+        sys.exit(1)
+    print(f"ok, {args.count} snapshots")
@@ -0,0 +1,105 @@
+import mmap
+import os
+import struct
+from dataclasses import dataclass
+from typing import List
+
+from memory import PagedBitMemory
+from registers import RegisterFile
+
+# snapshot file layout (all little-endian):
+# - header: magic, r, m, page_shift, (pad), resident pages count, pos, steps,
+#   stdout buffer length and its bits (MSB-first, the buffer is always < 8 bits)
+# - registers: 2^r registers, each big-endian in max(1, 2^m / 8) bytes
+# - page table: resident page indexes as u64
+# - page data: every resident page as is, starting at a multiple of the page size
+#   so the pages can be mapped back copy-on-write straight from the file
+
+MAGIC = b"JAWSNAP1"
+HEADER = struct.Struct("<8sBBBxIQQBB6x")
+
+
+@dataclass
+class Snapshot:
+    r: int
+    m: int
+    pos: int
+    steps: int
+    mem: PagedBitMemory
+    registers: RegisterFile
+    outbuf: List[bool]  # not yet printed stdout bits (devices.Stdout.pending)
+
+
+def _regbytes(m: int) -> int:
+    return max(1, 2**m // 8)
+
+
+def save(path: str, snap: Snapshot):
+    pages = snap.mem.pages()
+    outbits = 0
+    for b in snap.outbuf:
+        outbits = (outbits << 1) | b
+    outbits <<= 8 - len(snap.outbuf)
+
+    head = HEADER.pack(
+        MAGIC,
+        snap.r,
+        snap.m,
+        snap.mem.page_shift,
+        len(pages),
+        snap.pos,
+        snap.steps,
+        len(snap.outbuf),
+        outbits & 0xFF,
+    )
+    regbytes = _regbytes(snap.m)
+    head += b"".join(v.to_bytes(regbytes, "big") for v in snap.registers.values)
+    head += struct.pack(f"<{len(pages)}Q", *(idx for idx, _ in pages))
+    head += bytes(-len(head) % snap.mem.page_bytes)
+
+    # write aside and rename, so the snapshot that is being replaced stays valid for its readers
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(head)
+        for _, page in pages:
+            f.write(page)
+    os.replace(tmp, path)
+
+
+def load(path: str) -> Snapshot:
+    # the memory pages are not read, they are views of a private (copy-on-write) mapping of the file,
+    # so many runs forked from one snapshot share the pages they have not written to
+    # the sizes are checked before anything is unpacked or allocated from the header
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise ValueError(f"{path} is not a jaw snapshot")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    view = memoryview(mm)
+
+    magic, r, m, page_shift, npages, pos, steps, outlen, outbits = HEADER.unpack_from(view)
+    if magic != MAGIC or page_shift < 3 or outlen >= 8:
+        raise ValueError(f"{path} is not a jaw snapshot")
+    at = HEADER.size
+
+    regbytes = _regbytes(m)
+    data = at + 2**r * regbytes + 8 * npages
+    data += -data % (1 << page_shift >> 3)
+    if len(view) < data + (npages << page_shift >> 3):
+        raise ValueError(f"{path} is truncated or not a jaw snapshot")
+
+    registers = RegisterFile(r, m)
+    for n in range(registers.count):
+        registers[n] = int.from_bytes(view[at : at + regbytes], "big")
+        at += regbytes
+
+    idxs = struct.unpack_from(f"<{npages}Q", view, at)
+    at += 8 * npages
+
+    mem = PagedBitMemory(2 ** 2**m, page_shift)
+    at += -at % mem.page_bytes
+    for idx in idxs:
+        mem.map_page(idx, view[at : at + mem.page_bytes])
+        at += mem.page_bytes
+
+    outbuf = [bool(outbits & (0x80 >> j)) for j in range(outlen)]
+    return Snapshot(r, m, pos, steps, mem, registers, outbuf)
@@ -0,0 +1,65 @@
+import bisect
+import os
+from typing import List, NamedTuple
+
+# reads the sidecar the assembler writes next to a binary (`{program}.map`):
+# - header: `jaw-map 1 {source file}`
+# - a line per source line with code, sorted by the offset:
+#   `{bit offset in the binary hex} {size in bits hex} {lineno}\t{macro}\t{line}\t{augmenter output}`
+# (see asm_impls/sourcemap.py)
+
+MAGIC = "jaw-map 1"
+CODE_BEGINNING = 3  # the binary is loaded here, so pos = CODE_BEGINNING + the bit offset
+
+
+class Source(NamedTuple):
+    start: int  # pos of the first bit
+    end: int
+    file: str
+    lineno: int
+    macro: str  # e.g. `reg{}++ (reg{}, reg{})`
+    text: str
+    output: str  # the emitted bits as the augmenter answered them (`0xb...` or `0x...`)
+
+    def __str__(self) -> str:
+        return f"{self.file}:{self.lineno} {self.text}"
+
+
+class SourceMap:
+    def __init__(self, sources: List[Source]) -> None:
+        self.sources = sources
+        self._starts = [e.start for e in sources]
+
+    def find(self, pos: int) -> Source | None:
+        j = bisect.bisect_right(self._starts, pos) - 1
+        if j >= 0 and pos < self.sources[j].end:
+            return self.sources[j]
+        return None
+
+
+def load(path: str) -> SourceMap:
+    with open(path, "r") as f:
+        header = f.readline().rstrip("\n")
+        if not header.startswith(MAGIC + " "):
+            raise ValueError(f"{path} is not a jaw source map")
+        file = header[len(MAGIC) + 1 :]
+        sources: List[Source] = []
+        for lineno, line in enumerate(f, 2):
+            try:
+                head, macro, text, output = line.rstrip("\n").split("\t")
+                offset, size, source_lineno = head.split()
+                start = CODE_BEGINNING + int(offset, 16)
+                sources.append(
+                    Source(start, start + int(size, 16), file, int(source_lineno), macro, text, output)
+                )
+            except ValueError:
+                raise ValueError(f"{path}:{lineno}: malformed source map line")
+    if any(a.start > b.start for a, b in zip(sources, sources[1:])):
+        raise ValueError(f"{path} is not sorted")
+    return SourceMap(sources)
+
+
+def find_map(program: str) -> str | None:
+    # the map the assembler wrote next to the binary, if there is one
+    path = program + ".map"
+    return path if os.path.exists(path) else None
@@ -0,0 +1,154 @@
+import argparse
+import struct
+import sys
+from typing import BinaryIO, Iterator, NamedTuple, Set, Tuple
+
+import sourcemap
+from decoder import MEM_CONDJMP, MEM_WRITE, OP_NAMES, REG_WRITE
+
+# trace file layout:
+# - header: magic, r, m
+# - records of a fixed size, little-endian:
+#   {pos}{flags: op << 2 | b << 1 | taken}{n}{i}{k}{addr}{dest}{regk}
+#   where pos/addr/dest/regk are as wide as a register (1, 2, 4 or 8 bytes for m <= 6),
+#   n/k are as wide as a register index (1, 2, 4 or 8 bytes for r <= 64), i is a byte,
+#   addr is reg[n] for mem instructions, dest is pp after the instruction
+#   and regk is reg[k] for condjmps
+
+MAGIC = b"JAWTRACE"
+HEADER = struct.Struct("<8sBB6x")
+
+FLUSH_SIZE = 1 << 20  # bytes
+
+_ADDR_FORMATS = {1: "B", 2: "B", 3: "B", 4: "H", 5: "I", 6: "Q"}
+_INDEX_FORMATS = {8: "B", 16: "H", 32: "I", 64: "Q"}  # the widest r of every format
+
+
+def record_struct(r: int, m: int) -> struct.Struct:
+    a = _ADDR_FORMATS.get(m)
+    if a is None:
+        raise ValueError(f"tracing is not supported for m = {m}")
+    x = next((f for bits, f in _INDEX_FORMATS.items() if r <= bits), None)
+    if x is None:
+        raise ValueError(f"tracing is not supported for r = {r}")
+    return struct.Struct(f"<{a}B{x}B{x}{a}{a}{a}")
+
+
+class TraceRecord(NamedTuple):
+    pos: int
+    op: int
+    n: int
+    i: int
+    k: int
+    b: int
+    addr: int
+    dest: int
+    regk: int
+    taken: bool
+
+    def __str__(self) -> str:
+        # the same form as the vm prints with --debug
+        if self.op == MEM_WRITE:
+            return f"mem[reg{self.n}:{self.addr}] = {self.b}"
+        elif self.op == MEM_CONDJMP:
+            return f"mem[reg{self.n}:{self.addr}] ? pp:{self.dest} += reg{self.k}:{self.regk}"
+        elif self.op == REG_WRITE:
+            return f"reg{self.n}[{self.i}] = {self.b}"
+        else:  # REG_CONDJMP
+            return f"reg{self.n}[{self.i}] ? pp:{self.dest} += reg{self.k}:{self.regk}"
+
+
+def parse_pc_range(s: str) -> Tuple[int, int]:
+    # `lo:hi` (hi is exclusive), any side can be omitted
+    lo, _, hi = s.partition(":")
+    return (int(lo, 0) if lo else 0, int(hi, 0) if hi else 2**64)
+
+
+def parse_ops(s: str) -> Set[int]:
+    ops = {name: op for op, name in OP_NAMES.items()}
+    try:
+        return {ops[name] for name in s.split(",")}
+    except KeyError as e:
+        raise ValueError(f"unknown instruction class {e}, expected any of {', '.join(ops)}")
+
+
+class Tracer:
+    # buffers the records of executed instructions and writes them in large chunks
+
+    def __init__(
+        self,
+        path: str,
+        r: int,
+        m: int,
+        pc_range: Tuple[int, int] = (0, 2**64),
+        ops: Set[int] | None = None,
+    ) -> None:
+        self._rec = record_struct(r, m)
+        self._f = open(path, "wb")
+        self._f.write(HEADER.pack(MAGIC, r, m))
+        self._buf = bytearray()
+        self.lo, self.hi = pc_range
+        self.ops = set(OP_NAMES) if ops is None else ops
+        self.recorded = 0
+
+    def record(
+        self,
+        pos: int,
+        op: int,
+        n: int,
+        i: int,
+        k: int,
+        b: int,
+        addr: int,
+        dest: int,
+        regk: int,
+        taken: bool,
+    ):
+        if not (self.lo <= pos < self.hi) or op not in self.ops:
+            return
+        self._buf += self._rec.pack(
+            pos, op << 2 | b << 1 | bool(taken), n, i, k, addr, dest, regk
+        )
+        self.recorded += 1
+        if len(self._buf) >= FLUSH_SIZE:
+            self._f.write(self._buf)
+            self._buf.clear()
+
+    def close(self):
+        self._f.write(self._buf)
+        self._buf.clear()
+        self._f.close()
+
+
+def read_trace(f: BinaryIO) -> Iterator[TraceRecord]:
+    magic, r, m = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("not a jaw trace")
+    rec = record_struct(r, m)
+    while True:
+        chunk = f.read(rec.size * 65536)
+        if not chunk:
+            break
+        for pos, flags, n, i, k, addr, dest, regk in rec.iter_unpack(chunk):
+            yield TraceRecord(pos, flags >> 2, n, i, k, flags >> 1 & 1, addr, dest, regk, bool(flags & 1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print a jaw vm trace in the --debug form")
+    parser.add_argument("--pos", action="store_true", help="Prefix every record with its pos")
+    parser.add_argument(
+        "--map",
+        metavar="PATH",
+        help="The source map of the traced program, every record is followed by its source line",
+    )
+    parser.add_argument("trace", type=str, help="The trace file written by the vm --trace")
+    args = parser.parse_args()
+
+    sources = None if args.map is None else sourcemap.load(args.map)
+    out = sys.stdout
+    with open(args.trace, "rb") as f:
+        for record in read_trace(f):
+            if args.pos:
+                out.write(f"{record.pos:#x}: ")
+            source = None if sources is None else sources.find(record.pos)
+            out.write(f"{record}  // {source}\n" if source is not None else f"{record}\n")